@@ -1,14 +1,15 @@
 import streamlit as st
+import instrumentation
 from generate_puzzles import (
     PuzzleGenerator,
     PUZZLES_OPENINGS_BY_NAME,
     PUZZLES_OPENINGS_BY_USER,
 )
-
-import chess
+from puzzle_prefetch import PuzzlePrefetcher, PuzzleRequest
 
 DEFAULT_USERNAME = "trisolaran3"
 DEFAULT_OPENING = "French Defense"
+DEFAULT_RATING = 1400
 
 
 @st.cache_resource
@@ -16,7 +17,18 @@ def get_puzzle_generator():
     return PuzzleGenerator()
 
 
+@st.cache_resource
+def get_prefetcher():
+    return PuzzlePrefetcher(get_puzzle_generator())
+
+
+def next_puzzle():
+    st.session_state.advance = True
+
+
 puzzle_generator = get_puzzle_generator()
+if "prefetch" not in st.session_state:
+    st.session_state.prefetch = get_prefetcher().session_queue()
 
 puzzle_pack = st.selectbox(
     "Puzzle Pack",
@@ -30,13 +42,26 @@ username = ""
 if puzzle_pack == PUZZLES_OPENINGS_BY_USER:
     username = st.text_input("Lichess Username", DEFAULT_USERNAME)
 
-fen, analysis_url = puzzle_generator.generate_puzzle_fen_string(
-    puzzle_pack_name=puzzle_pack,
-    target_rating=1400,
-    opening_name=opening_name,
-    username=username,
-)
+target_rating = st.slider("Target Rating", 600, 2800, DEFAULT_RATING, step=50)
+
+# Keep showing the same puzzle across unrelated reruns; take the next one
+# from the session's prefetch queue on "Next Puzzle" or new inputs.
+request = PuzzleRequest(puzzle_pack, target_rating, opening_name, username)
+if (
+    st.session_state.get("advance")
+    or st.session_state.get("request") != request
+    or "puzzle" not in st.session_state
+):
+    st.session_state.puzzle = st.session_state.prefetch.next(request)
+    st.session_state.request = request
+    st.session_state.advance = False
+fen, analysis_url = st.session_state.puzzle
 
 st.components.v1.iframe(analysis_url, width=370, height=515, scrolling=False)
 
-st.button("Next Puzzle")
+st.button("Next Puzzle", on_click=next_puzzle)
+
+# st.query_params only exists from Streamlit 1.30.
+if "timings" in st.experimental_get_query_params():
+    with st.expander("Timings"):
+        st.code(instrumentation.get_instrumentation().format_summary())
@@ -0,0 +1,366 @@
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from instrumentation import peak_rss_mb
+from process_puzzles import PUZZLE_INPUT_FILE, PUZZLE_OUTPUT_DIR, filter_puzzles
+
+# Bump when stages or their measurements change, so old reports are not
+# compared like for like.
+BENCHMARK_VERSION = 1
+SYNTHETIC_SIZES = {"10k": 10_000, "1m": 1_000_000, "4m": 4_000_000}
+LICHESS_FIELDS = [
+    "PuzzleId",
+    "FEN",
+    "Moves",
+    "Rating",
+    "RatingDeviation",
+    "Popularity",
+    "NbPlays",
+    "Themes",
+    "GameUrl",
+    "OpeningTags",
+]
+MOTIF_THEMES = [
+    "advantage",
+    "crushing",
+    "mate",
+    "mateIn1",
+    "mateIn2",
+    "mateIn3",
+    "fork",
+    "pin",
+    "skewer",
+    "sacrifice",
+    "discoveredAttack",
+    "hangingPiece",
+    "kingsideAttack",
+    "defensiveMove",
+    "quietMove",
+    "deflection",
+]
+LENGTH_THEMES = ["oneMove", "short", "long", "veryLong"]
+OPENING_FAMILIES = {
+    "Sicilian_Defense": ["Najdorf_Variation", "Dragon_Variation", "Alapin_Variation"],
+    "French_Defense": ["Advance_Variation", "Winawer_Variation"],
+    "Italian_Game": ["Giuoco_Piano", "Two_Knights_Defense"],
+    "Kings_Indian_Defense": ["Classical_Variation", "Samisch_Variation"],
+    "Queens_Gambit_Declined": ["Exchange_Variation"],
+    "Caro-Kann_Defense": ["Advance_Variation", "Classical_Variation"],
+    "Ruy_Lopez": ["Berlin_Defense", "Closed"],
+    "Scandinavian_Defense": ["Mieses-Kotroc_Variation"],
+}
+POSITION_POOL_SIZE = 4000
+LATENCY_CALLS = 2000
+
+
+def synthetic_positions(rng: random.Random, count: int) -> List[Tuple[str, str, int]]:
+    """(FEN, legal UCI move, ply) triples reached by random play."""
+    import chess
+
+    positions = []
+    while len(positions) < count:
+        board = chess.Board()
+        for ply in range(rng.randint(8, 90)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+            if ply >= 4 and rng.random() < 0.2:
+                moves = list(board.legal_moves)
+                if moves:
+                    positions.append((board.fen(), rng.choice(moves).uci(), ply))
+    return positions[:count]
+
+
+def generate_synthetic_puzzles(output_file: str, num_rows: int, seed: int = 0):
+    """Write a lichess_db_puzzle.csv-shaped file of num_rows synthetic puzzles.
+
+    Positions are real, with a legal first move, and ratings, popularity,
+    play counts, themes and opening tags follow roughly the distributions of
+    the Lichess database, so the filters keep a realistic share of rows.
+    The same seed always writes the same file.
+    """
+    rng = random.Random(seed)
+    positions = synthetic_positions(rng, min(POSITION_POOL_SIZE, max(num_rows, 1)))
+    families = list(OPENING_FAMILIES)
+    id_chars = string.ascii_letters + string.digits
+
+    with open(output_file, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(LICHESS_FIELDS)
+        for i in range(num_rows):
+            fen, first_move, ply = positions[rng.randrange(len(positions))]
+            phase = "opening" if ply < 20 else "middlegame" if ply < 60 else "endgame"
+            themes = {phase, rng.choice(LENGTH_THEMES)}
+            themes.update(rng.sample(MOTIF_THEMES, rng.randint(1, 3)))
+
+            opening_tags = ""
+            if phase == "opening" or rng.random() < 0.3:
+                family = rng.choice(families)
+                opening_tags = (
+                    f"{family} {family}_{rng.choice(OPENING_FAMILIES[family])}"
+                )
+
+            puzzle_id = "".join(rng.choice(id_chars) for _ in range(5))
+            writer.writerow(
+                [
+                    f"{puzzle_id}{i:x}",
+                    fen,
+                    f"{first_move} e2e4 e7e5",
+                    min(3300, max(400, int(rng.gauss(1500, 500)))),
+                    max(50, int(rng.gauss(78, 10))),
+                    min(100, max(-100, int(100 - rng.expovariate(1 / 12)))),
+                    int(rng.lognormvariate(6.5, 1.8)) + 1,
+                    " ".join(sorted(themes)),
+                    f"https://lichess.org/{puzzle_id}abc#{ply}",
+                    opening_tags,
+                ]
+            )
+
+
+def time_stage(action: Callable[[], object], rows: Optional[int] = None) -> Dict:
+    start = time.perf_counter()
+    action()
+    seconds = time.perf_counter() - start
+    result = {"seconds": round(seconds, 4)}
+    if rows is not None:
+        result["rows"] = rows
+        result["rows_per_second"] = round(rows / seconds, 1) if seconds else None
+    # ru_maxrss is the process's peak so far, not this stage's own.
+    result["cumulative_peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def time_calls(action: Callable[[int], object], calls: int) -> Dict:
+    """Latency percentiles over `calls` calls of action(i)."""
+    latencies = np.empty(calls)
+    start = time.perf_counter()
+    for i in range(calls):
+        call_start = time.perf_counter()
+        action(i)
+        latencies[i] = time.perf_counter() - call_start
+    seconds = time.perf_counter() - start
+    return {
+        "calls": calls,
+        "seconds": round(seconds, 4),
+        "calls_per_second": round(calls / seconds, 1),
+        "p50_us": round(float(np.percentile(latencies, 50)) * 1e6, 2),
+        "p99_us": round(float(np.percentile(latencies, 99)) * 1e6, 2),
+        "cumulative_peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    num_rows: int,
+    work_dir: str,
+    num_workers: int = 1,
+    calls: int = LATENCY_CALLS,
+    seed: int = 0,
+) -> Dict:
+    """Run every pipeline stage against synthetic data in work_dir.
+
+    The stages run in order, each on the previous stage's output, from
+    filtering the raw CSV to exporting a static pack. Puzzle files are read
+    through the same relative paths the scripts use, so work_dir becomes the
+    working directory for the run.
+    """
+    from generate_puzzles import (
+        PUZZLES_RANDOM,
+        PuzzleGenerator,
+        pawns_only_fen,
+        target_puzzles_by_rating,
+    )
+    from generate_static_puzzles import export_puzzles_to_csv
+    from puzzle_index import pawn_structure_key
+
+    report = {
+        "version": BENCHMARK_VERSION,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "rows": num_rows,
+        "workers": num_workers,
+        "seed": seed,
+        "stages": {},
+    }
+    stages = report["stages"]
+    rng = random.Random(seed)
+
+    previous_dir = os.getcwd()
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    try:
+        stages["generate_synthetic_data"] = time_stage(
+            lambda: generate_synthetic_puzzles(PUZZLE_INPUT_FILE, num_rows, seed),
+            num_rows,
+        )
+        stages["filter_puzzles"] = time_stage(
+            lambda: filter_puzzles(PUZZLE_INPUT_FILE, PUZZLE_OUTPUT_DIR, num_workers),
+            num_rows,
+        )
+
+        puzzle_generator = None
+
+        def construct():
+            nonlocal puzzle_generator
+            puzzle_generator = PuzzleGenerator()
+            for puzzle_pack_name in puzzle_generator.puzzle_mapping:
+                puzzle_generator.get_rating_index(puzzle_pack_name)
+
+        stages["puzzle_generator_construction"] = time_stage(construct)
+        random_pack = puzzle_generator.puzzle_mapping[PUZZLES_RANDOM]
+        report["random_pack_puzzles"] = len(random_pack)
+
+        ratings = [rng.randint(600, 2400) for _ in range(calls)]
+        stages["target_puzzles_by_rating"] = time_calls(
+            lambda i: target_puzzles_by_rating(random_pack, ratings[i]), calls
+        )
+        stages["generate_puzzle_fen_strings"] = time_calls(
+            lambda i: puzzle_generator.generate_puzzle_fen_strings(
+                PUZZLES_RANDOM, ratings[i], "", ""
+            ),
+            calls,
+        )
+
+        fens = [random_pack[rng.randrange(len(random_pack))].fen for _ in range(calls)]
+        stages["pawns_only_fen"] = time_calls(lambda i: pawns_only_fen(fens[i]), calls)
+        stages["pawn_structure_key"] = time_calls(
+            lambda i: pawn_structure_key(fens[i]), calls
+        )
+
+        stages["export_puzzles_to_csv"] = time_calls(
+            lambda i: export_puzzles_to_csv(
+                "static_puzzles", 100, PUZZLES_RANDOM, 800, 1600, puzzle_generator, i
+            ),
+            max(1, calls // 100),
+        )
+    finally:
+        os.chdir(previous_dir)
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def compare_reports(baseline: Dict, current: Dict) -> Dict[str, Dict[str, float]]:
+    """Ratio of current to baseline for every timing both reports share.
+
+    Ratios above 1 are slower (or larger, for memory) than the baseline.
+    """
+    keys = ["seconds", "p50_us", "p99_us", "cumulative_peak_rss_mb"]
+    ratios = {}
+    for stage, measured in current["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before is None:
+            continue
+        ratios[stage] = {
+            key: round(measured[key] / before[key], 3)
+            for key in keys
+            if measured.get(key) and before.get(key)
+        }
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the puzzle pipeline.")
+    parser.add_argument(
+        "command",
+        type=str,
+        help="Command to run. Options: run, generate, compare",
+    )
+    parser.add_argument(
+        "--size",
+        type=str,
+        default="10k",
+        help=f"Synthetic database size: {', '.join(SYNTHETIC_SIZES)} or a row count",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic data")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes for filtering",
+    )
+    parser.add_argument(
+        "--calls",
+        type=int,
+        default=LATENCY_CALLS,
+        help="Calls per latency benchmark",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default=None,
+        help="Directory for synthetic data and outputs (a temporary one if unset)",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Write the JSON report to this file"
+    )
+    parser.add_argument(
+        "reports", nargs="*", help="For compare: baseline and current JSON reports"
+    )
+    args = parser.parse_args()
+    num_rows = SYNTHETIC_SIZES.get(args.size.lower()) or int(args.size)
+
+    if args.command == "generate":
+        output_file = args.output or PUZZLE_INPUT_FILE
+        generate_synthetic_puzzles(output_file, num_rows, args.seed)
+        print(f"Wrote {num_rows} synthetic puzzles to {output_file}")
+
+    elif args.command == "run":
+        # Keep the pipeline's own progress output out of the JSON report.
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.work_dir:
+                report = run_benchmarks(
+                    num_rows, args.work_dir, args.workers, args.calls, args.seed
+                )
+            else:
+                with tempfile.TemporaryDirectory() as work_dir:
+                    report = run_benchmarks(
+                        num_rows, work_dir, args.workers, args.calls, args.seed
+                    )
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+        print(output)
+
+    elif args.command == "compare":
+        if len(args.reports) != 2:
+            parser.error("compare takes a baseline and a current report")
+        with open(args.reports[0]) as f:
+            baseline = json.load(f)
+        with open(args.reports[1]) as f:
+            current = json.load(f)
+        print(json.dumps(compare_reports(baseline, current), indent=2))
+
+    else:
+        parser.error(f"Unknown command {args.command}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import chess
+
+import instrumentation
+
+DEFAULT_CACHE_DIR = "board_images"
+# Bump when the same settings would render a different image.
+RENDER_VERSION = 1
+# 8 squares of 32px: a 256px thumbnail.
+DEFAULT_SQUARE_SIZE = 32
+SPRITE_COLUMNS = 10
+PGN_FEN_TAG = re.compile(r'^\[FEN "([^"]+)"\]', re.MULTILINE)
+
+
+@dataclass(frozen=True)
+class RenderSettings:
+    """Everything besides the position that changes a rendered board."""
+
+    square_size: int = DEFAULT_SQUARE_SIZE
+    coordinates: bool = True
+    image_format: str = "png"
+
+    def key(self) -> str:
+        """Short hash naming the cache directory for these settings."""
+        settings = json.dumps(
+            {"version": RENDER_VERSION, **asdict(self)}, sort_keys=True
+        )
+        return hashlib.sha256(settings.encode()).hexdigest()[:12]
+
+
+def board_key(fen: str) -> str:
+    """Cache key of the image of a FEN.
+
+    Only the piece placement is drawn, so positions differing in side to
+    move, castling rights or move counters share one image.
+    """
+    return hashlib.sha256(fen.split(" ", 1)[0].encode()).hexdigest()[:32]
+
+
+def image_path(cache_dir: str, settings: RenderSettings, fen: str) -> str:
+    key = board_key(fen)
+    return os.path.join(
+        cache_dir, settings.key(), key[:2], f"{key}.{settings.image_format}"
+    )
+
+
+def read_pack_fens(pack_file: str) -> List[str]:
+    """The FENs of a pack, in pack order.
+
+    Reads PGN packs ([FEN] tags), JSON packs from generate_static_puzzles.py,
+    and CSVs with a fen column (static packs) or FEN column (puzzle sets).
+    """
+    with open(pack_file, "r", newline="") as f:
+        if pack_file.endswith(".pgn"):
+            return PGN_FEN_TAG.findall(f.read())
+        if pack_file.endswith(".json"):
+            pack = json.load(f)
+            if "fields" not in pack or "fen" not in pack["fields"]:
+                raise ValueError(f"{pack_file} is not a puzzle pack")
+            fen_index = pack["fields"].index("fen")
+            return [puzzle[fen_index] for puzzle in pack["puzzles"]]
+        reader = csv.DictReader(f)
+        column = "fen" if "fen" in (reader.fieldnames or []) else "FEN"
+        return [row[column] for row in reader]
+
+
+_renderers: Dict[RenderSettings, object] = {}
+
+
+def _renderer(settings: RenderSettings):
+    """One BoardImage per process and settings, so its font and piece
+    images are loaded once rather than for every board."""
+    renderer = _renderers.get(settings)
+    if renderer is None:
+        # Imported here so reading packs and cache lookups need no Pillow.
+        from fentoimage.board import BoardImage
+        from fentoimage.config import Config, SquareConfig, TextConfig
+
+        # fentoimage's defaults suit 128px squares; scale the labels.
+        scale = settings.square_size / 128
+        config = Config(
+            square=SquareConfig(),
+            text=TextConfig(
+                enabled=settings.coordinates,
+                font_size=max(6, round(24 * scale)),
+                padding=max(1, round(8 * scale)),
+            ),
+        )
+        renderer = _renderers[settings] = BoardImage(
+            chess.STARTING_FEN, config=config, square_size=settings.square_size
+        )
+    return renderer
+
+
+def _render_board(task: Tuple[str, RenderSettings, str]) -> str:
+    fen, settings, path = task
+    renderer = _renderer(settings)
+    renderer.board = chess.Board(fen)
+    image = renderer.render()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    image.save(tmp_path, format=settings.image_format.upper())
+    os.replace(tmp_path, path)
+    return path
+
+
+def render_fens(
+    fens: Sequence[str],
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    settings: RenderSettings = RenderSettings(),
+    num_workers: int = 1,
+) -> Dict[str, str]:
+    """Image paths of the given FENs, rendering only those not yet cached.
+
+    Identical positions are rendered once. Returns the path for each FEN.
+    """
+    paths = {fen: image_path(cache_dir, settings, fen) for fen in fens}
+    # Image path -> one FEN to render it from.
+    missing: Dict[str, str] = {}
+    for fen, path in paths.items():
+        if path in missing or os.path.exists(path):
+            instrumentation.cache_hit("board_image")
+        else:
+            instrumentation.cache_miss("board_image")
+            missing[path] = fen
+
+    with instrumentation.stage("render_boards") as recorder:
+        tasks = [(fen, settings, path) for path, fen in missing.items()]
+        if num_workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                list(executor.map(_render_board, tasks, chunksize=16))
+        else:
+            for task in tasks:
+                _render_board(task)
+        recorder.add(rows=len(tasks))
+    cached = len(set(paths.values())) - len(missing)
+    print(f"Rendered {len(missing)} boards, {cached} cached")
+    return paths
+
+
+def write_sprite_sheet(
+    fens: Sequence[str],
+    paths: Dict[str, str],
+    output_file: str,
+    settings: RenderSettings = RenderSettings(),
+    columns: int = SPRITE_COLUMNS,
+) -> bool:
+    """Pack a pack's board images into one image, in pack order.
+
+    Next to it, <output_file stem>.json gives the tile size, column count
+    and the tile index of every FEN. Returns False, writing nothing, when
+    the existing sheet already has the same tiles.
+    """
+    from PIL import Image
+
+    keys = [board_key(fen) for fen in fens]
+    tile_indexes = {key: i for i, key in enumerate(dict.fromkeys(keys))}
+    tiles = list(tile_indexes)
+    tile_size = settings.square_size * 8
+    index_file = os.path.splitext(output_file)[0] + ".json"
+    index = {
+        "tile_size": tile_size,
+        "columns": columns,
+        "settings": settings.key(),
+        "tiles": tiles,
+        "fens": [tile_indexes[key] for key in keys],
+    }
+    if os.path.exists(output_file) and os.path.exists(index_file):
+        with open(index_file) as f:
+            if json.load(f) == index:
+                return False
+
+    rows = (len(tiles) + columns - 1) // columns
+    sheet = Image.new("RGB", (tile_size * min(columns, len(tiles)), tile_size * rows))
+    path_by_key = {board_key(fen): paths[fen] for fen in fens}
+    for i, key in enumerate(tiles):
+        with Image.open(path_by_key[key]) as tile:
+            sheet.paste(tile, ((i % columns) * tile_size, (i // columns) * tile_size))
+
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    sheet.save(output_file)
+    with open(index_file, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    return True
+
+
+def render_packs(
+    pack_files: Sequence[str],
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    settings: RenderSettings = RenderSettings(),
+    num_workers: int = 1,
+    sprite_dir: Optional[str] = None,
+) -> Dict[str, List[str]]:
+    """Render every board of every pack in one batch.
+
+    Positions shared between packs are rendered once, and positions already
+    in the cache are not rendered at all. With sprite_dir, each pack also
+    gets a sprite sheet there. Returns each pack's image paths in pack order.
+    """
+    fens_by_pack = {pack_file: read_pack_fens(pack_file) for pack_file in pack_files}
+    all_fens = list(
+        dict.fromkeys(fen for fens in fens_by_pack.values() for fen in fens)
+    )
+    paths = render_fens(all_fens, cache_dir, settings, num_workers)
+
+    if sprite_dir is not None:
+        for pack_file, fens in fens_by_pack.items():
+            if not fens:
+                continue
+            stem = os.path.splitext(os.path.basename(pack_file))[0]
+            sprite_file = os.path.join(
+                sprite_dir, f"{stem}.sprite.{settings.image_format}"
+            )
+            if write_sprite_sheet(fens, paths, sprite_file, settings):
+                print(f"Saved {sprite_file}")
+    return {
+        pack_file: [paths[fen] for fen in fens]
+        for pack_file, fens in fens_by_pack.items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render board thumbnails for puzzle packs."
+    )
+    parser.add_argument(
+        "packs", nargs="+", help="Pack files: .pgn, .json or .csv with FENs"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help="Directory of rendered boards, reused across runs",
+    )
+    parser.add_argument(
+        "--square-size",
+        type=int,
+        default=DEFAULT_SQUARE_SIZE,
+        help="Square size in pixels (the board is 8 squares wide)",
+    )
+    parser.add_argument(
+        "--no-coordinates",
+        action="store_true",
+        help="Leave out the file and rank labels",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of rendering processes",
+    )
+    parser.add_argument(
+        "--sprite-dir",
+        type=str,
+        default=None,
+        help="Also write one sprite sheet per pack to this directory",
+    )
+    args = parser.parse_args()
+
+    render_packs(
+        args.packs,
+        args.cache_dir,
+        RenderSettings(args.square_size, not args.no_coordinates),
+        args.workers,
+        args.sprite_dir,
+    )
+    instrumentation.get_instrumentation().finish()
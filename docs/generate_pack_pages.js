@@ -4,22 +4,41 @@ const path = require('path');
 const packs = [
     {
         name: 'Random Tactics',
-        file: 'puzzles_Random_n50_elo800-1600.csv'
+        file: 'puzzles_Random_n50_elo800-1600.json'
     },
     {
         name: 'Opening Tactics',
-        file: 'puzzles_Opening_n50_elo800-1600.csv'
+        file: 'puzzles_Opening_n50_elo800-1600.json'
     },
     {
         name: 'Middlegame Tactics',
-        file: 'puzzles_Middlegame_n50_elo800-1600.csv'
+        file: 'puzzles_Middlegame_n50_elo800-1600.json'
     },
     {
         name: 'Endgame Tactics',
-        file: 'puzzles_Endgame_n50_elo800-1600.csv'
+        file: 'puzzles_Endgame_n50_elo800-1600.json'
     }
 ];
 
+// A pack's file may also be the index.json of a sharded pack directory,
+// e.g. { name: 'Endless Tactics', file: 'puzzles_Random_n20000_elo600-2600/index.json',
+// page: 'endless' }
+
+// Content-hashed packs are listed in pack_index.json under their plain name
+const staticDir = path.join(__dirname, 'static_puzzles');
+const packIndexFile = path.join(staticDir, 'pack_index.json');
+const packIndex = fs.existsSync(packIndexFile)
+    ? JSON.parse(fs.readFileSync(packIndexFile, 'utf8'))
+    : {};
+
+function resolvePackFile(file) {
+    const resolved = packIndex[file] || file;
+    if (!fs.existsSync(path.join(staticDir, resolved))) {
+        throw new Error(`Missing pack static_puzzles/${resolved}`);
+    }
+    return resolved;
+}
+
 // Read the template
 const template = fs.readFileSync(path.join(__dirname, 'pack_template.html'), 'utf8');
 
@@ -31,10 +50,10 @@ if (!fs.existsSync(packsDir)) {
 
 // Generate a file for each pack
 packs.forEach(pack => {
-    const fileName = pack.file.split('_')[1].toLowerCase() + '.html';
+    const fileName = (pack.page || pack.file.split('_')[1].toLowerCase()) + '.html';
     const content = template
         .replace(/{PACK_NAME}/g, pack.name)
-        .replace(/{PUZZLE_FILE}/g, pack.file);
+        .replace(/{PUZZLE_FILE}/g, resolvePackFile(pack.file));
     
     fs.writeFileSync(path.join(packsDir, fileName), content);
     console.log(`Generated packs/${fileName}`);
@@ -1,7 +1,8 @@
 import { Chessground } from 'https://cdn.jsdelivr.net/npm/@lichess-org/chessground/+esm';
 import { Chess } from 'https://cdn.jsdelivr.net/npm/chess.js@1.0.0/+esm';
 
-let puzzles = [];
+// A pack is { count, get(index) -> Promise<puzzle>, indexForElo(elo) -> Promise<index> }
+let pack = null;
 let currentPuzzleIndex = 0;
 let ground = null;
 let chess = null;
@@ -110,26 +111,147 @@ function resetPosition() {
     }
 }
 
+async function fetchPack(file) {
+    const response = await fetch(`../static_puzzles/${file}`);
+    if (!response.ok) {
+        throw new Error(`Failed to load ${file}: ${response.status}`);
+    }
+    // Precompressed packs served as plain files are decompressed here
+    if (file.endsWith('.gz')) {
+        const stream = response.body.pipeThrough(new DecompressionStream('gzip'));
+        return new Response(stream).text();
+    }
+    return response.text();
+}
+
+function parseCsvLine(line) {
+    const values = [];
+    let value = '';
+    let quoted = false;
+    for (let i = 0; i < line.length; i++) {
+        const char = line[i];
+        if (quoted) {
+            if (char === '"' && line[i + 1] === '"') {
+                value += '"';
+                i++;
+            } else if (char === '"') {
+                quoted = false;
+            } else {
+                value += char;
+            }
+        } else if (char === '"') {
+            quoted = true;
+        } else if (char === ',') {
+            values.push(value);
+            value = '';
+        } else {
+            value += char;
+        }
+    }
+    values.push(value);
+    return values;
+}
+
+function parseCsvPack(text) {
+    const lines = text.split(/\r?\n/).filter(line => line.trim());
+    const headers = parseCsvLine(lines[0]).map(header => header.trim());
+
+    return lines.slice(1).map(line => {
+        const values = parseCsvLine(line);
+        const puzzle = {};
+        headers.forEach((header, index) => {
+            puzzle[header] = values[index]?.trim();
+        });
+        return puzzle;
+    });
+}
+
+function parseJsonPack(text) {
+    // {"fields": ["fen", "elo", "defensive"], "puzzles": [[...], ...]}
+    const pack = JSON.parse(text);
+    return pack.puzzles.map(values => {
+        const puzzle = {};
+        pack.fields.forEach((field, index) => {
+            puzzle[field] = values[index];
+        });
+        puzzle.type = puzzle.defensive ? 'defensive' : 'offensive';
+        return puzzle;
+    });
+}
+
+function firstIndexForElo(puzzles, elo) {
+    const index = puzzles.findIndex(puzzle => Number(puzzle.elo) >= elo);
+    return index === -1 ? puzzles.length - 1 : index;
+}
+
+function arrayPack(puzzles) {
+    return {
+        count: puzzles.length,
+        get: async index => puzzles[index],
+        indexForElo: async elo => firstIndexForElo(puzzles, elo),
+    };
+}
+
+// Number of shards kept in memory on either side of the current one
+const SHARD_WINDOW = 1;
+
+async function shardedPack(indexFile) {
+    const base = indexFile.slice(0, indexFile.lastIndexOf('/') + 1);
+    const index = JSON.parse(await fetchPack(indexFile));
+    const shards = new Map();
+
+    function loadShard(shard) {
+        if (shard < 0 || shard >= index.shards.length) return null;
+        if (!shards.has(shard)) {
+            const loading = fetchPack(base + index.shards[shard].file).then(parseJsonPack);
+            // Forget failed loads so the next visit retries them
+            loading.catch(() => shards.delete(shard));
+            shards.set(shard, loading);
+        }
+        return shards.get(shard);
+    }
+
+    return {
+        count: index.count,
+        async get(puzzleIndex) {
+            const shard = Math.floor(puzzleIndex / index.shard_size);
+            for (const loaded of shards.keys()) {
+                if (Math.abs(loaded - shard) > SHARD_WINDOW) shards.delete(loaded);
+            }
+            const puzzles = await loadShard(shard);
+            // Prefetch the next shard while this one is being played
+            loadShard(shard + 1)?.catch(() => {});
+            return puzzles[puzzleIndex - shard * index.shard_size];
+        },
+        async indexForElo(elo) {
+            // Shards are in ELO order, so only the first one reaching elo is loaded
+            const shard = index.shards.findIndex(entry => entry.max_elo >= elo);
+            if (shard === -1) return index.count - 1;
+            const puzzles = await loadShard(shard);
+            return shard * index.shard_size + firstIndexForElo(puzzles, elo);
+        },
+    };
+}
+
+async function loadPack(file) {
+    if (file.endsWith('/index.json')) {
+        return shardedPack(file);
+    }
+    const text = await fetchPack(file);
+    return arrayPack(/\.json(\.gz)?$/.test(file) ? parseJsonPack(text) : parseCsvPack(text));
+}
+
 async function loadPuzzles() {
     try {
-        const response = await fetch(`../static_puzzles/${PUZZLE_PACK}`);
-        const csvText = await response.text();
-
-        const lines = csvText.split('\n');
-        const headers = lines[0].split(',');
-
-        puzzles = lines.slice(1).filter(line => line.trim()).map(line => {
-            const values = line.split(',');
-            const puzzle = {};
-            headers.forEach((header, index) => {
-                puzzle[header.trim()] = values[index]?.trim();
-            });
-            return puzzle;
-        });
+        pack = await loadPack(PUZZLE_PACK);
 
+        // ?elo=1500 starts at the first puzzle of that rating
+        const elo = new URLSearchParams(window.location.search).get('elo');
         const savedIndex = localStorage.getItem(storageKey);
-        if (savedIndex !== null) {
-            currentPuzzleIndex = parseInt(savedIndex);
+        if (elo !== null) {
+            currentPuzzleIndex = await pack.indexForElo(parseInt(elo));
+        } else if (savedIndex !== null) {
+            currentPuzzleIndex = Math.min(parseInt(savedIndex), pack.count - 1);
         }
 
         showPuzzle();
@@ -139,27 +261,34 @@ async function loadPuzzles() {
     }
 }
 
-function showPuzzle() {
-    if (puzzles.length === 0) return;
-
-    const puzzle = puzzles[currentPuzzleIndex];
-    if (puzzle.fen) {
-        setupBoard(puzzle.fen);
-    }
+async function showPuzzle() {
+    if (!pack || pack.count === 0) return;
 
+    const index = currentPuzzleIndex;
     document.getElementById('puzzle-counter').textContent =
-        `${currentPuzzleIndex + 1} of ${puzzles.length}`;
+        `${index + 1} of ${pack.count}`;
+    localStorage.setItem(storageKey, index);
 
-    localStorage.setItem(storageKey, currentPuzzleIndex);
+    let puzzle;
+    try {
+        puzzle = await pack.get(index);
+    } catch (error) {
+        console.error('Error loading puzzle:', error);
+        return;
+    }
+    // Skip puzzles the user has already moved past while loading
+    if (index === currentPuzzleIndex && puzzle.fen) {
+        setupBoard(puzzle.fen);
+    }
 }
 
 function updateControls() {
     document.getElementById('prevButton').disabled = currentPuzzleIndex === 0;
-    document.getElementById('nextButton').disabled = currentPuzzleIndex === puzzles.length - 1;
+    document.getElementById('nextButton').disabled = !pack || currentPuzzleIndex === pack.count - 1;
 }
 
 function nextPuzzle() {
-    if (currentPuzzleIndex < puzzles.length - 1) {
+    if (pack && currentPuzzleIndex < pack.count - 1) {
         currentPuzzleIndex++;
         showPuzzle();
         updateControls();
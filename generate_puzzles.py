@@ -1,10 +1,19 @@
-import csv
 import random
 import io
-import chess.pgn
+import threading
+from collections.abc import Mapping
+import numpy as np
+import instrumentation
 from process_puzzles import Puzzle
-from typing import Dict, List, Tuple
-import lichess
+from puzzle_index import (
+    OpeningIndex,
+    get_opening_index,
+    get_structure_index,
+    get_tag_index,
+    pawn_structure_key_from_bitboards,
+)
+from puzzle_store import PuzzleChain, PuzzleSubset, load_puzzles, puzzle_ratings
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
 
 PUZZLES_OPENING = "Opening"
@@ -19,107 +28,129 @@ PUZZLE_FILES = {
     PUZZLES_MIDDLEGAME: "puzzles/middlegame.csv",
     PUZZLES_ENDGAME: "puzzles/endgame.csv",
 }
+OPENING_TAG_FILE = "puzzles/opening_tag.csv"
+ALL_PUZZLES_FILE = "puzzles/all.csv"
 
 NUM_OPENINGS = 256
 MIN_PUZZLES_FOR_STRUCTURE = 5
+# Puzzles are drawn from within RATING_WINDOW of the target rating, or from
+# the nearest RATING_SAMPLE_SIZE when the window holds fewer.
+RATING_WINDOW = 100
 RATING_SAMPLE_SIZE = 1000
 
 LICHESS_USERNAME = "trisolaran3"
 LICHESS_LAST_N_GAMES = 10
 
 
-def coin_flip() -> bool:
-    return random.random() > 0.5
+def coin_flip(rng: Optional[random.Random] = None) -> bool:
+    return (rng or random).random() > 0.5
 
 
-class PuzzleGenerator:
-    def __init__(self):
-        self.puzzle_mapping = self.load_puzzles()
-        # self.opening_puzzles_by_name = self.load_opening_puzzles_by_name()
-        # self.opening_puzzles_by_structure = self.load_opening_puzzles_by_structure()
-
-    def load_puzzles(self) -> Dict[str, List[Puzzle]]:
-        puzzle_mapping: Dict[str, List[Puzzle]] = {
-            PUZZLES_OPENING: [],
-            PUZZLES_MIDDLEGAME: [],
-            PUZZLES_ENDGAME: [],
-            PUZZLES_RANDOM: [],
-        }
-        for name, file_name in PUZZLE_FILES.items():
-            with open(file_name, "r") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    puzzle = Puzzle.from_dict(row)
-                    puzzle_mapping[name].append(puzzle)
-
-        puzzle_mapping[PUZZLES_RANDOM] = (
-            puzzle_mapping[PUZZLES_OPENING]
-            + puzzle_mapping[PUZZLES_MIDDLEGAME]
-            + puzzle_mapping[PUZZLES_ENDGAME]
-        )
+class PuzzlePacks(Mapping):
+    """Puzzle packs by name, each loaded from disk on first use.
 
-        return puzzle_mapping
-
-    def load_opening_puzzles_by_name(self) -> Dict[str, List[Puzzle]]:
-        opening_puzzles_by_name: Dict[str, List[Puzzle]] = {}
-        with open("puzzles/opening_tag.csv", "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                puzzle = Puzzle.from_dict(row)
-                for tag in puzzle.opening_tags.split(" "):
-                    if not tag.strip():
-                        continue
-                    display_tag = convert_to_display(tag)
-                    opening_puzzles_by_name.setdefault(display_tag, []).append(puzzle)
-
-        # Filter to the top NUM_OPENINGS openings.
-        opening_puzzles_by_name = {
-            k: v
-            for k, v in sorted(
-                opening_puzzles_by_name.items(), key=lambda x: len(x[1]), reverse=True
-            )[:NUM_OPENINGS]
-        }
+    The Random pack is a chain over the other packs rather than a copy.
+    """
 
-        # Sort the openings by name.
-        opening_puzzles_by_name = {
-            k: v
-            for k, v in sorted(
-                opening_puzzles_by_name.items(), key=lambda x: x[0], reverse=False
-            )
-        }
+    def __init__(self, puzzle_files: Dict[str, str] = PUZZLE_FILES):
+        self.puzzle_files = puzzle_files
+        self.packs: Dict[str, Sequence[Puzzle]] = {}
+        self.lock = threading.RLock()
 
-        return opening_puzzles_by_name
+    def __getitem__(self, name: str) -> Sequence[Puzzle]:
+        pack = self.packs.get(name)
+        if pack is None:
+            with self.lock:
+                pack = self.packs.get(name)
+                if pack is None:
+                    pack = self.packs[name] = self.load_pack(name)
+        return pack
 
-    def load_opening_puzzles_by_structure(self) -> Dict[str, List[Puzzle]]:
-        opening_puzzles_by_structure: Dict[str, List[Puzzle]] = {}
-        with open("puzzles/opening_tag.csv", "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                puzzle = Puzzle.from_dict(row)
-                structure1 = pawns_only_fen(puzzle.fen)
-                opening_puzzles_by_structure.setdefault(structure1, []).append(puzzle)
+    def __contains__(self, name) -> bool:
+        return name in self.puzzle_files or name == PUZZLES_RANDOM
 
-                structure2 = pawns_only_fen(
-                    puzzle.generate_puzzle_position(defensive=False)
-                )
+    def __iter__(self) -> Iterator[str]:
+        yield from self.puzzle_files
+        yield PUZZLES_RANDOM
 
-                if structure1 == structure2:
-                    continue
+    def __len__(self) -> int:
+        return len(self.puzzle_files) + 1
 
-                opening_puzzles_by_structure.setdefault(structure2, []).append(puzzle)
+    def source_files(self, name: str) -> List[str]:
+        """The filtered puzzle files a pack is loaded from."""
+        if name == PUZZLES_RANDOM:
+            return list(self.puzzle_files.values())
+        if name not in self.puzzle_files:
+            raise KeyError(name)
+        return [self.puzzle_files[name]]
 
-        # Filter to structures with minimum number of puzzles.
-        opening_puzzles_by_structure = {
-            k: v
-            for k, v in sorted(
-                opening_puzzles_by_structure.items(),
-                key=lambda x: len(x[1]),
-                reverse=True,
-            )
-            if len(v) > MIN_PUZZLES_FOR_STRUCTURE
+    def load_pack(self, name: str) -> Sequence[Puzzle]:
+        if name == PUZZLES_RANDOM:
+            return PuzzleChain([self[pack_name] for pack_name in self.puzzle_files])
+        if name not in self.puzzle_files:
+            raise KeyError(name)
+        with instrumentation.stage(f"load_pack:{name}") as recorder:
+            pack = load_puzzles(self.puzzle_files[name])
+            recorder.add(rows=len(pack))
+        return pack
+
+
+class PuzzleGenerator:
+    def __init__(self):
+        self.puzzle_mapping = PuzzlePacks()
+        self.rating_indexes: Dict[str, "RatingIndex"] = {}
+        self.lock = threading.Lock()
+        self.opening_rating_indexes: Dict[str, "RatingIndex"] = {}
+        self.opening_rating_indexes_source: Optional[OpeningIndex] = None
+
+    def get_rating_index(self, puzzle_pack_name: str) -> "RatingIndex":
+        index = self.rating_indexes.get(puzzle_pack_name)
+        if index is None:
+            with self.lock:
+                index = self.rating_indexes.get(puzzle_pack_name)
+                if index is None:
+                    instrumentation.cache_miss("rating_index")
+                    puzzles = self.puzzle_mapping[puzzle_pack_name]
+                    with instrumentation.stage(f"rating_index:{puzzle_pack_name}") as recorder:
+                        index = RatingIndex(puzzles)
+                        recorder.add(rows=len(index))
+                    self.rating_indexes[puzzle_pack_name] = index
+                    return index
+        instrumentation.cache_hit("rating_index")
+        return index
+
+    def load_opening_puzzles_by_name(self) -> Dict[str, Sequence[Puzzle]]:
+        opening_index = get_opening_index(OPENING_TAG_FILE)
+        return {
+            convert_to_display(tag): opening_index.puzzles_for(tag)
+            for tag in sorted(opening_index.top_tags(NUM_OPENINGS))
         }
 
-        return opening_puzzles_by_structure
+    def get_opening_rating_index(self, opening_name: str) -> "RatingIndex":
+        opening_index = get_opening_index(OPENING_TAG_FILE)
+        with self.lock:
+            # Drop indexes built over an opening index that has since changed.
+            if self.opening_rating_indexes_source is not opening_index:
+                self.opening_rating_indexes = {}
+                self.opening_rating_indexes_source = opening_index
+            index = self.opening_rating_indexes.get(opening_name)
+            if index is None:
+                index = RatingIndex(
+                    opening_index.puzzles_for(convert_from_display(opening_name))
+                )
+                self.opening_rating_indexes[opening_name] = index
+        return index
+
+    def load_opening_puzzles_by_structure(self) -> Dict[int, Sequence[Puzzle]]:
+        structure_index = get_structure_index(
+            OPENING_TAG_FILE, MIN_PUZZLES_FOR_STRUCTURE
+        )
+        return {
+            structure: PuzzleSubset(
+                structure_index.puzzles, structure_index.positions_for(structure)
+            )
+            for structure in structure_index.structure_ids
+        }
 
     def get_puzzle_pack_names(self) -> List[str]:
         puzzle_packs = [
@@ -135,7 +166,10 @@ class PuzzleGenerator:
         return puzzle_packs
 
     def get_opening_names(self) -> List[str]:
-        return self.load_opening_puzzles_by_name().keys()
+        opening_index = get_opening_index(OPENING_TAG_FILE)
+        return sorted(
+            convert_to_display(tag) for tag in opening_index.top_tags(NUM_OPENINGS)
+        )
 
     def _get_puzzles_for_pack(
         self,
@@ -143,12 +177,12 @@ class PuzzleGenerator:
         target_rating: int,
         opening_name: str,
         username: str,
-    ) -> List[Puzzle]:
-        puzzles = []
+    ) -> Sequence[Puzzle]:
         if puzzle_pack_name in self.puzzle_mapping:
-            puzzles = self.puzzle_mapping[puzzle_pack_name]
+            return self.get_rating_index(puzzle_pack_name).candidates(target_rating)
         elif puzzle_pack_name == PUZZLES_OPENINGS_BY_NAME:
-            puzzles = self.opening_puzzles_by_name[opening_name]
+            index = self.get_opening_rating_index(opening_name)
+            return index.candidates(target_rating)
         elif puzzle_pack_name == PUZZLES_OPENINGS_BY_USER:
             puzzles = self.get_personalized_puzzles(username)
         else:
@@ -163,11 +197,12 @@ class PuzzleGenerator:
         opening_name: str,
         username: str,
     ) -> Tuple[str, str]:
-        puzzles = self._get_puzzles_for_pack(puzzle_pack_name, target_rating, opening_name, username)
-        puzzle = random.choice(puzzles)
-        is_defensive = coin_flip()
-        fen = puzzle.generate_puzzle_position(is_defensive)
-        return fen, convert_to_analysis_url(fen)
+        with instrumentation.stage("generate_puzzle_fen_string"):
+            puzzles = self._get_puzzles_for_pack(puzzle_pack_name, target_rating, opening_name, username)
+            puzzle = random.choice(puzzles)
+            is_defensive = coin_flip()
+            fen = puzzle.generate_puzzle_position(is_defensive)
+            return fen, convert_to_analysis_url(fen)
 
     def generate_puzzle_fen_strings(
         self,
@@ -176,54 +211,252 @@ class PuzzleGenerator:
         opening_name: str,
         username: str,
     ) -> Tuple[Tuple[str, str], Tuple[str, str]]:
-        puzzles = self._get_puzzles_for_pack(puzzle_pack_name, target_rating, opening_name, username)
-        puzzle = random.choice(puzzles)
-        offensive_fen = puzzle.generate_puzzle_position(False)
-        defensive_fen = puzzle.generate_puzzle_position(True)
+        with instrumentation.stage("generate_puzzle_fen_strings"):
+            puzzles = self._get_puzzles_for_pack(puzzle_pack_name, target_rating, opening_name, username)
+            puzzle = random.choice(puzzles)
+            offensive_fen = puzzle.generate_puzzle_position(False)
+            defensive_fen = puzzle.generate_puzzle_position(True)
         return (
             (offensive_fen, convert_to_analysis_url(offensive_fen)),
             (defensive_fen, convert_to_analysis_url(defensive_fen))
         )
 
-    def get_personalized_puzzles(self, username: str) -> List[Puzzle]:
-        structures = get_structure_sets_from_lichess(username, LICHESS_LAST_N_GAMES)
+    def select_puzzles(
+        self,
+        requests: List[Tuple[str, int]],
+        rng: Optional[random.Random] = None,
+    ) -> List[Puzzle]:
+        """Select one puzzle for each (puzzle pack, target rating) request.
+
+        Candidates are the same as for generate_puzzle_fen_string, but within
+        a pack no puzzle id is returned twice. If every candidate for a
+        request is already taken, the search widens to the nearest untaken
+        puzzles by rating. Raises ValueError if a pack runs out of puzzles.
+        """
+        with instrumentation.stage("select_puzzles") as recorder:
+            recorder.add(rows=len(requests))
+            return self._select_puzzles(requests, rng or random)
+
+    def select_puzzles_for_curve(
+        self,
+        puzzle_pack_name: str,
+        curve: Sequence[int],
+        rng: Optional[random.Random] = None,
+    ) -> List[Puzzle]:
+        """Select one puzzle per target rating of an ELO curve, in order,
+        with no puzzle id returned twice. See select_puzzles."""
+        return self.select_puzzles([(puzzle_pack_name, elo) for elo in curve], rng)
 
-        puzzles: List[Puzzle] = []
-        for structure in structures:
-            matching_puzzles = self.opening_puzzles_by_structure.get(structure)
-            if matching_puzzles:
-                puzzles.extend(matching_puzzles)
+    def _select_puzzles(
+        self, requests: List[Tuple[str, int]], rng: random.Random
+    ) -> List[Puzzle]:
+        requests_by_pack: Dict[str, List[int]] = {}
+        for i, (puzzle_pack_name, _) in enumerate(requests):
+            if puzzle_pack_name not in self.puzzle_mapping:
+                raise ValueError("Invalid puzzle pack name")
+            requests_by_pack.setdefault(puzzle_pack_name, []).append(i)
+
+        selections: List[Optional[Puzzle]] = [None] * len(requests)
+        for puzzle_pack_name, request_indexes in requests_by_pack.items():
+            index = self.get_rating_index(puzzle_pack_name)
+            taken = np.zeros(len(index), dtype=bool)
+            taken_ids: Set[str] = set()
+            targets = np.array([requests[i][1] for i in request_indexes])
+            los, his = index.window_bounds(
+                targets - RATING_WINDOW, targets + RATING_WINDOW
+            )
+            # Requests whose windows cover the same puzzles are served by one
+            # draw from the window's untaken puzzles. Windows too small to
+            # draw from fall back to the puzzles nearest the target, so those
+            # requests are grouped by target too.
+            by_window: Dict[Tuple[int, int, Optional[int]], List[int]] = {}
+            for i, lo, hi in zip(request_indexes, los.tolist(), his.tolist()):
+                target = requests[i][1] if hi - lo < RATING_SAMPLE_SIZE else None
+                by_window.setdefault((lo, hi, target), []).append(i)
+            for (lo, hi, _), window_indexes in by_window.items():
+                target_rating = requests[window_indexes[0]][1]
+                if hi - lo >= RATING_SAMPLE_SIZE:
+                    positions = index.order[lo:hi]
+                else:
+                    positions = index.nearest(target_rating, RATING_SAMPLE_SIZE)
+                puzzles = _select_untaken(
+                    index,
+                    target_rating,
+                    positions,
+                    len(window_indexes),
+                    taken,
+                    taken_ids,
+                    rng,
+                )
+                for i, puzzle in zip(window_indexes, puzzles):
+                    selections[i] = puzzle
+        return selections
 
+    def query_puzzles(
+        self,
+        query: str,
+        min_rating: Optional[int] = None,
+        max_rating: Optional[int] = None,
+        puzzle_file: str = ALL_PUZZLES_FILE,
+    ) -> Sequence[Puzzle]:
+        """Puzzles matching a boolean tag query, e.g. "fork AND endgame AND
+        NOT long", within an optional rating range. See TagIndex for the
+        query syntax. Results are in pack order. The default puzzle_file is
+        written by `process_puzzles.py filter --all-puzzles`."""
+        with instrumentation.stage("query_puzzles") as recorder:
+            puzzles = get_tag_index(puzzle_file).puzzles_matching(
+                query, min_rating, max_rating
+            )
+            recorder.add(rows=len(puzzles))
         return puzzles
 
+    def get_personalized_puzzles(self, username: str) -> Sequence[Puzzle]:
+        structures = get_structure_sets_from_lichess(username, LICHESS_LAST_N_GAMES)
+        structure_index = get_structure_index(
+            OPENING_TAG_FILE, MIN_PUZZLES_FOR_STRUCTURE
+        )
+        return structure_index.puzzles_matching(structures)
+
 
 def convert_to_display(opening: str) -> str:
     return " ".join([word.capitalize() for word in opening.split("_")])
 
 
+def convert_from_display(opening: str) -> str:
+    return opening.lower().replace(" ", "_")
+
+
 def convert_to_analysis_url(fen: str) -> str:
     normalized_fen = fen.replace(" ", "_")
     return f"https://lichess.org/analysis/{normalized_fen}"
 
 
-def target_puzzles_by_rating(puzzles: List[Puzzle], target_rating: int):
-    min_rating = target_rating - 100
-    max_rating = target_rating + 100
-    filtered_puzzles = [
-        puzzle
-        for puzzle in puzzles
-        if puzzle.rating >= min_rating and puzzle.rating <= max_rating
-    ]
-
-    if len(filtered_puzzles) >= RATING_SAMPLE_SIZE:
-        return filtered_puzzles
-
-    return sorted(puzzles, key=lambda x: abs(x.rating - target_rating))[
-        :RATING_SAMPLE_SIZE
-    ]
+class RatingIndex:
+    """Puzzles ordered by rating for O(log n + K) rating-targeted selection.
+
+    Selections contain the same puzzles as a linear scan of the pack. Nearest-K
+    fallbacks keep the scan's order (by rating distance, then pack position);
+    rating windows are returned as views in rating order.
+    """
+
+    def __init__(self, puzzles: Sequence[Puzzle]):
+        self.puzzles = puzzles
+        self.ratings = puzzle_ratings(puzzles).astype(np.int32)
+        # A stable sort keeps puzzles with equal ratings in pack order.
+        self.order = np.argsort(self.ratings, kind="stable")
+        self.sorted_ratings = self.ratings[self.order]
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def window(self, min_rating: int, max_rating: int) -> np.ndarray:
+        """Pack positions of the puzzles rated within [min_rating, max_rating]."""
+        lo, hi = self.window_bounds(min_rating, max_rating)
+        return self.order[lo:hi]
+
+    def window_bounds(
+        self, min_ratings, max_ratings
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """The [lo, hi) slices of `order` rated within each pair of bounds.
+
+        Takes scalars or arrays, so many windows cost two searchsorted calls.
+        """
+        lo = np.searchsorted(self.sorted_ratings, min_ratings, side="left")
+        hi = np.searchsorted(self.sorted_ratings, max_ratings, side="right")
+        return lo, hi
+
+    def nearest(self, target_rating: int, k: int) -> np.ndarray:
+        """Pack positions of the k puzzles closest in rating to target_rating."""
+        n = len(self.order)
+        if k >= n:
+            return self._by_distance(self.order, target_rating)
+
+        # The k nearest puzzles are within k places of the insertion point on
+        # either side, which bounds the k-th smallest distance.
+        p = int(np.searchsorted(self.sorted_ratings, target_rating))
+        lo, hi = max(0, p - k), min(n, p + k)
+        distances = np.abs(self.sorted_ratings[lo:hi] - target_rating)
+        kth_distance = np.partition(distances, k - 1)[k - 1]
+
+        # Everything strictly closer is in the slice. Puzzles at exactly the
+        # k-th distance may extend past it, so take those from the full rating
+        # runs and keep the earliest in pack order, like a stable sort would.
+        closer = self.order[lo:hi][distances < kth_distance]
+        below = target_rating - kth_distance
+        above = target_rating + kth_distance
+        ties = [self.window(below, below)]
+        if kth_distance:
+            ties.append(self.window(above, above))
+        ties = np.sort(np.concatenate(ties))[: k - len(closer)]
+        return self._by_distance(np.concatenate([closer, ties]), target_rating)
+
+    def around(self, target_rating: int, k: int) -> np.ndarray:
+        """Pack positions of k puzzles around target_rating, in rating order.
+
+        A cheaper stand-in for nearest when the exact order does not matter:
+        one contiguous slice of the rating order, centred on target_rating.
+        """
+        n = len(self.order)
+        p = int(np.searchsorted(self.sorted_ratings, target_rating))
+        lo = min(max(0, p - k // 2), max(0, n - k))
+        return self.order[lo : lo + k]
+
+    def _by_distance(self, positions: np.ndarray, target_rating: int) -> np.ndarray:
+        distances = np.abs(self.ratings[positions] - target_rating)
+        return positions[np.lexsort((positions, distances))]
+
+    def candidate_positions(self, target_rating: int) -> np.ndarray:
+        positions = self.window(
+            target_rating - RATING_WINDOW, target_rating + RATING_WINDOW
+        )
+        if len(positions) < RATING_SAMPLE_SIZE:
+            positions = self.nearest(target_rating, RATING_SAMPLE_SIZE)
+        return positions
+
+    def candidates(self, target_rating: int) -> Sequence[Puzzle]:
+        return PuzzleSubset(self.puzzles, self.candidate_positions(target_rating))
+
+
+def _select_untaken(
+    index: RatingIndex,
+    target_rating: int,
+    positions: np.ndarray,
+    count: int,
+    taken: np.ndarray,
+    taken_ids: Set[str],
+    rng: random.Random,
+) -> List[Puzzle]:
+    """Draw count puzzles with distinct ids from the untaken positions,
+    widening to the nearest untaken puzzles by rating once they run out."""
+    selected: List[Puzzle] = []
+    while len(selected) < count:
+        untaken = positions[~taken[positions]]
+        if len(untaken) == 0:
+            num_taken = int(taken.sum())
+            if num_taken == len(index):
+                raise ValueError("Not enough puzzles in pack for the requested batch")
+            # The nearest num_taken + 1 puzzles include at least one untaken.
+            positions = index.nearest(target_rating, num_taken + RATING_SAMPLE_SIZE)
+            continue
+
+        num_draws = min(count - len(selected), len(untaken))
+        picked = untaken[rng.sample(range(len(untaken)), num_draws)]
+        taken[picked] = True
+        for position in picked.tolist():
+            puzzle = index.puzzles[position]
+            if puzzle.puzzle_id not in taken_ids:
+                taken_ids.add(puzzle.puzzle_id)
+                selected.append(puzzle)
+    return selected
+
+
+def target_puzzles_by_rating(puzzles: Sequence[Puzzle], target_rating: int):
+    return RatingIndex(puzzles).candidates(target_rating)
 
 
 def extract_fens_from_pgn(pgn_string):
+    import chess.pgn
+
     # Parse the PGN string
     pgn = chess.pgn.read_game(io.StringIO(pgn_string))
 
@@ -239,11 +472,23 @@ def extract_fens_from_pgn(pgn_string):
     return fens
 
 
-def get_structure_sets_from_pgn(pgn_string):
+def get_structure_sets_from_pgn(pgn_string) -> Set[int]:
+    import chess
+    import chess.pgn
+
+    # Read the pawn bitboards off each board directly instead of going
+    # through a FEN, producing the same keys as pawn_structure_key.
     structures = set()
-    fens = extract_fens_from_pgn(pgn_string)
-    for fen in fens:
-        structures.add(pawns_only_fen(fen))
+    pgn = chess.pgn.read_game(io.StringIO(pgn_string))
+    board = pgn.board()
+    for move in pgn.mainline_moves():
+        board.push(move)
+        structures.add(
+            pawn_structure_key_from_bitboards(
+                board.pawns & board.occupied_co[chess.WHITE],
+                board.pawns & board.occupied_co[chess.BLACK],
+            )
+        )
     return structures
 
 
@@ -274,9 +519,7 @@ def pawns_only_fen(fen):
     return "/".join(new_layout)
 
 
-def get_structure_sets_from_lichess(username: str, num_games: int) -> List[str]:
-    structures = set()
-    pgns = lichess.api.user_games(username, max=num_games, format=PGN)
-    for pgn in pgns:
-        structures.update(get_structure_sets_from_pgn(pgn))
-    return structures
+def get_structure_sets_from_lichess(username: str, num_games: int) -> Set[int]:
+    from lichess_games import get_default_fetcher
+
+    return get_default_fetcher().get_structures_sync(username, num_games)
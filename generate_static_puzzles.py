@@ -1,10 +1,41 @@
-from generate_puzzles import PuzzleGenerator, PUZZLES_RANDOM
+from generate_puzzles import PuzzleGenerator, PuzzlePacks, PUZZLES_RANDOM, convert_to_analysis_url
+from puzzle_index import source_digest, source_fingerprint
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence
+import instrumentation
+import multiprocessing
+import hashlib
+import gzip
+import io
 import os
+import re
 import csv
+import json
 import argparse
 import random
+
+# Records the inputs of every pack written by a bulk build
+BUILD_MANIFEST_FILE = 'build_manifest.json'
+# Maps each pack's plain file name to its current content-hashed name
+PACK_INDEX_FILE = 'pack_index.json'
+# Bump when the same inputs would produce a different pack file
+PACK_FORMAT_VERSION = 2
+# Seed used for packs whose spec does not give one
+DEFAULT_SEED = 0
+
+# csv keeps every column; json drops the derivable analysis_url
+PACK_FORMATS = ['csv', 'json']
+PACK_COMPRESSIONS = ['gz', 'br']
+JSON_PACK_FIELDS = ['fen', 'elo', 'defensive']
+CONTENT_HASH_LENGTH = 12
+# Sharded packs are a directory of JSON shards listed in this file
+SHARD_INDEX_FILE = 'index.json'
+DEFAULT_SHARD_SIZE = 500
+
 def generate_static_puzzles(num_puzzles: int, puzzle_pack: str, 
-                          start_elo: int, end_elo: int) -> list:
+                          start_elo: int, end_elo: int,
+                          puzzle_generator: Optional[PuzzleGenerator] = None,
+                          rng: Optional[random.Random] = None) -> list:
     """Generate a static dataset of puzzles with ELO ratings between start_elo and end_elo.
     
     Args:
@@ -12,78 +43,525 @@ def generate_static_puzzles(num_puzzles: int, puzzle_pack: str,
         puzzle_pack: The puzzle pack to use
         start_elo: Starting ELO rating (inclusive)
         end_elo: Ending ELO rating (inclusive)
+        puzzle_generator: Generator to select from (a new one is created if None)
+        rng: Random source for selection and shuffling (the random module if None)
     """
-    puzzle_generator = PuzzleGenerator()
+    puzzle_generator = puzzle_generator or PuzzleGenerator()
+    rng = rng or random
     puzzles = []
 
     # Divide num_puzzles by 2 since we are generating both offensive and defensive puzzles
     num_puzzles = num_puzzles // 2
+    elos = []
     for i in range(num_puzzles):
         # Calculate ELO for this puzzle - linear distribution between start and end
         elo = start_elo + (end_elo - start_elo) * (i / (num_puzzles - 1)) if num_puzzles > 1 else start_elo
-        elo = int(round(elo))
-        
+        elos.append(int(round(elo)))
+
+    # Select every puzzle in one batch so no puzzle appears twice in the pack
+    selections = puzzle_generator.select_puzzles_for_curve(puzzle_pack, elos, rng)
+    for elo, puzzle in zip(elos, selections):
         # Get both offensive and defensive puzzles
-        (offensive_fen, offensive_url), (defensive_fen, defensive_url) = (
-            puzzle_generator.generate_puzzle_fen_strings(
-                puzzle_pack,
-                elo,
-                None,
-                None
-            )
-        )
+        offensive_fen = puzzle.generate_puzzle_position(False)
+        defensive_fen = puzzle.generate_puzzle_position(True)
         
         # Add both puzzles to the list
         puzzles.extend([
             {
                 'fen': offensive_fen,
-                'analysis_url': offensive_url,
+                'analysis_url': convert_to_analysis_url(offensive_fen),
                 'elo': elo,
                 'type': 'offensive'
             },
             {
                 'fen': defensive_fen,
-                'analysis_url': defensive_url,
+                'analysis_url': convert_to_analysis_url(defensive_fen),
                 'elo': elo,
                 'type': 'defensive'
             }
         ])
 
     # Shuffle the puzzles
-    random.shuffle(puzzles)
+    rng.shuffle(puzzles)
     
     return puzzles
 
 def export_puzzles_to_csv(output_dir: str, num_puzzles: int,
                          puzzle_pack: str, start_elo: int, 
-                         end_elo: int):
-    """Generate puzzles and save them as a CSV file with metadata in the filename.
+                         end_elo: int,
+                         puzzle_generator: Optional[PuzzleGenerator] = None,
+                         seed: Optional[int] = None,
+                         pack_format: str = 'csv',
+                         compress: Sequence[str] = (),
+                         content_hash: bool = False) -> Optional[str]:
+    """Generate puzzles and save them as a pack file with metadata in the filename.
     
     Args:
-        output_dir: Output directory for the CSV file
+        output_dir: Output directory for the pack file
         num_puzzles: Number of puzzles to generate
         puzzle_pack: The puzzle pack to use
         start_elo: Starting ELO rating
         end_elo: Ending ELO rating
+        puzzle_generator: Generator to select from (a new one is created if None)
+        seed: Seed for puzzle selection and ordering (unseeded if None)
+        pack_format: One of PACK_FORMATS
+        compress: Precompressed copies to write next to the pack (gz, br)
+        content_hash: Put a hash of the contents in the filename and record
+            it in the output directory's pack index
+
+    Returns:
+        The path of the written file, or None if no puzzles were generated
     """
     
     # Generate puzzles
-    puzzles = generate_static_puzzles(num_puzzles, puzzle_pack, start_elo, end_elo)
+    rng = random.Random(seed) if seed is not None else None
+    puzzles = generate_static_puzzles(num_puzzles, puzzle_pack, start_elo, end_elo,
+                                      puzzle_generator, rng)
     
     if puzzles:
-        # Create filename with metadata
-        filename = f"puzzles_{puzzle_pack}_n{num_puzzles}_elo{start_elo}-{end_elo}.csv"
-        filepath = os.path.join(output_dir, filename)
-        
-        os.makedirs(output_dir, exist_ok=True)
-        
-        with open(filepath, 'w', newline='') as f:
-            writer = csv.writer(f)
-            if puzzles and len(puzzles) > 0:
-                writer.writerow(puzzles[0].keys())
-                for puzzle in puzzles:
-                    writer.writerow(puzzle.values())
+        filepath = write_pack(output_dir, puzzles, puzzle_pack, num_puzzles, start_elo,
+                              end_elo, pack_format, compress, content_hash)
+        if content_hash:
+            update_pack_index(output_dir, [filepath])
+        return filepath
+    return None
+
+
+def pack_file_name(puzzle_pack: str, num_puzzles: int, start_elo: int, end_elo: int,
+                   pack_format: str = 'csv') -> str:
+    return f"puzzles_{puzzle_pack}_n{num_puzzles}_elo{start_elo}-{end_elo}.{pack_format}"
+
+
+def encode_pack(puzzles: List[dict], pack_format: str) -> bytes:
+    """Serialize generated puzzles in one of PACK_FORMATS.
+    
+    The json format is {"version", "fields", "puzzles"} with one array per
+    puzzle in the order of fields, and defensive as 0 or 1.
+    """
+    if pack_format == 'csv':
+        output = io.StringIO(newline='')
+        writer = csv.writer(output)
+        writer.writerow(puzzles[0].keys())
+        for puzzle in puzzles:
+            writer.writerow(puzzle.values())
+        return output.getvalue().encode()
+    if pack_format == 'json':
+        pack = {
+            'version': 1,
+            'fields': JSON_PACK_FIELDS,
+            'puzzles': [
+                [puzzle['fen'], int(puzzle['elo']), int(puzzle['type'] == 'defensive')]
+                for puzzle in puzzles
+            ],
+        }
+        return json.dumps(pack, separators=(',', ':')).encode()
+    raise ValueError(f"Unknown pack format {pack_format}")
+
+
+def decode_json_pack(content: bytes) -> List[dict]:
+    """Read a json pack back into puzzles with fen, elo and type, as the
+    frontend's parseJsonPack does (analysis_url is not stored)."""
+    pack = json.loads(content)
+    puzzles = []
+    for values in pack['puzzles']:
+        puzzle = dict(zip(pack['fields'], values))
+        puzzle['type'] = 'defensive' if puzzle.pop('defensive') else 'offensive'
+        puzzles.append(puzzle)
+    return puzzles
+
+
+def compress_pack(content: bytes, compression: str) -> bytes:
+    # mtime=0 keeps the gzip header, and so the file, the same across rebuilds
+    if compression == 'gz':
+        return gzip.compress(content, compresslevel=9, mtime=0)
+    if compression == 'br':
+        try:
+            import brotli
+        except ImportError:
+            raise ImportError("br compression requires the brotli package") from None
+        return brotli.compress(content, quality=11)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def write_pack(output_dir: str, puzzles: List[dict], puzzle_pack: str, num_puzzles: int,
+               start_elo: int, end_elo: int, pack_format: str = 'csv',
+               compress: Sequence[str] = (), content_hash: bool = False) -> str:
+    """Write generated puzzles as a pack file plus any precompressed copies.
+    
+    With content_hash the filename carries a hash of the contents, so it can
+    be cached forever, and older hashed versions of the same pack are removed.
+
+    Returns:
+        The path of the uncompressed pack file
+    """
+    content = encode_pack(puzzles, pack_format)
+    filename = pack_file_name(puzzle_pack, num_puzzles, start_elo, end_elo, pack_format)
+    if content_hash:
+        stem = filename[:-len(pack_format) - 1]
+        digest = hashlib.sha256(content).hexdigest()[:CONTENT_HASH_LENGTH]
+        filename = f"{stem}.{digest}.{pack_format}"
+    filepath = os.path.join(output_dir, filename)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    changed = _write_if_changed(filepath, content)
+    for compression in compress:
+        changed |= _write_if_changed(f"{filepath}.{compression}",
+                                     compress_pack(content, compression))
+    if content_hash:
+        stale = re.compile(re.escape(stem) + r'\.[0-9a-f]{%d}\.' % CONTENT_HASH_LENGTH
+                           + re.escape(pack_format) + r'(\.\w+)?$')
+        for name in os.listdir(output_dir):
+            if stale.match(name) and not name.startswith(filename):
+                os.remove(os.path.join(output_dir, name))
+    if changed:
         print(f"Saved {len(puzzles)} puzzles to {filepath}")
+    else:
+        print(f"Unchanged {filepath}")
+    return filepath
+
+
+def update_pack_index(output_dir: str, filepaths: List[str]):
+    """Point each content-hashed pack's plain file name at its hashed file."""
+    index_file = os.path.join(output_dir, PACK_INDEX_FILE)
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        stem, digest, pack_format = filename.rsplit('.', 2)
+        index[f"{stem}.{pack_format}"] = filename
+    _write_if_changed(index_file, (json.dumps(index, indent=2, sort_keys=True) + '\n').encode())
+
+
+def _write_if_changed(filepath: str, content: bytes) -> bool:
+    """Atomically write content unless the file already holds exactly it.
+    
+    Returns:
+        Whether the file was written
+    """
+    if os.path.exists(filepath):
+        with open(filepath, 'rb') as f:
+            if f.read() == content:
+                return False
+    # Write to a temporary file and rename it into place so readers never
+    # see a partially written pack
+    tmp_filepath = f"{filepath}.tmp{os.getpid()}"
+    with open(tmp_filepath, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_filepath, filepath)
+    return True
+
+
+def _file_sha256(filepath: str) -> Optional[str]:
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def export_sharded_pack(output_dir: str, num_puzzles: int, puzzle_pack: str,
+                        start_elo: int, end_elo: int,
+                        shard_size: int = DEFAULT_SHARD_SIZE,
+                        puzzle_generator: Optional[PuzzleGenerator] = None,
+                        seed: Optional[int] = DEFAULT_SEED,
+                        compress: Sequence[str] = ()) -> Optional[str]:
+    """Generate a large pack and save it as fixed-size JSON shards plus an index.
+    
+    Puzzles are ordered by ELO, so ordinals run from start_elo to end_elo,
+    and split into shards of shard_size puzzles. The index lists every
+    shard's file, puzzle count and ELO range, so a client can find the shard
+    for an ordinal or a rating and fetch only that one. Shard filenames are
+    content-hashed; shards no longer listed in the index are removed.
+    
+    Args:
+        output_dir: Output directory for the pack directory
+        num_puzzles: Number of puzzles to generate
+        puzzle_pack: The puzzle pack to use
+        start_elo: Starting ELO rating
+        end_elo: Ending ELO rating
+        shard_size: Number of puzzles per shard
+        puzzle_generator: Generator to select from (a new one is created if None)
+        seed: Seed for puzzle selection and ordering (unseeded if None)
+        compress: Precompressed copies to write next to each shard (gz, br)
+
+    Returns:
+        The path of the shard index, or None if no puzzles were generated
+    """
+    rng = random.Random(seed) if seed is not None else None
+    puzzles = generate_static_puzzles(num_puzzles, puzzle_pack, start_elo, end_elo,
+                                      puzzle_generator, rng)
+    if not puzzles:
+        return None
+    # Stable, so puzzles of equal ELO keep their shuffled order
+    puzzles.sort(key=lambda puzzle: puzzle['elo'])
+
+    stem = pack_file_name(puzzle_pack, num_puzzles, start_elo, end_elo, 'json')[:-len('.json')]
+    pack_dir = os.path.join(output_dir, stem)
+    os.makedirs(pack_dir, exist_ok=True)
+
+    shards = []
+    for shard_start in range(0, len(puzzles), shard_size):
+        shard = puzzles[shard_start:shard_start + shard_size]
+        content = encode_pack(shard, 'json')
+        digest = hashlib.sha256(content).hexdigest()[:CONTENT_HASH_LENGTH]
+        filename = f"shard-{len(shards):05d}.{digest}.json"
+        _write_if_changed(os.path.join(pack_dir, filename), content)
+        for compression in compress:
+            _write_if_changed(os.path.join(pack_dir, f"{filename}.{compression}"),
+                              compress_pack(content, compression))
+        shards.append({
+            'file': filename,
+            'count': len(shard),
+            'min_elo': shard[0]['elo'],
+            'max_elo': shard[-1]['elo'],
+        })
+
+    index = {
+        'version': 1,
+        'fields': JSON_PACK_FIELDS,
+        'count': len(puzzles),
+        'shard_size': shard_size,
+        'shards': shards,
+    }
+    index_file = os.path.join(pack_dir, SHARD_INDEX_FILE)
+    changed = _write_if_changed(index_file, (json.dumps(index, indent=2) + '\n').encode())
+
+    listed = {shard['file'] for shard in shards}
+    for name in os.listdir(pack_dir):
+        if name.startswith('shard-') and name.split('.json')[0] + '.json' not in listed:
+            os.remove(os.path.join(pack_dir, name))
+    if changed:
+        print(f"Saved {len(puzzles)} puzzles in {len(shards)} shards to {pack_dir}")
+    else:
+        print(f"Unchanged {pack_dir}")
+    return index_file
+
+
+class ShardedPack:
+    """Reads a sharded pack one shard at a time, like the loader in docs/script.js.
+
+    Puzzles are looked up by ordinal or by the first ordinal reaching a
+    rating, loading only the shard that holds them.
+    """
+
+    def __init__(self, index_file: str):
+        self.pack_dir = os.path.dirname(index_file)
+        with open(index_file) as f:
+            self.index = json.load(f)
+        self.count: int = self.index['count']
+        self.shard_size: int = self.index['shard_size']
+        self.loaded: Dict[int, List[dict]] = {}
+
+    def __len__(self) -> int:
+        return self.count
+
+    def shard(self, shard: int) -> List[dict]:
+        if shard not in self.loaded:
+            filepath = os.path.join(self.pack_dir, self.index['shards'][shard]['file'])
+            with open(filepath, 'rb') as f:
+                self.loaded[shard] = decode_json_pack(f.read())
+        return self.loaded[shard]
+
+    def __getitem__(self, ordinal: int) -> dict:
+        if not 0 <= ordinal < self.count:
+            raise IndexError("sharded pack index out of range")
+        shard = ordinal // self.shard_size
+        return self.shard(shard)[ordinal - shard * self.shard_size]
+
+    def index_for_elo(self, elo: int) -> int:
+        """The ordinal of the first puzzle rated at least elo, or the last one."""
+        for shard, entry in enumerate(self.index['shards']):
+            if entry['max_elo'] >= elo:
+                puzzles = self.shard(shard)
+                offset = next(i for i, puzzle in enumerate(puzzles) if puzzle['elo'] >= elo)
+                return shard * self.shard_size + offset
+        return self.count - 1
+
+
+# Shared with bulk export workers; inherited copy-on-write when forked
+_bulk_puzzle_generator: Optional[PuzzleGenerator] = None
+
+
+def _init_bulk_worker():
+    global _bulk_puzzle_generator
+    if _bulk_puzzle_generator is None:
+        _bulk_puzzle_generator = PuzzleGenerator()
+
+
+def _export_pack_spec(task: tuple) -> Optional[str]:
+    output_dir, spec = task
+    rng = random.Random(spec['seed'])
+    puzzles = generate_static_puzzles(spec['num_puzzles'], spec['puzzle_pack'],
+                                      spec['start_elo'], spec['end_elo'],
+                                      _bulk_puzzle_generator, rng)
+    if not puzzles:
+        return None
+    return write_pack(output_dir, puzzles, spec['puzzle_pack'], spec['num_puzzles'],
+                      spec['start_elo'], spec['end_elo'], spec['format'],
+                      spec['compress'], spec['content_hash'])
+
+
+def _source_digests(source_files: List[str], previous: Dict[str, dict]) -> Dict[str, dict]:
+    """Content hashes of the source files, reusing the previous build's hash
+    for any file whose size and modification time are unchanged."""
+    sources = {}
+    for source_file in source_files:
+        fingerprint = source_fingerprint(source_file)
+        entry = previous.get(source_file)
+        if entry is None or entry.get('fingerprint') != fingerprint:
+            instrumentation.cache_miss('source_digest')
+            with instrumentation.stage('source_digest') as recorder:
+                entry = {'fingerprint': fingerprint, 'sha256': source_digest(source_file)}
+                recorder.add(bytes_read=os.path.getsize(source_file))
+        else:
+            instrumentation.cache_hit('source_digest')
+        sources[source_file] = entry
+    return sources
+
+
+def _is_up_to_date(output_dir: str, recorded: Optional[dict], inputs: dict) -> bool:
+    if recorded is None or recorded['inputs'] != inputs:
+        return False
+    filepath = os.path.join(output_dir, recorded['file'])
+    return (recorded['sha256'] == _file_sha256(filepath)
+            and all(os.path.exists(f"{filepath}.{compression}")
+                    for compression in inputs['compress']))
+
+
+def export_puzzle_packs(manifest_file: str, output_dir: str,
+                        num_workers: int = 1, incremental: bool = False,
+                        pack_format: str = 'csv', compress: Sequence[str] = (),
+                        content_hash: bool = False) -> List[Optional[str]]:
+    """Generate every pack listed in a manifest, loading puzzle data only once.
+    
+    The manifest is a JSON list of pack specs, each with puzzle_pack,
+    num_puzzles, start_elo, end_elo and an optional seed, format, compress
+    and content_hash that override the defaults given here. Puzzle packs and
+    their rating indexes are loaded in this process before the workers fork,
+    so the workers share them read-only instead of each reloading them.
+    
+    No two specs may write the same file name, so packs must differ in
+    puzzle_pack, num_puzzles, ELO range or format, not only in seed.
+
+    Each pack is a pure function of its spec, its seed and the contents of
+    its source files. Those inputs are recorded in a build manifest in
+    output_dir, and pack files whose contents did not change are not
+    rewritten.
+    
+    Args:
+        manifest_file: Path to the JSON manifest of pack specs
+        output_dir: Output directory for the pack files
+        num_workers: Number of worker processes
+        incremental: Skip packs whose recorded inputs and output are unchanged
+        pack_format: Default pack format, one of PACK_FORMATS
+        compress: Default precompressed copies to write (gz, br)
+        content_hash: Whether to content-hash filenames by default
+
+    Returns:
+        The path of each spec's pack, in manifest order
+    """
+    global _bulk_puzzle_generator
+    defaults = {'seed': DEFAULT_SEED, 'format': pack_format,
+                'compress': sorted(compress), 'content_hash': content_hash}
+    with open(manifest_file) as f:
+        specs = [{**defaults, **spec} for spec in json.load(f)]
+    # The file name leaves out the seed and compression, so specs differing
+    # only in those would overwrite (or clean up) each other's files.
+    names = [pack_file_name(spec['puzzle_pack'], spec['num_puzzles'], spec['start_elo'],
+                            spec['end_elo'], spec['format']) for spec in specs]
+    first_spec = {}
+    for i, name in enumerate(names):
+        if name in first_spec:
+            raise ValueError(f"Manifest entries {first_spec[name]} and {i} both write {name}")
+        first_spec[name] = i
+
+    build_manifest_file = os.path.join(output_dir, BUILD_MANIFEST_FILE)
+    previous = {'sources': {}, 'packs': {}}
+    if os.path.exists(build_manifest_file):
+        with open(build_manifest_file) as f:
+            previous = json.load(f)
+
+    puzzle_packs = PuzzlePacks()
+    pack_sources = {
+        spec['puzzle_pack']: puzzle_packs.source_files(spec['puzzle_pack'])
+        for spec in specs
+    }
+    sources = _source_digests(
+        sorted({source for files in pack_sources.values() for source in files}),
+        previous['sources'],
+    )
+
+    filepaths: List[Optional[str]] = []
+    build_inputs = {}
+    pending = []
+    for i, (spec, name) in enumerate(zip(specs, names)):
+        inputs = {
+            'version': PACK_FORMAT_VERSION,
+            'puzzle_pack': spec['puzzle_pack'],
+            'num_puzzles': spec['num_puzzles'],
+            'start_elo': spec['start_elo'],
+            'end_elo': spec['end_elo'],
+            'seed': spec['seed'],
+            'format': spec['format'],
+            'compress': sorted(spec['compress']),
+            'content_hash': spec['content_hash'],
+            'sources': {source: sources[source]['sha256']
+                        for source in pack_sources[spec['puzzle_pack']]},
+        }
+        build_inputs[name] = inputs
+
+        recorded = previous['packs'].get(name)
+        if incremental and _is_up_to_date(output_dir, recorded, inputs):
+            instrumentation.cache_hit('incremental_pack')
+            filepath = os.path.join(output_dir, recorded['file'])
+            print(f"Up to date {filepath}")
+            filepaths.append(filepath)
+            continue
+        if incremental:
+            instrumentation.cache_miss('incremental_pack')
+        filepaths.append(None)
+        pending.append(i)
+
+    if pending:
+        tasks = [(output_dir, specs[i]) for i in pending]
+        _bulk_puzzle_generator = PuzzleGenerator()
+        for puzzle_pack in sorted({spec['puzzle_pack'] for _, spec in tasks}):
+            _bulk_puzzle_generator.get_rating_index(puzzle_pack)
+
+        if num_workers <= 1:
+            written = [_export_pack_spec(task) for task in tasks]
+        else:
+            # Without fork (e.g. spawn on macOS) the initializer rebuilds the
+            # generator per worker, which only maps the puzzle stores again
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                                     initializer=_init_bulk_worker) as executor:
+                written = list(executor.map(_export_pack_spec, tasks))
+        for i, filepath in zip(pending, written):
+            filepaths[i] = filepath
+
+    hashed = [filepath for spec, filepath in zip(specs, filepaths)
+              if spec['content_hash'] and filepath is not None]
+    if hashed:
+        update_pack_index(output_dir, hashed)
+
+    # Keep the records of packs built from other manifests into output_dir
+    packs = {
+        name: entry for name, entry in previous['packs'].items()
+        if os.path.exists(os.path.join(output_dir, entry.get('file', name)))
+    }
+    for (name, inputs), filepath in zip(build_inputs.items(), filepaths):
+        if filepath is not None:
+            packs[name] = {'inputs': inputs, 'file': os.path.basename(filepath),
+                           'sha256': _file_sha256(filepath)}
+    build_manifest = {'sources': {**previous['sources'], **sources}, 'packs': packs}
+    os.makedirs(output_dir, exist_ok=True)
+    _write_if_changed(build_manifest_file,
+                      (json.dumps(build_manifest, indent=2, sort_keys=True) + '\n').encode())
+    return filepaths
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate static chess puzzles')
@@ -96,15 +574,62 @@ if __name__ == "__main__":
     parser.add_argument('--end_elo', type=int, default=1000,
                       help='Ending ELO rating')
     parser.add_argument('--output_dir', type=str, default="docs/static_puzzles",
-                      help='Output directory for the CSV file')
+                      help='Output directory for the pack files')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                      help='Seed for puzzle selection and ordering')
+    parser.add_argument('--format', type=str, default='csv', choices=PACK_FORMATS,
+                      help='Pack file format (json drops derivable columns)')
+    parser.add_argument('--compress', type=str, nargs='*', default=[],
+                      choices=PACK_COMPRESSIONS,
+                      help='Also write precompressed copies of each pack')
+    parser.add_argument('--content_hash', action='store_true',
+                      help='Put a content hash in pack filenames and update pack_index.json')
+    parser.add_argument('--shard_size', type=int, default=None,
+                      help=f'Write a sharded JSON pack with this many puzzles per shard '
+                           f'(e.g. {DEFAULT_SHARD_SIZE})')
+    parser.add_argument('--manifest', type=str, default=None,
+                      help='JSON list of pack specs to generate in bulk')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                      help='Number of worker processes for --manifest')
+    parser.add_argument('--incremental', action='store_true',
+                      help='With --manifest, skip packs whose inputs are unchanged')
+    parser.add_argument('--profile', type=str, nargs='?', const='profiles', default=None,
+                      help='Write a cProfile pstats file per stage to this directory')
     
     args = parser.parse_args()
+    instrumentation.configure(profile_dir=args.profile)
+    
+    if args.manifest:
+        # Export every pack in the manifest
+        with instrumentation.stage('export_puzzle_packs'):
+            export_puzzle_packs(args.manifest, args.output_dir, args.workers, args.incremental,
+                                args.format, args.compress, args.content_hash)
+    elif args.shard_size:
+        # Export one large pack as shards
+        with instrumentation.stage('export_sharded_pack'):
+            export_sharded_pack(
+                output_dir=args.output_dir,
+                num_puzzles=args.num_puzzles,
+                puzzle_pack=args.puzzle_pack,
+                start_elo=args.start_elo,
+                end_elo=args.end_elo,
+                shard_size=args.shard_size,
+                seed=args.seed,
+                compress=args.compress
+            )
+    else:
+        # Export puzzles using the export function
+        with instrumentation.stage('export_puzzles_to_csv'):
+            export_puzzles_to_csv(
+                output_dir=args.output_dir,
+                num_puzzles=args.num_puzzles,
+                puzzle_pack=args.puzzle_pack,
+                start_elo=args.start_elo,
+                end_elo=args.end_elo,
+                seed=args.seed,
+                pack_format=args.format,
+                compress=args.compress,
+                content_hash=args.content_hash
+            )
     
-    # Export puzzles using the export function
-    export_puzzles_to_csv(
-        output_dir=args.output_dir,
-        num_puzzles=args.num_puzzles,
-        puzzle_pack=args.puzzle_pack,
-        start_elo=args.start_elo,
-        end_elo=args.end_elo
-    ) 
\ No newline at end of file
+    instrumentation.get_instrumentation().finish()
@@ -0,0 +1,239 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, TextIO
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROGRESS_INTERVAL_SECONDS = 5.0
+PROFILE_TOP_FUNCTIONS = 15
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size so far of this process and its waited children."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return round(peak * scale / (1024 * 1024), 1)
+
+
+@dataclass
+class StageStats:
+    """Totals over every run of one named stage."""
+
+    name: str
+    calls: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    rows: int = 0
+    bytes_read: int = 0
+
+    def to_dict(self) -> Dict:
+        result = {
+            "calls": self.calls,
+            "seconds": round(self.seconds, 4),
+            "max_seconds": round(self.max_seconds, 4),
+        }
+        if self.rows:
+            result["rows"] = self.rows
+            result["rows_per_second"] = (
+                round(self.rows / self.seconds, 1) if self.seconds else None
+            )
+        if self.bytes_read:
+            result["bytes_read"] = self.bytes_read
+            result["mb_per_second"] = (
+                round(self.bytes_read / self.seconds / 1e6, 1) if self.seconds else None
+            )
+        return result
+
+
+class StageRecorder:
+    """Handed to the body of a stage to count its work and report progress.
+
+    progress() may be called as often as convenient; it prints at most once
+    every `interval` seconds.
+    """
+
+    def __init__(self, name: str, stream: TextIO, interval: float):
+        self.name = name
+        self.stream = stream
+        self.interval = interval
+        self.rows = 0
+        self.bytes_read = 0
+        self.start = time.perf_counter()
+        self.next_report = self.start + interval
+
+    def add(self, rows: int = 0, bytes_read: int = 0):
+        self.rows += rows
+        self.bytes_read += bytes_read
+
+    def progress(self, total_bytes: Optional[int] = None):
+        now = time.perf_counter()
+        if now < self.next_report:
+            return
+        self.next_report = now + self.interval
+        elapsed = now - self.start
+        message = f"[{self.name}] {self.rows:,} rows, {self.rows / elapsed:,.0f} rows/s"
+        if total_bytes:
+            message += f", {100 * self.bytes_read / total_bytes:.0f}% of input"
+        print(message, file=self.stream, flush=True)
+
+
+class Instrumentation:
+    """Collects per-stage wall time, throughput, cache hits and peak memory.
+
+    Stages are named blocks of work, timed with `with stage(name) as s`.
+    Repeated stages are summed under their name. Stages also wrap per-request
+    work, so they only read the clock; peak memory is sampled once, for the
+    summary. With a profile directory, every outermost stage on the main
+    thread also runs under cProfile, and finish() writes one pstats file per
+    stage.
+    """
+
+    def __init__(
+        self,
+        profile_dir: Optional[str] = None,
+        stream: TextIO = sys.stderr,
+        progress_interval: float = PROGRESS_INTERVAL_SECONDS,
+    ):
+        self.profile_dir = profile_dir
+        self.stream = stream
+        self.progress_interval = progress_interval
+        self.stages: Dict[str, StageStats] = {}
+        self.cache_hits: Dict[str, int] = {}
+        self.cache_misses: Dict[str, int] = {}
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageRecorder]:
+        recorder = StageRecorder(name, self.stream, self.progress_interval)
+        depth = getattr(self.local, "depth", 0)
+        profile = None
+        if (
+            self.profile_dir is not None
+            and depth == 0
+            and threading.current_thread() is threading.main_thread()
+        ):
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+        self.local.depth = depth + 1
+        if profile is not None:
+            profile.enable()
+        try:
+            yield recorder
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.local.depth = depth
+            seconds = time.perf_counter() - recorder.start
+            with self.lock:
+                stats = self.stages.get(name)
+                if stats is None:
+                    stats = self.stages[name] = StageStats(name)
+                stats.calls += 1
+                stats.seconds += seconds
+                stats.max_seconds = max(stats.max_seconds, seconds)
+                stats.rows += recorder.rows
+                stats.bytes_read += recorder.bytes_read
+
+    def cache_hit(self, cache: str):
+        with self.lock:
+            self.cache_hits[cache] = self.cache_hits.get(cache, 0) + 1
+
+    def cache_miss(self, cache: str):
+        with self.lock:
+            self.cache_misses[cache] = self.cache_misses.get(cache, 0) + 1
+
+    def summary(self) -> Dict:
+        with self.lock:
+            caches = sorted(set(self.cache_hits) | set(self.cache_misses))
+            return {
+                "stages": {name: stats.to_dict() for name, stats in self.stages.items()},
+                "caches": {
+                    cache: {
+                        "hits": self.cache_hits.get(cache, 0),
+                        "misses": self.cache_misses.get(cache, 0),
+                    }
+                    for cache in caches
+                },
+                "peak_rss_mb": peak_rss_mb(),
+            }
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        lines = [f"{'stage':<40} {'calls':>7} {'seconds':>10} {'rows/s':>12}"]
+        for name, stats in summary["stages"].items():
+            rows_per_second = stats.get("rows_per_second")
+            lines.append(
+                f"{name:<40} {stats['calls']:>7} {stats['seconds']:>10.3f} "
+                f"{'' if rows_per_second is None else f'{rows_per_second:,.0f}':>12}"
+            )
+        for cache, counts in summary["caches"].items():
+            lines.append(f"cache {cache}: {counts['hits']} hits, {counts['misses']} misses")
+        lines.append(f"peak RSS: {summary['peak_rss_mb']} MB")
+        return "\n".join(lines)
+
+    def dump_profiles(self) -> List[str]:
+        """Write each stage's profile to <profile_dir>/<stage>.pstats."""
+        if self.profile_dir is None:
+            return []
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile_files = []
+        for name, profile in self.profiles.items():
+            profile_file = os.path.join(
+                self.profile_dir, f"{name.replace('/', '_').replace(':', '_')}.pstats"
+            )
+            profile.dump_stats(profile_file)
+            profile_files.append(profile_file)
+            top = io.StringIO()
+            pstats.Stats(profile, stream=top).sort_stats("cumulative").print_stats(
+                PROFILE_TOP_FUNCTIONS
+            )
+            print(f"[profile {name}] {profile_file}\n{top.getvalue()}", file=self.stream)
+        return profile_files
+
+    def finish(self):
+        """Print the summary and write any stage profiles."""
+        self.dump_profiles()
+        print(self.format_summary(), file=self.stream)
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation() -> Instrumentation:
+    return _instrumentation
+
+
+def configure(profile_dir: Optional[str] = None) -> Instrumentation:
+    """Replace the process-wide instrumentation, e.g. to turn on profiling."""
+    global _instrumentation
+    _instrumentation = Instrumentation(profile_dir=profile_dir)
+    return _instrumentation
+
+
+def stage(name: str):
+    return _instrumentation.stage(name)
+
+
+def cache_hit(cache: str):
+    _instrumentation.cache_hit(cache)
+
+
+def cache_miss(cache: str):
+    _instrumentation.cache_miss(cache)
@@ -0,0 +1,261 @@
+import asyncio
+import http.client
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Protocol, Set, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+from puzzle_index import pawn_structure_key_from_bitboards
+
+LICHESS_API_URL = "https://lichess.org"
+GAMES_CACHE_TTL_SECONDS = 300
+GAMES_CACHE_MAX_USERS = 1024
+HTTP_TIMEOUT_SECONDS = 10
+# Lichess perf types of standard chess; the rest are variants, whose moves
+# python-chess cannot replay on a standard board.
+STANDARD_PERF_TYPES = "ultraBullet,bullet,blitz,rapid,classical,correspondence"
+# "fromPosition" games are standard chess from a custom start (initialFen).
+STANDARD_VARIANTS = {"standard", "fromPosition"}
+
+
+class HttpBackend(Protocol):
+    """Performs GET requests for the fetcher. Swap it out to test or to use
+    a different client library."""
+
+    async def get(self, url: str, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        ...
+
+
+class PooledHttpBackend:
+    """Stdlib HTTP backend that keeps connections alive per host.
+
+    Requests run on worker threads so they do not block the event loop, and
+    finished connections go back to a small per-host pool for reuse.
+    """
+
+    def __init__(self, timeout: float = HTTP_TIMEOUT_SECONDS, max_idle: int = 4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle: Dict[Tuple[str, str], List[http.client.HTTPConnection]] = {}
+        self.lock = threading.Lock()
+
+    async def get(self, url: str, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        return await asyncio.to_thread(self._get, url, headers)
+
+    def _get(self, url: str, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+
+        # A pooled connection may have been closed by the server while idle,
+        # so retry once on a fresh connection.
+        for attempt in range(2):
+            connection = self._acquire(key, fresh=attempt > 0)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+            return response.status, body
+        raise RuntimeError("unreachable")
+
+    def _acquire(self, key: Tuple[str, str], fresh: bool) -> http.client.HTTPConnection:
+        if not fresh:
+            with self.lock:
+                pool = self.idle.get(key)
+                if pool:
+                    return pool.pop()
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, key: Tuple[str, str], connection: http.client.HTTPConnection):
+        with self.lock:
+            pool = self.idle.setdefault(key, [])
+            if len(pool) < self.max_idle:
+                pool.append(connection)
+                return
+        connection.close()
+
+
+@dataclass
+class UserGame:
+    game_id: str
+    created_at: int
+    structures: FrozenSet[int]
+
+
+@dataclass
+class UserGames:
+    # Newest first.
+    games: List[UserGame]
+    fetched_at: float
+    # Games requested when the history was last read back; holding fewer
+    # means the user has no older games.
+    depth: int
+    # Union of the structures of the newest n games, by n.
+    structures: Dict[int, Set[int]] = field(default_factory=dict)
+
+    def structures_of(self, num_games: int) -> Set[int]:
+        structures = self.structures.get(num_games)
+        if structures is None:
+            structures = set()
+            for game in self.games[:num_games]:
+                structures.update(game.structures)
+            self.structures[num_games] = structures
+        return structures
+
+
+def game_structures(moves: str, initial_fen: Optional[str] = None) -> FrozenSet[int]:
+    """Pawn structure keys of every position reached in a game's SAN moves."""
+    import chess
+
+    board = chess.Board(initial_fen) if initial_fen else chess.Board()
+    structures = set()
+    for san in moves.split():
+        board.push_san(san)
+        structures.add(
+            pawn_structure_key_from_bitboards(
+                board.pawns & board.occupied_co[chess.WHITE],
+                board.pawns & board.occupied_co[chess.BLACK],
+            )
+        )
+    return frozenset(structures)
+
+
+class LichessGamesFetcher:
+    """Fetches a user's recent games and caches their pawn structures.
+
+    Users are cached by name, whatever number of games was asked for, and
+    served without touching the network for `ttl` seconds. After that, only
+    games newer than the newest cached game are requested and parsed, and
+    asking for more games than are cached only requests the older ones. At
+    most `max_users` users are cached, least recently used first out.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[HttpBackend] = None,
+        base_url: str = LICHESS_API_URL,
+        ttl: float = GAMES_CACHE_TTL_SECONDS,
+        max_users: int = GAMES_CACHE_MAX_USERS,
+    ):
+        self.backend = backend or PooledHttpBackend()
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.max_users = max_users
+        self.cache: "OrderedDict[str, UserGames]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def fetch_games(
+        self,
+        username: str,
+        max_games: int,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+    ) -> List[UserGame]:
+        """Request a user's most recent standard chess games, newest first,
+        optionally only those created in [since, until]."""
+        params = {
+            "max": max_games,
+            "moves": "true",
+            "pgnInJson": "false",
+            "perfType": STANDARD_PERF_TYPES,
+        }
+        if since is not None:
+            params["since"] = since
+        if until is not None:
+            params["until"] = until
+        url = f"{self.base_url}/api/games/user/{quote(username)}?{urlencode(params)}"
+        status, body = await self.backend.get(url, {"Accept": "application/x-ndjson"})
+        if status != 200:
+            raise ValueError(f"Lichess returned {status} for user {username}")
+
+        games = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            game = json.loads(line)
+            if game.get("variant", "standard") not in STANDARD_VARIANTS:
+                continue
+            games.append(
+                UserGame(
+                    game["id"],
+                    game["createdAt"],
+                    game_structures(game.get("moves", ""), game.get("initialFen")),
+                )
+            )
+        return games
+
+    async def get_structures(self, username: str, num_games: int) -> Set[int]:
+        key = username.lower()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+        now = time.monotonic()
+        if cached is None:
+            games = await self.fetch_games(username, num_games)
+            entry = UserGames(games, now, num_games)
+        else:
+            stale = now - cached.fetched_at >= self.ttl
+            if not stale and cached.depth >= num_games:
+                return cached.structures_of(num_games)
+
+            depth = max(cached.depth, num_games)
+            games = cached.games
+            fetched_at = cached.fetched_at
+            if stale:
+                since = games[0].created_at + 1 if games else None
+                new_games = await self.fetch_games(username, depth, since)
+                games = _merge_games(new_games, games)
+                fetched_at = now
+            # Holding fewer games than were asked for means there are no
+            # older ones; otherwise read back past the oldest cached game.
+            has_older = len(cached.games) >= cached.depth
+            if has_older and len(games) < num_games:
+                until = games[-1].created_at - 1 if games else None
+                older = await self.fetch_games(
+                    username, num_games - len(games), until=until
+                )
+                games = _merge_games(games, older)
+            entry = UserGames(games[:depth], fetched_at, depth)
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_users:
+                self.cache.popitem(last=False)
+        return entry.structures_of(num_games)
+
+    def get_structures_sync(self, username: str, num_games: int) -> Set[int]:
+        return asyncio.run(self.get_structures(username, num_games))
+
+
+def _merge_games(newer: List[UserGame], older: List[UserGame]) -> List[UserGame]:
+    """Two newest-first game lists as one, without repeating a game."""
+    seen = {game.game_id for game in newer}
+    return newer + [game for game in older if game.game_id not in seen]
+
+
+_default_fetcher: Optional[LichessGamesFetcher] = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_default_fetcher() -> LichessGamesFetcher:
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = LichessGamesFetcher()
+        return _default_fetcher
@@ -1,10 +1,28 @@
+import bz2
 import csv
-import chess.pgn
+import gzip
+import hashlib
+import io
+import itertools
+import math
+import os
+import queue
 import random
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Tuple, Optional
+from typing import BinaryIO, Callable, Deque, Dict, List, Tuple, Optional
 import argparse
 
+import numpy as np
+
+import instrumentation
+from instrumentation import StageRecorder
+
 
 @dataclass
 class PuzzleFilter:
@@ -17,6 +35,25 @@ class PuzzleFilter:
 
 
 PUZZLE_INPUT_FILE = "lichess_db_puzzle.csv"
+PUZZLE_OUTPUT_DIR = "puzzles"
+# Filtered outputs carry the position after the opponent's first move, so
+# serving a puzzle never has to replay it.
+OFFENSIVE_FEN_FIELD = "OffensiveFEN"
+FILTER_CHUNK_SIZE = 16 * 1024 * 1024
+# Chunks queued per filter worker, so part files never pile up on disk.
+FILTER_CHUNKS_PER_WORKER = 2
+# Lichess publishes the dump as .zst; these are read as a stream.
+COMPRESSED_SUFFIXES = (".zst", ".gz", ".bz2")
+READ_BUFFER_SIZE = 1024 * 1024
+DECOMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+DECOMPRESS_QUEUE_BLOCKS = 8
+# Per-puzzle content hashes and filter matches from the last filter run, for
+# --delta. Bump the version when their meaning changes.
+FINGERPRINT_FILE = "fingerprints.npz"
+FINGERPRINT_VERSION = 3
+FINGERPRINT_BATCH_ROWS = 65536
+# Filter matches are recorded as one bit per filter in a uint64.
+MAX_FILTERS = 64
 PUZZLE_FILTER_MAPPING: Dict[str, PuzzleFilter] = {
     "opening": PuzzleFilter(
         min_rating=750,
@@ -51,32 +88,987 @@ PUZZLE_FILTER_MAPPING: Dict[str, PuzzleFilter] = {
         puzzle_opening_tag=None,
     ),
 }
+# Filters only run on request. "all" keeps every reasonably popular puzzle,
+# for ad hoc theme queries through the tag index rather than a dedicated
+# filter per theme; it is nearly a copy of the dump, so writing it costs
+# about as much as every other filter together. `filter --all-puzzles`.
+OPTIONAL_FILTER_MAPPING: Dict[str, PuzzleFilter] = {
+    "all": PuzzleFilter(
+        min_rating=500,
+        max_rating=2500,
+        min_popularity=50,
+        min_plays=100,
+        puzzle_theme_tag=None,
+        puzzle_opening_tag=None,
+    ),
+}
+
+
+class FilterPlan:
+    """All configured filters compiled into one predicate evaluated per row.
+
+    Rows are rejected from the raw CSV fields using the union of every
+    filter's numeric bounds before any per-filter work. Surviving rows are
+    matched against exact theme/opening tokens, and only the filters keyed
+    on one of the row's tokens are checked, so the per-row cost grows with
+    the number of tags on the row rather than the number of filters.
+    Identical rating/popularity/plays ranges are evaluated once per row.
+    """
+
+    def __init__(self, filters: Dict[str, PuzzleFilter], fieldnames: List[str]):
+        if len(filters) > MAX_FILTERS:
+            raise ValueError(
+                f"At most {MAX_FILTERS} filters can run at once, got {len(filters)}"
+            )
+        self.filter_names = list(filters)
+        # Bit of each filter in a fingerprint's match mask.
+        self.filter_bits = {name: bit for bit, name in enumerate(filters)}
+        self.rating_index = fieldnames.index("Rating")
+        self.popularity_index = fieldnames.index("Popularity")
+        self.plays_index = fieldnames.index("NbPlays")
+        self.themes_index = fieldnames.index("Themes")
+        self.opening_tags_index = fieldnames.index("OpeningTags")
+        self.fen_index = fieldnames.index("FEN")
+        self.moves_index = fieldnames.index("Moves")
+        self.offensive_fen_index = (
+            fieldnames.index(OFFENSIVE_FEN_FIELD)
+            if OFFENSIVE_FEN_FIELD in fieldnames
+            else None
+        )
+        self.num_fields = len(fieldnames)
+
+        self.min_rating = min((f.min_rating for f in filters.values()), default=0)
+        self.max_rating = max((f.max_rating for f in filters.values()), default=0)
+        self.min_popularity = min(
+            (f.min_popularity for f in filters.values()), default=0
+        )
+        self.min_plays = min((f.min_plays for f in filters.values()), default=0)
+
+        self.ranges: List[Tuple[int, int, int, int]] = []
+        # Entries are (filter_name, range_id, opening_tag).
+        self.untagged: List[Tuple[str, int, Optional[str]]] = []
+        self.by_theme: Dict[str, List[Tuple[str, int, Optional[str]]]] = {}
+        for filter_name, filter in filters.items():
+            filter_range = (
+                filter.min_rating,
+                filter.max_rating,
+                filter.min_popularity,
+                filter.min_plays,
+            )
+            if filter_range not in self.ranges:
+                self.ranges.append(filter_range)
+            entry = (
+                filter_name,
+                self.ranges.index(filter_range),
+                filter.puzzle_opening_tag.lower()
+                if filter.puzzle_opening_tag
+                else None,
+            )
+            if filter.puzzle_theme_tag:
+                self.by_theme.setdefault(filter.puzzle_theme_tag.lower(), []).append(
+                    entry
+                )
+            else:
+                self.untagged.append(entry)
+
+    def parse_line(self, line: bytes) -> Optional[List[str]]:
+        """Split a raw CSV data line into fields, or None if it is not a row."""
+        if b'"' in line:
+            values = next(csv.reader([line.decode("utf-8")]), [])
+        else:
+            values = line.rstrip(b"\r\n").decode("utf-8").split(",")
+        if len(values) < self.num_fields:
+            return None
+        return values
+
+    def output_line(self, line: bytes, values: List[str]) -> bytes:
+        """The line to write for a matching row, with its offensive FEN."""
+        if self.offensive_fen_index is not None:
+            return _terminate_line(line)
+        fen = compute_offensive_fen(
+            values[self.fen_index], values[self.moves_index].split()[0]
+        )
+        return line.rstrip(b"\r\n") + b"," + fen.encode("utf-8") + b"\n"
+
+    def filter_mask(self, matches: List[str]) -> int:
+        mask = 0
+        for filter_name in matches:
+            mask |= 1 << self.filter_bits[filter_name]
+        return mask
+
+    def match(self, values: List[str]) -> List[str]:
+        """Return the names of the filters matching a row of raw CSV fields."""
+        rating = int(values[self.rating_index])
+        if not self.min_rating <= rating <= self.max_rating:
+            return []
+        popularity = int(values[self.popularity_index])
+        if popularity < self.min_popularity:
+            return []
+        plays = int(values[self.plays_index])
+        if plays < self.min_plays:
+            return []
+
+        candidates = list(self.untagged)
+        if self.by_theme:
+            # A theme listed twice must not match (and write) a row twice.
+            themes = dict.fromkeys(values[self.themes_index].lower().split())
+            for theme in themes:
+                candidates.extend(self.by_theme.get(theme, ()))
+        if not candidates:
+            return []
+
+        range_results: Dict[int, bool] = {}
+        opening_tags: Optional[set] = None
+        matches = []
+        for filter_name, range_id, opening_tag in candidates:
+            in_range = range_results.get(range_id)
+            if in_range is None:
+                min_rating, max_rating, min_popularity, min_plays = self.ranges[
+                    range_id
+                ]
+                in_range = (
+                    min_rating <= rating <= max_rating
+                    and popularity >= min_popularity
+                    and plays >= min_plays
+                )
+                range_results[range_id] = in_range
+            if not in_range:
+                continue
+            if opening_tag is not None:
+                if opening_tags is None:
+                    opening_tags = set(values[self.opening_tags_index].lower().split())
+                if opening_tag not in opening_tags:
+                    continue
+            matches.append(filter_name)
+        return matches
+
+
+def is_compressed_input(input_file: str) -> bool:
+    return input_file.endswith(COMPRESSED_SUFFIXES)
+
+
+def find_puzzle_input(input_file: str = PUZZLE_INPUT_FILE) -> str:
+    """input_file if it exists, else a compressed copy of it next to it."""
+    if os.path.exists(input_file):
+        return input_file
+    for suffix in COMPRESSED_SUFFIXES:
+        if os.path.exists(input_file + suffix):
+            return input_file + suffix
+    return input_file
+
+
+class ThreadedDecompressor(io.RawIOBase):
+    """Reads a decompressing stream on a background thread.
+
+    zlib, bz2 and zstd release the GIL while they work, so decompressing the
+    next blocks overlaps with parsing and filtering the current one. At most
+    `max_blocks` decompressed blocks are buffered. `on_eof` runs when the
+    stream is exhausted; an exception from it is raised to the reader in
+    place of the end of the stream.
+    """
+
+    def __init__(
+        self,
+        stream: BinaryIO,
+        source: BinaryIO,
+        block_size: int = DECOMPRESS_BLOCK_SIZE,
+        max_blocks: int = DECOMPRESS_QUEUE_BLOCKS,
+        on_eof: Optional[Callable[[], None]] = None,
+    ):
+        super().__init__()
+        self.stream = stream
+        self.source = source
+        self.on_eof = on_eof
+        self.block_size = block_size
+        self.blocks: "queue.Queue[Optional[bytes]]" = queue.Queue(max_blocks)
+        self.pending = memoryview(b"")
+        self.compressed_bytes = 0
+        self.error: Optional[BaseException] = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.stream.read(self.block_size)
+                self.compressed_bytes = self.source.tell()
+                if not block:
+                    if self.on_eof is not None:
+                        self.on_eof()
+                    break
+                self._put(block)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def _put(self, block: Optional[bytes]):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self.pending:
+            block = self.blocks.get()
+            if block is None:
+                # Leave the end marker for any later read.
+                self.blocks.put(None)
+                if self.error is not None:
+                    raise self.error
+                return 0
+            self.pending = memoryview(block)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
+
+class ZstdFrameReader:
+    """Decompresses a .zst file frame by frame with zstandard.
+
+    Unlike zstandard's stream_reader, which ends quietly at the end of the
+    input, this raises EOFError when the input stops inside a frame, so a
+    truncated dump is never read as a complete one.
+    """
+
+    def __init__(self, decompressor, source: BinaryIO):
+        self.decompressor = decompressor
+        self.source = source
+        self.frame = decompressor.decompressobj()
+        self.in_frame = False
+
+    def read(self, size: int = -1) -> bytes:
+        # Returns whatever one read of the source decompresses to, which is
+        # fine for ThreadedDecompressor; size is only a hint.
+        while True:
+            data = self.source.read(READ_BUFFER_SIZE)
+            if not data:
+                if self.in_frame:
+                    raise EOFError("compressed file ended before the end of a frame")
+                return b""
+            block = b""
+            while data:
+                self.in_frame = True
+                block += self.frame.decompress(data)
+                if not self.frame.eof:
+                    break
+                # Concatenated frames: start the next one on what is left.
+                data = self.frame.unused_data
+                self.frame = self.decompressor.decompressobj()
+                self.in_frame = False
+            if block:
+                return block
+
+    def close(self):
+        pass
+
+
+class PuzzleInput:
+    """A puzzle dump opened for a single streaming pass.
+
+    Plain CSVs are read with a large buffer. .zst, .gz and .bz2 dumps are
+    decompressed on a background thread, or for .zst without the zstandard
+    package, by a `zstd` process. position() is how far into the file on disk
+    the read has got, for progress reporting.
+    """
+
+    def __init__(self, input_file: str):
+        self.input_file = input_file
+        self.size = os.path.getsize(input_file)
+        self.source = open(input_file, "rb")
+        self.process: Optional[subprocess.Popen] = None
+        self.decompressor: Optional[ThreadedDecompressor] = None
+        if not is_compressed_input(input_file):
+            self.stream: BinaryIO = io.BufferedReader(
+                self.source, buffer_size=READ_BUFFER_SIZE
+            )
+            return
+
+        if input_file.endswith(".gz"):
+            decompressed = gzip.GzipFile(fileobj=self.source, mode="rb")
+        elif input_file.endswith(".bz2"):
+            decompressed = bz2.BZ2File(self.source, mode="rb")
+        else:
+            decompressed = self._open_zstd()
+        self.decompressor = ThreadedDecompressor(
+            decompressed, self.source, on_eof=self._check_process
+        )
+        self.stream = io.BufferedReader(self.decompressor, buffer_size=READ_BUFFER_SIZE)
+
+    def _open_zstd(self) -> BinaryIO:
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+        if zstandard is not None:
+            # Lichess dumps are compressed with --long, which needs a larger
+            # window than zstandard allows by default.
+            return ZstdFrameReader(
+                zstandard.ZstdDecompressor(max_window_size=1 << 31), self.source
+            )
+        if shutil.which("zstd") is None:
+            raise ImportError(
+                ".zst input requires the zstandard package or the zstd command"
+            )
+        # The zstd process reads the same open file, so source.tell() still
+        # reports how far it has got.
+        self.process = subprocess.Popen(
+            ["zstd", "-dc", "--long=31"], stdin=self.source, stdout=subprocess.PIPE
+        )
+        return self.process.stdout
+
+    def _check_process(self):
+        """Fail the read if the zstd process did not decompress the whole
+        dump, so a truncated or corrupt file is never taken as complete."""
+        if self.process is not None and self.process.wait() != 0:
+            raise OSError(
+                f"zstd failed to decompress {self.input_file} "
+                f"(exit status {self.process.returncode})"
+            )
+
+    def position(self) -> int:
+        if self.decompressor is not None:
+            return self.decompressor.compressed_bytes
+        return self.stream.tell()
 
+    def close(self):
+        self.stream.close()
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        self.source.close()
 
-def filter_puzzles():
-    filtered_puzzles: Dict[str, List[str]] = {}
-    with open(PUZZLE_INPUT_FILE, "r") as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            if i % 1000 == 0:
-                print(f"Processed {i} rows")
-            puzzle = Puzzle.from_dict(row)
-            for filter_name, filter in PUZZLE_FILTER_MAPPING.items():
-                if puzzle.apply_filter(filter):
-                    filtered_puzzles.setdefault(filter_name, []).append(row)
-
-    for filter_name, puzzles in filtered_puzzles.items():
-        print(f"{filter_name}: {len(puzzles)}")
-        output_file = f"puzzles/{filter_name}.csv"
-        with open(output_file, "w") as out:
-            writer = csv.DictWriter(out, fieldnames=reader.fieldnames)
-            writer.writeheader()
-            for row in puzzles:
-                writer.writerow(row)
+    def __enter__(self) -> "PuzzleInput":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_puzzle_input(input_file: str) -> PuzzleInput:
+    return PuzzleInput(input_file)
+
+
+def filter_puzzles(
+    input_file: str = PUZZLE_INPUT_FILE,
+    output_dir: str = PUZZLE_OUTPUT_DIR,
+    num_workers: int = 1,
+    delta: bool = False,
+    filters: Dict[str, PuzzleFilter] = PUZZLE_FILTER_MAPPING,
+):
+    """Filter the dump into one CSV per filter in filters.
+
+    Every full run records the fingerprints of the dump it read. With
+    delta, the outputs of the previous run are instead patched with only
+    the puzzles added, removed or changed since, and only the affected
+    stores are rebuilt. Without fingerprints, or after the filters change,
+    a delta run does a full filter.
+    """
+    if delta:
+        fingerprints = load_fingerprints(output_dir, filters)
+        if fingerprints is not None:
+            _filter_puzzles_delta(
+                input_file, output_dir, fingerprints, num_workers, filters
+            )
+            return
+
+    # The outputs are about to be rewritten, so fingerprints of the old ones
+    # must not survive a run that fails half way.
+    remove_fingerprints(output_dir)
+    with instrumentation.stage("filter") as recorder:
+        # Compressed dumps cannot be split into byte ranges, so they are
+        # filtered in one pass with decompression on its own thread.
+        if num_workers > 1 and not is_compressed_input(input_file):
+            counts, fingerprints = _filter_puzzles_parallel(
+                input_file, output_dir, num_workers, recorder, filters
+            )
+        else:
+            counts, fingerprints = _filter_puzzles_serial(
+                input_file, output_dir, recorder, filters
+            )
+
+    for filter_name, count in counts.items():
+        print(f"{filter_name}: {count}")
+
+    save_fingerprints(output_dir, fingerprints, filters)
+    build_filtered_stores(output_dir, num_workers, list(filters))
+
+
+def build_filtered_stores(
+    output_dir: str = PUZZLE_OUTPUT_DIR,
+    num_workers: int = 1,
+    filter_names: Optional[List[str]] = None,
+):
+    """Write a columnar puzzle store and a tag index next to each filtered CSV."""
+    # Imported here because puzzle_store depends on Puzzle from this module.
+    from puzzle_index import TagIndex
+    from puzzle_store import build_puzzle_store
+
+    csv_files = [
+        os.path.join(output_dir, f"{filter_name}.csv")
+        for filter_name in (
+            PUZZLE_FILTER_MAPPING if filter_names is None else filter_names
+        )
+    ]
+    with instrumentation.stage("build_stores") as recorder:
+        recorder.add(bytes_read=sum(os.path.getsize(f) for f in csv_files))
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                store_files = list(executor.map(build_puzzle_store, csv_files))
+        else:
+            store_files = [build_puzzle_store(csv_file) for csv_file in csv_files]
+    for store_file in store_files:
+        print(f"Wrote {store_file}")
+
+    with instrumentation.stage("build_tag_indexes"):
+        for csv_file in csv_files:
+            TagIndex.load(csv_file)
+
+
+@dataclass
+class Fingerprints:
+    """Sorted puzzle ids with a hash of each one's dump row and a
+    bitmask of the filters (in filter order) it matched."""
+
+    ids: np.ndarray
+    hashes: np.ndarray
+    masks: np.ndarray
+
+
+class FingerprintBuilder:
+    """Collects the fingerprint of every dump row as it is filtered."""
+
+    def __init__(self):
+        self.ids: List[bytes] = []
+        self.hashes: List[bytes] = []
+        self.masks: List[int] = []
+        self.parts: List[Fingerprints] = []
+
+    def add(self, plan: FilterPlan, line: bytes, values: List[str], matches: List[str]):
+        self.ids.append(_line_id(line))
+        self.hashes.append(_content_hash(values))
+        self.masks.append(plan.filter_mask(matches))
+        # Kept as arrays in batches; a list of millions of small objects
+        # would cost several times the memory.
+        if len(self.ids) == FINGERPRINT_BATCH_ROWS:
+            self._flush()
+
+    def extend(self, fingerprints: Fingerprints):
+        self._flush()
+        self.parts.append(fingerprints)
+
+    def _flush(self):
+        if self.ids:
+            self.parts.append(
+                Fingerprints(
+                    np.array(self.ids, dtype=bytes),
+                    np.frombuffer(b"".join(self.hashes), dtype="<u8"),
+                    np.array(self.masks, dtype=np.uint64),
+                )
+            )
+            self.ids, self.hashes, self.masks = [], [], []
+
+    def unsorted(self) -> Fingerprints:
+        """The fingerprints so far, in dump order."""
+        self._flush()
+        if not self.parts:
+            return Fingerprints(
+                np.zeros(0, dtype="S1"),
+                np.zeros(0, dtype="<u8"),
+                np.zeros(0, dtype=np.uint64),
+            )
+        return Fingerprints(
+            np.concatenate([part.ids for part in self.parts]),
+            np.concatenate([part.hashes for part in self.parts]),
+            np.concatenate([part.masks for part in self.parts]),
+        )
+
+    def finish(self) -> Fingerprints:
+        fingerprints = self.unsorted()
+        return _sorted_fingerprints(
+            fingerprints.ids, fingerprints.hashes, fingerprints.masks
+        )
+
+
+def _filter_config(filters: Dict[str, PuzzleFilter]) -> str:
+    return f"{FINGERPRINT_VERSION}:{list(filters.items())!r}"
+
+
+def _line_id(line: bytes) -> bytes:
+    return line.split(b",", 1)[0]
+
+
+def _content_hash(values: List[str]) -> bytes:
+    # Every field, counters included, so a delta run rewrites a row whenever
+    # a full run would write it differently.
+    content = "\x1f".join(values)
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest()
+
+
+def _sorted_fingerprints(
+    ids: np.ndarray, hashes: np.ndarray, masks: np.ndarray
+) -> Fingerprints:
+    order = np.argsort(ids, kind="stable")
+    return Fingerprints(ids[order], hashes[order], masks[order])
+
+
+def load_fingerprints(
+    output_dir: str, filters: Dict[str, PuzzleFilter] = PUZZLE_FILTER_MAPPING
+) -> Optional[Fingerprints]:
+    """The fingerprints of the last filter run, or None if they are missing,
+    were recorded for other filters, or an output has gone missing."""
+    for filter_name in filters:
+        if not os.path.exists(os.path.join(output_dir, f"{filter_name}.csv")):
+            return None
+    try:
+        with np.load(os.path.join(output_dir, FINGERPRINT_FILE)) as data:
+            if str(data["config"]) != _filter_config(filters):
+                return None
+            return Fingerprints(data["ids"], data["hashes"], data["masks"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_fingerprints(
+    output_dir: str,
+    fingerprints: Fingerprints,
+    filters: Dict[str, PuzzleFilter] = PUZZLE_FILTER_MAPPING,
+):
+    fingerprint_file = os.path.join(output_dir, FINGERPRINT_FILE)
+    tmp_file = f"{fingerprint_file}.tmp{os.getpid()}"
+    with open(tmp_file, "wb") as f:
+        np.savez(
+            f,
+            config=np.array(_filter_config(filters)),
+            ids=fingerprints.ids,
+            hashes=fingerprints.hashes,
+            masks=fingerprints.masks,
+        )
+    os.replace(tmp_file, fingerprint_file)
+
+
+def remove_fingerprints(output_dir: str):
+    try:
+        os.remove(os.path.join(output_dir, FINGERPRINT_FILE))
+    except FileNotFoundError:
+        pass
+
+
+@dataclass
+class PuzzleUpdate:
+    """An added or changed puzzle found by a delta run, with its dump line."""
+
+    mask: int
+    old_mask: int
+    content_hash: bytes
+    line: bytes
+    values: List[str]
+    # Computed on first use, and only when the position is new or changed.
+    output_line: Optional[bytes] = None
+
+
+def _filter_puzzles_delta(
+    input_file: str,
+    output_dir: str,
+    previous: Fingerprints,
+    num_workers: int,
+    filters: Dict[str, PuzzleFilter],
+):
+    """Patch the filtered outputs with the puzzles that changed since the
+    fingerprints were recorded.
+
+    The dump is read once to fingerprint every row. Only added and changed
+    puzzles get new output rows, and only those whose FEN or Moves changed
+    replay their first move, which is the expensive part; the others keep
+    their existing OffensiveFEN. Each output keeps its existing order:
+    removed puzzles are dropped, changed ones replaced in place and new
+    matches appended.
+    """
+    seen = np.zeros(len(previous.ids), dtype=bool)
+    changed = np.zeros(len(previous.ids), dtype=bool)
+    updates: Dict[bytes, PuzzleUpdate] = {}
+
+    with instrumentation.stage("filter_delta") as recorder:
+        with open_puzzle_input(input_file) as puzzle_input:
+            plan = FilterPlan(filters, _parse_header(puzzle_input.stream.readline()))
+            batch: List[bytes] = []
+            for line in puzzle_input.stream:
+                batch.append(line)
+                if len(batch) == FINGERPRINT_BATCH_ROWS:
+                    _diff_batch(plan, batch, previous, seen, changed, updates)
+                    recorder.rows += len(batch)
+                    recorder.bytes_read = puzzle_input.position()
+                    recorder.progress(puzzle_input.size)
+                    batch = []
+            _diff_batch(plan, batch, previous, seen, changed, updates)
+            recorder.rows += len(batch)
+            recorder.bytes_read = puzzle_input.size
+
+        gone = ~seen
+        removed = dict(zip(previous.ids[gone].tolist(), previous.masks[gone].tolist()))
+        num_changed = int(changed.sum())
+        print(
+            f"{len(updates) - num_changed} added, {len(removed)} removed, "
+            f"{num_changed} changed"
+        )
+
+        patched = []
+        for filter_name, bit in plan.filter_bits.items():
+            flag = 1 << bit
+            if any(mask & flag for mask in removed.values()) or any(
+                (update.mask | update.old_mask) & flag for update in updates.values()
+            ):
+                output_file = os.path.join(output_dir, f"{filter_name}.csv")
+                count = _patch_output(plan, output_file, flag, removed, updates)
+                patched.append(filter_name)
+                print(f"{filter_name}: {count}")
+
+        keep = seen & ~changed
+        save_fingerprints(
+            output_dir,
+            _sorted_fingerprints(
+                np.concatenate(
+                    [previous.ids[keep], np.array(list(updates), dtype=bytes)]
+                )
+                if updates
+                else previous.ids[keep],
+                np.concatenate(
+                    [
+                        previous.hashes[keep],
+                        np.frombuffer(
+                            b"".join(u.content_hash for u in updates.values()),
+                            "<u8",
+                        ),
+                    ]
+                ),
+                np.concatenate(
+                    [
+                        previous.masks[keep],
+                        np.array([u.mask for u in updates.values()], dtype=np.uint64),
+                    ]
+                ),
+            ),
+            filters,
+        )
+
+    if patched:
+        build_filtered_stores(output_dir, num_workers, patched)
+
+
+def _diff_batch(
+    plan: FilterPlan,
+    lines: List[bytes],
+    previous: Fingerprints,
+    seen: np.ndarray,
+    changed: np.ndarray,
+    updates: Dict[bytes, PuzzleUpdate],
+):
+    """Mark a batch of dump lines as seen and collect the ones that differ."""
+    batch = FingerprintBuilder()
+    rows = []
+    for line in lines:
+        values = plan.parse_line(line)
+        if values is None:
+            continue
+        batch.add(plan, line, values, plan.match(values))
+        rows.append((line, values))
+    if not rows:
+        return
+    current = batch.unsorted()
+
+    positions = np.searchsorted(previous.ids, current.ids)
+    found = positions < len(previous.ids)
+    found[found] = previous.ids[positions[found]] == current.ids[found]
+    seen[positions[found]] = True
+    differs = ~found
+    differs[found] = (previous.hashes[positions[found]] != current.hashes[found]) | (
+        previous.masks[positions[found]] != current.masks[found]
+    )
+    changed[positions[found & differs]] = True
+
+    for i in np.flatnonzero(differs):
+        line, values = rows[i]
+        updates[bytes(current.ids[i])] = PuzzleUpdate(
+            mask=int(current.masks[i]),
+            old_mask=int(previous.masks[positions[i]]) if found[i] else 0,
+            content_hash=current.hashes[i].tobytes(),
+            line=line,
+            values=values,
+        )
+
+
+def _update_line(
+    plan: FilterPlan, update: PuzzleUpdate, old_line: Optional[bytes]
+) -> bytes:
+    """The output row for an update, replacing old_line if it had one."""
+    if old_line is not None and plan.offensive_fen_index is None:
+        old_values = plan.parse_line(old_line)
+        if (
+            old_values is not None
+            and old_values[plan.fen_index] == update.values[plan.fen_index]
+            and old_values[plan.moves_index] == update.values[plan.moves_index]
+        ):
+            # Same position, so the same offensive FEN: no move to replay.
+            offensive_fen = old_values[-1].encode("utf-8")
+            return update.line.rstrip(b"\r\n") + b"," + offensive_fen + b"\n"
+    if update.output_line is None:
+        update.output_line = plan.output_line(update.line, update.values)
+    return update.output_line
+
+
+def _patch_output(
+    plan: FilterPlan,
+    output_file: str,
+    flag: int,
+    removed: Dict[bytes, int],
+    updates: Dict[bytes, PuzzleUpdate],
+) -> int:
+    """Rewrite one filtered CSV with removed rows dropped, changed rows
+    replaced where they were and newly matching rows appended.
+
+    An update is appended only if its puzzle was not already in the file,
+    whatever the fingerprints say, so outputs never gain duplicate rows.
+    """
+    count = 0
+    # Updated puzzles already written, in place of their old row.
+    written = set()
+    tmp_file = f"{output_file}.tmp{os.getpid()}"
+    with open(output_file, "rb") as old, open(tmp_file, "wb") as out:
+        out.write(old.readline())
+        for line in old:
+            puzzle_id = _line_id(line)
+            if puzzle_id in removed:
+                continue
+            update = updates.get(puzzle_id)
+            if update is None:
+                out.write(line)
+            elif puzzle_id in written or not update.mask & flag:
+                continue
+            else:
+                out.write(_update_line(plan, update, line))
+                written.add(puzzle_id)
+            count += 1
+        for puzzle_id, update in updates.items():
+            if update.mask & flag and puzzle_id not in written:
+                out.write(_update_line(plan, update, None))
+                count += 1
+    os.replace(tmp_file, output_file)
+    return count
+
+
+def _filter_puzzles_serial(
+    input_file: str,
+    output_dir: str,
+    recorder: StageRecorder,
+    filters: Dict[str, PuzzleFilter] = PUZZLE_FILTER_MAPPING,
+) -> Tuple[Dict[str, int], Fingerprints]:
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {filter_name: 0 for filter_name in filters}
+    fingerprints = FingerprintBuilder()
+    rows = 0
+    with open_puzzle_input(input_file) as puzzle_input:
+        f = puzzle_input.stream
+        header = f.readline()
+        plan = FilterPlan(filters, _parse_header(header))
+        outputs = _open_filter_outputs(output_dir, header, plan.filter_names)
+        try:
+            for rows, line in enumerate(f, 1):
+                # Checking the clock every row would cost more than the filter.
+                if rows & 0x3FFF == 0:
+                    recorder.rows = rows
+                    recorder.bytes_read = puzzle_input.position()
+                    recorder.progress(puzzle_input.size)
+                _write_matches(plan, line, outputs, counts, fingerprints)
+        finally:
+            for out in outputs.values():
+                out.close()
+    recorder.rows, recorder.bytes_read = rows, puzzle_input.size
+    return counts, fingerprints.finish()
+
+
+def _filter_puzzles_parallel(
+    input_file: str,
+    output_dir: str,
+    num_workers: int,
+    recorder: StageRecorder,
+    filters: Dict[str, PuzzleFilter] = PUZZLE_FILTER_MAPPING,
+) -> Tuple[Dict[str, int], Fingerprints]:
+    """Filter the input in byte-range chunks on a process pool.
+
+    Each worker streams its chunk's matches into per-filter part files, which
+    are appended to the final outputs in chunk order, so the result is
+    identical to the serial path. At most FILTER_CHUNKS_PER_WORKER chunks per
+    worker are in flight, which bounds the part files on disk when an early
+    chunk is slow.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with open(input_file, "rb") as f:
+        header = f.readline()
+        data_start = f.tell()
+    plan = FilterPlan(filters, _parse_header(header))
+    ranges = _chunk_ranges(input_file, data_start, FILTER_CHUNK_SIZE)
+
+    counts = {filter_name: 0 for filter_name in filters}
+    fingerprints = FingerprintBuilder()
+    parts_dir = tempfile.mkdtemp(prefix=".filter-", dir=output_dir)
+    outputs = _open_filter_outputs(output_dir, header, plan.filter_names)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            tasks = (
+                (input_file, data_start, start, end, plan, parts_dir, i)
+                for i, (start, end) in enumerate(ranges)
+            )
+            pending: Deque[Future] = deque(
+                executor.submit(_filter_chunk, task)
+                for task in itertools.islice(
+                    tasks, num_workers * FILTER_CHUNKS_PER_WORKER
+                )
+            )
+            for i in range(len(ranges)):
+                future = pending.popleft()
+                for task in itertools.islice(tasks, 1):
+                    pending.append(executor.submit(_filter_chunk, task))
+                chunk_rows, chunk_counts, chunk_fingerprints = future.result()
+                fingerprints.extend(chunk_fingerprints)
+                for filter_name, count in chunk_counts.items():
+                    part_file = _part_file_name(parts_dir, filter_name, i)
+                    with open(part_file, "rb") as part:
+                        shutil.copyfileobj(part, outputs[filter_name])
+                    os.remove(part_file)
+                    counts[filter_name] += count
+                start, end = ranges[i]
+                recorder.add(rows=chunk_rows, bytes_read=end - start)
+                recorder.progress(ranges[-1][1])
+    finally:
+        for out in outputs.values():
+            out.close()
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    return counts, fingerprints.finish()
+
+
+def _filter_chunk(
+    task: Tuple[str, int, int, int, FilterPlan, str, int]
+) -> Tuple[int, Dict[str, int], Fingerprints]:
+    """Filter one byte range into part files; returns the rows read, the
+    matches per filter and the rows' fingerprints in file order."""
+    input_file, data_start, start, end, plan, parts_dir, chunk_index = task
+    counts = {filter_name: 0 for filter_name in plan.filter_names}
+    fingerprints = FingerprintBuilder()
+    rows = 0
+    parts = {
+        filter_name: open(_part_file_name(parts_dir, filter_name, chunk_index), "wb")
+        for filter_name in plan.filter_names
+    }
+    try:
+        with open(input_file, "rb") as f:
+            # A line belongs to the chunk it starts in, so skip the partial
+            # line (or the boundary newline) owned by the previous chunk.
+            if start > data_start:
+                f.seek(start - 1)
+                f.readline()
+            else:
+                f.seek(start)
+            pos = f.tell()
+            while pos < end:
+                line = f.readline()
+                if not line:
+                    break
+                pos += len(line)
+                rows += 1
+                _write_matches(plan, line, parts, counts, fingerprints)
+    finally:
+        for part in parts.values():
+            part.close()
+    return rows, counts, fingerprints.unsorted()
+
+
+def _write_matches(
+    plan: FilterPlan,
+    line: bytes,
+    outputs: Dict[str, BinaryIO],
+    counts: Dict[str, int],
+    fingerprints: FingerprintBuilder,
+):
+    values = plan.parse_line(line)
+    if values is None:
+        return
+    matches = plan.match(values)
+    fingerprints.add(plan, line, values, matches)
+    if not matches:
+        return
+    output_line = plan.output_line(line, values)
+    for filter_name in matches:
+        outputs[filter_name].write(output_line)
+        counts[filter_name] += 1
+
+
+def _chunk_ranges(
+    input_file: str, data_start: int, chunk_size: int
+) -> List[Tuple[int, int]]:
+    size = os.path.getsize(input_file)
+    return [
+        (start, min(start + chunk_size, size))
+        for start in range(data_start, size, chunk_size)
+    ]
+
+
+def _part_file_name(parts_dir: str, filter_name: str, chunk_index: int) -> str:
+    return os.path.join(parts_dir, f"{filter_name}.{chunk_index:06d}.part")
+
+
+def _open_filter_outputs(
+    output_dir: str, header: bytes, filter_names: List[str]
+) -> Dict[str, BinaryIO]:
+    header = _terminate_line(header)
+    if OFFENSIVE_FEN_FIELD not in _parse_header(header):
+        header = header.rstrip(b"\r\n") + f",{OFFENSIVE_FEN_FIELD}\n".encode("utf-8")
+    outputs = {}
+    for filter_name in filter_names:
+        out = open(os.path.join(output_dir, f"{filter_name}.csv"), "wb")
+        out.write(header)
+        outputs[filter_name] = out
+    return outputs
+
+
+def _parse_header(header: bytes) -> List[str]:
+    return next(csv.reader([header.decode("utf-8")]))
+
+
+def _terminate_line(line: bytes) -> bytes:
+    return line if line.endswith(b"\n") else line + b"\n"
 
 
 @dataclass
 class Puzzle:
+    # Puzzles are created by the million when filtering and as views over a
+    # puzzle store, so they carry no per-instance __dict__.
+    __slots__ = (
+        "puzzle_id",
+        "fen",
+        "moves",
+        "rating",
+        "rating_deviation",
+        "popularity",
+        "plays",
+        "themes",
+        "opening_tags",
+        "offensive_fen",
+    )
+
     puzzle_id: str
     fen: str
     moves: List[str]
@@ -86,6 +1078,7 @@ class Puzzle:
     plays: int
     themes: str
     opening_tags: str
+    offensive_fen: Optional[str]
 
     # Example Row
     # {'PuzzleId': '013h1', 'FEN': 'r1bqk1nr/1p3ppp/p3p3/3pP3/1b1PP3/2N5/PP4PP/R1BQKB1R b KQkq - 0 9', 'Moves': 'd5e4 d1a4 c8d7 a4b4', 'Rating': '1206', 'RatingDeviation': '128', 'Popularity': '83', 'NbPlays': '28', 'Themes': 'advantage fork opening short', 'GameUrl': 'https://lichess.org/3L3zhonx/black#18', 'OpeningTags': 'Sicilian_Defense Sicilian_Defense_McDonnell_Attack'}
@@ -101,6 +1094,7 @@ class Puzzle:
         plays: int,
         themes: str,
         opening_tags: str,
+        offensive_fen: Optional[str] = None,
     ):
         self.puzzle_id = puzzle_id
         self.fen = fen
@@ -111,6 +1105,7 @@ class Puzzle:
         self.plays = int(plays)
         self.themes = themes.lower() if themes else ""
         self.opening_tags = opening_tags.lower() if opening_tags else ""
+        self.offensive_fen = offensive_fen or None
 
     @classmethod
     def from_dict(cls, d: Dict[str, str]) -> "Puzzle":
@@ -124,6 +1119,7 @@ class Puzzle:
             d["NbPlays"],
             d["Themes"],
             d["OpeningTags"],
+            d.get(OFFENSIVE_FEN_FIELD),
         )
 
     def apply_filter(self, filter: PuzzleFilter) -> bool:
@@ -133,51 +1129,176 @@ class Puzzle:
             and self.plays >= filter.min_plays
             and (
                 filter.puzzle_theme_tag is None
-                or filter.puzzle_theme_tag in self.themes
+                or filter.puzzle_theme_tag.lower() in self.themes.split()
             )
             and (
                 filter.puzzle_opening_tag is None
-                or filter.puzzle_opening_tag in self.opening_tags
+                or filter.puzzle_opening_tag.lower() in self.opening_tags.split()
             )
         )
 
-    def generate_puzzle_position(self, defensive: bool) -> Tuple[str, str]:
-        game = chess.pgn.Game()
-        game.setup(self.fen)
-
+    def generate_puzzle_position(self, defensive: bool) -> str:
         if defensive:
             return self.fen
+        if self.offensive_fen is None:
+            self.offensive_fen = compute_offensive_fen(self.fen, self.moves[0])
+        return self.offensive_fen
+
+
+def compute_offensive_fen(fen: str, first_move: str) -> str:
+    """The puzzle position after the opponent's first move has been played."""
+    # Imported lazily so that serving puzzles with precomputed positions does
+    # not load python-chess at all.
+    import chess
+
+    board = chess.Board(fen)
+    board.push(chess.Move.from_uci(first_move))
+    return board.fen()
+
+
+PGN_OUTPUT_DIR = "puzzle_packs"
+
+
+@dataclass
+class PgnPackSpec:
+    """One PGN pack to cut from a puzzle CSV: how many puzzles, and
+    optionally a filter the puzzles must pass."""
+
+    output_file: str
+    num_puzzles: int = 32
+    puzzle_filter: Optional[PuzzleFilter] = None
+
+
+class Reservoir:
+    """A uniform sample of `size` items from a stream of unknown length.
+
+    Uses Li's Algorithm L, which draws random numbers only when an item is
+    taken, so offering an item that is skipped costs one comparison.
+    """
+
+    def __init__(self, size: int, rng: random.Random):
+        self.size = size
+        self.rng = rng
+        self.items: List[bytes] = []
+        self.seen = 0
+        self.weight = 1.0
+        # Index of the next item to take once the reservoir is full.
+        self.next_index = size - 1
+        if size:
+            self._advance()
+
+    def _advance(self):
+        self.weight *= math.exp(math.log(1.0 - self.rng.random()) / self.size)
+        skip = math.floor(math.log(1.0 - self.rng.random()) / math.log1p(-self.weight))
+        self.next_index += skip + 1
+
+    def offer(self, item: bytes):
+        if len(self.items) < self.size:
+            self.items.append(item)
+        elif self.seen == self.next_index:
+            self.items[self.rng.randrange(self.size)] = item
+            self._advance()
+        self.seen += 1
+
 
-        node = game.add_variation(chess.Move.from_uci(self.moves[0]))
-        return node.board().fen()
+def generate_pgn_packs(
+    input_file: str, specs: List[PgnPackSpec], seed: Optional[int] = None
+) -> Dict[str, List[str]]:
+    """Sample every pack in `specs` from one streaming read of input_file.
+
+    input_file may be a filtered CSV or a full dump (compressed or not).
+    Only the sampled rows are kept in memory and parsed. Packs with the same
+    filter are cut from one shared sample, so they never repeat a puzzle
+    between them. Returns the PGN entries of each pack by output file.
+    """
+    rng = random.Random(seed)
+    # Packs sharing a filter draw from one reservoir; "" is the unfiltered one.
+    groups: Dict[str, List[PgnPackSpec]] = {}
+    filters: Dict[str, PuzzleFilter] = {}
+    for spec in specs:
+        key = "" if spec.puzzle_filter is None else repr(spec.puzzle_filter)
+        groups.setdefault(key, []).append(spec)
+        if spec.puzzle_filter is not None:
+            filters[key] = spec.puzzle_filter
+    reservoirs = {
+        key: Reservoir(sum(spec.num_puzzles for spec in group), rng)
+        for key, group in groups.items()
+    }
+    unfiltered = reservoirs.get("")
+
+    with open_puzzle_input(input_file) as puzzle_input:
+        header = puzzle_input.stream.readline()
+        fieldnames = _parse_header(header)
+        plan = FilterPlan(filters, fieldnames) if filters else None
+        for line in puzzle_input.stream:
+            if not line.strip():
+                continue
+            if unfiltered is not None:
+                unfiltered.offer(line)
+            if plan is not None:
+                values = plan.parse_line(line)
+                if values is not None:
+                    for key in plan.match(values):
+                        reservoirs[key].offer(line)
+
+    pgns = {}
+    for key, group in groups.items():
+        reservoir = reservoirs[key]
+        if len(reservoir.items) < reservoir.size:
+            raise ValueError(
+                f"{input_file} has {len(reservoir.items)} matching puzzles, "
+                f"{reservoir.size} requested"
+            )
+        start = 0
+        for spec in group:
+            lines = reservoir.items[start : start + spec.num_puzzles]
+            start += spec.num_puzzles
+            pgns[spec.output_file] = [
+                _pgn_entry(line, fieldnames, rng) for line in lines
+            ]
+    return pgns
+
+
+def _pgn_entry(line: bytes, fieldnames: List[str], rng: random.Random) -> str:
+    puzzle = Puzzle.from_dict(
+        dict(zip(fieldnames, next(csv.reader([line.decode("utf-8")]))))
+    )
+    fen = puzzle.generate_puzzle_position(rng.random() > 0.5)
+    return f'[FEN "{fen}"]\n[SITE "https://lichess.org/training/{puzzle.puzzle_id}"]\n\n*\n\n'
+
+
+def write_pgn_packs(
+    input_file: str, specs: List[PgnPackSpec], seed: Optional[int] = None
+):
+    with instrumentation.stage("generate_pgn") as recorder:
+        pgns = generate_pgn_packs(input_file, specs, seed)
+        recorder.add(bytes_read=os.path.getsize(input_file))
+
+    for output_file, entries in pgns.items():
+        # Leave an unchanged pack untouched so rebuilds only rewrite what
+        # changed.
+        data = "".join(entries).encode("utf-8")
+        if os.path.exists(output_file):
+            with open(output_file, "rb") as f:
+                if f.read() == data:
+                    print(f"Unchanged {output_file}")
+                    continue
+        os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+        with open(output_file, "wb") as f:
+            f.write(data)
+        print(f"Wrote {output_file}")
 
 
 def generate_puzzle_pack_pgn_strings(
-    input_file: str, num_puzzles: int = 32
+    input_file: str, num_puzzles: int = 32, seed: Optional[int] = None
 ) -> List[str]:
-    puzzles = []
-    with open(input_file, "r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            puzzle = Puzzle.from_dict(row)
-            puzzles.append(puzzle)
-
-    pgn_strings = []
-    for puzzle in random.sample(puzzles, num_puzzles):
-        fen = puzzle.generate_puzzle_position(coin_flip())
-        pgn_strings.append(
-            f'[FEN "{fen}"]\n[SITE "https://lichess.org/training/{puzzle.puzzle_id}"]\n\n*\n\n'
-        )
-    return pgn_strings
+    return generate_pgn_packs(input_file, [PgnPackSpec("", num_puzzles)], seed)[""]
 
 
 def generate_puzzle_pack_pgn_file(
-    input_file: str, output_file: str, num_puzzles: int = 32
+    input_file: str, output_file: str, num_puzzles: int = 32, seed: Optional[int] = None
 ):
-    pgn_strings = generate_puzzle_pack_pgn_strings(input_file, num_puzzles)
-    with open(output_file, "w") as f:
-        for pgn in pgn_strings:
-            f.write(pgn)
+    write_pgn_packs(input_file, [PgnPackSpec(output_file, num_puzzles)], seed)
 
 
 def main():
@@ -188,14 +1309,52 @@ def main():
     parser.add_argument(
         "command",
         type=str,
-        help="Command to run. Options: filter, generate",
+        help="Command to run. Options: filter, store, generate",
     )
 
     parser.add_argument(
         "--puzzle-type",
         type=str,
         default="middlegame",
-        help="Type of puzzle to generate",
+        help="Type of puzzle to generate: a filtered set in puzzles/, which is "
+        "also the pack name",
+    )
+
+    parser.add_argument(
+        "--num-packs",
+        type=int,
+        default=1,
+        help="Number of packs to generate, with no puzzle in more than one",
+    )
+
+    parser.add_argument(
+        "--source",
+        type=str,
+        default=None,
+        help="CSV to sample packs from instead of the --puzzle-type set, e.g. "
+        "the full dump",
+    )
+
+    parser.add_argument(
+        "--opening-tag",
+        type=str,
+        default=None,
+        help="Only sample puzzles with this Lichess opening tag",
+    )
+
+    parser.add_argument(
+        "--theme",
+        type=str,
+        default=None,
+        help="Only sample puzzles with this theme",
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=PGN_OUTPUT_DIR,
+        help="Directory for generated packs, named <puzzle-type>_<n>.pgn "
+        "(generate only; filter always writes to puzzles/)",
     )
 
     parser.add_argument(
@@ -205,16 +1364,96 @@ def main():
         help="Number of puzzles to generate",
     )
 
+    parser.add_argument(
+        "--input",
+        type=str,
+        default=PUZZLE_INPUT_FILE,
+        help="Lichess puzzle database CSV to filter, optionally .zst, .gz or .bz2",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes for filtering (1 = single process)",
+    )
+
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only re-filter puzzles added, removed or changed since the last "
+        "filter run, and patch the filtered CSVs in place",
+    )
+
+    parser.add_argument(
+        "--all-puzzles",
+        action="store_true",
+        help="Also filter puzzles/all.csv, every reasonably popular puzzle, for "
+        "PuzzleGenerator.query_puzzles; roughly doubles filter time and disk use",
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for sampling puzzles, so the same inputs give the same pack",
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="profiles",
+        default=None,
+        help="Write a cProfile pstats file per stage to this directory",
+    )
+
     args = parser.parse_args()
     command = args.command
+    instrumentation.configure(profile_dir=args.profile)
+    filters = PUZZLE_FILTER_MAPPING
+    if args.all_puzzles:
+        filters = {**PUZZLE_FILTER_MAPPING, **OPTIONAL_FILTER_MAPPING}
 
     if command == "filter":
-        filter_puzzles()
+        filter_puzzles(
+            find_puzzle_input(args.input),
+            PUZZLE_OUTPUT_DIR,
+            args.workers,
+            args.delta,
+            filters,
+        )
+
+    elif command == "store":
+        build_filtered_stores(PUZZLE_OUTPUT_DIR, args.workers, list(filters))
 
     elif command == "generate":
-        generate_puzzle_pack_pgn_file(
-            "puzzles/middlegame.csv", "puzzle_packs/middlegames_2.pgn"
+        source = args.source or os.path.join(
+            PUZZLE_OUTPUT_DIR, f"{args.puzzle_type}.csv"
         )
+        puzzle_filter = None
+        if args.opening_tag or args.theme:
+            # Opening tags and themes restrict the sample without any other
+            # bounds, e.g. to cut an opening pack from the full dump.
+            puzzle_filter = PuzzleFilter(
+                min_rating=0,
+                max_rating=10000,
+                min_popularity=-100,
+                min_plays=0,
+                puzzle_theme_tag=args.theme,
+                puzzle_opening_tag=args.opening_tag,
+            )
+        specs = [
+            PgnPackSpec(
+                os.path.join(args.output_dir, f"{args.puzzle_type}_{i}.pgn"),
+                args.num_puzzles,
+                puzzle_filter,
+            )
+            for i in range(1, args.num_packs + 1)
+        ]
+        write_pgn_packs(find_puzzle_input(source), specs, args.seed)
+
+    instrumentation.get_instrumentation().finish()
 
 
 if __name__ == "__main__":
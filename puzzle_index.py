@@ -0,0 +1,634 @@
+import hashlib
+import os
+import threading
+from collections.abc import Sequence
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import instrumentation
+from puzzle_store import (
+    PuzzleStore,
+    PuzzleSubset,
+    load_puzzles,
+    puzzle_ratings,
+    store_file_for,
+)
+
+# Bump when the layout of a cached index changes so stale caches are rebuilt.
+INDEX_CACHE_VERSION = 1
+
+
+def source_fingerprint(csv_file: str) -> str:
+    """Identifies the current contents of a filtered puzzle file.
+
+    Uses the CSV when it exists and its store otherwise, matching what
+    load_puzzles reads.
+    """
+    path = csv_file if os.path.exists(csv_file) else store_file_for(csv_file)
+    stat = os.stat(path)
+    return ":".join(
+        [
+            str(INDEX_CACHE_VERSION),
+            os.path.abspath(path),
+            str(stat.st_size),
+            str(stat.st_mtime_ns),
+        ]
+    )
+
+
+def source_digest(csv_file: str) -> str:
+    """SHA-256 of the contents behind a filtered puzzle file.
+
+    Unlike source_fingerprint this does not change when the file is merely
+    rewritten or copied, so it can key outputs that should be reproducible.
+    """
+    path = csv_file if os.path.exists(csv_file) else store_file_for(csv_file)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def index_cache_file(csv_file: str, kind: str) -> str:
+    return f"{os.path.splitext(csv_file)[0]}.{kind}.npz"
+
+
+def load_cached_index(
+    cache_file: str, fingerprint: str
+) -> Optional[Dict[str, np.ndarray]]:
+    """Load a cached index, or None if it is missing or built from other data."""
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+            if str(data["fingerprint"]) == fingerprint:
+                instrumentation.cache_hit("index_file")
+                return {name: data[name] for name in data.files}
+    except (OSError, ValueError, KeyError):
+        pass
+    instrumentation.cache_miss("index_file")
+    return None
+
+
+def save_cached_index(cache_file: str, fingerprint: str, arrays: Dict[str, np.ndarray]):
+    tmp_file = f"{cache_file}.tmp{os.getpid()}"
+    with open(tmp_file, "wb") as f:
+        np.savez(f, fingerprint=np.array(fingerprint), **arrays)
+    os.replace(tmp_file, cache_file)
+
+
+class OpeningIndex:
+    """Opening tag -> positions of the puzzles carrying it.
+
+    Positions index into `puzzles`, the loaded opening_tag pack, and are in
+    pack order for each tag. Tags are the lowercased Lichess opening tags.
+    """
+
+    def __init__(
+        self,
+        puzzles: Sequence,
+        tags: List[str],
+        offsets: np.ndarray,
+        positions: np.ndarray,
+        first_seen: np.ndarray,
+    ):
+        self.puzzles = puzzles
+        self.tags = tags
+        self.offsets = offsets
+        self.positions = positions
+        self.first_seen = first_seen
+        self.tag_ids = {tag: i for i, tag in enumerate(tags)}
+        self.counts = np.diff(offsets)
+        # Most puzzles first; ties keep the order the tags first appear in.
+        self.tags_by_count = [tags[i] for i in np.lexsort((first_seen, -self.counts))]
+
+    @classmethod
+    def load(cls, csv_file: str) -> "OpeningIndex":
+        """Load the index for a filtered CSV from its cache, or build it."""
+        fingerprint = source_fingerprint(csv_file)
+        cache_file = index_cache_file(csv_file, "openings")
+        puzzles = load_puzzles(csv_file)
+        cached = load_cached_index(cache_file, fingerprint)
+        if cached is not None:
+            return cls(
+                puzzles,
+                [str(tag) for tag in cached["tags"]],
+                cached["offsets"],
+                cached["positions"],
+                cached["first_seen"],
+            )
+
+        with instrumentation.stage("build_opening_index"):
+            index = cls.build(puzzles)
+        save_cached_index(
+            cache_file,
+            fingerprint,
+            {
+                "tags": np.array(index.tags, dtype=str),
+                "offsets": index.offsets,
+                "positions": index.positions,
+                "first_seen": index.first_seen,
+            },
+        )
+        return index
+
+    @classmethod
+    def build(cls, puzzles: Sequence) -> "OpeningIndex":
+        tags, rows, tag_ids = _tag_occurrences(puzzles, "opening_tags")
+        offsets, positions = _group_postings(rows, tag_ids, len(tags))
+        seen_ids, first_flat = np.unique(tag_ids, return_index=True)
+        first_seen = np.full(len(tags), len(tag_ids), dtype=np.int64)
+        first_seen[seen_ids] = first_flat
+        return cls(puzzles, tags, offsets, positions, first_seen)
+
+    def top_tags(self, n: int) -> List[str]:
+        return self.tags_by_count[:n]
+
+    def positions_for(self, tag: str) -> np.ndarray:
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            return self.positions[:0]
+        return self.positions[self.offsets[tag_id] : self.offsets[tag_id + 1]]
+
+    def puzzles_for(self, tag: str) -> PuzzleSubset:
+        return PuzzleSubset(self.puzzles, self.positions_for(tag))
+
+
+def _group_postings(
+    rows: np.ndarray, tag_ids: np.ndarray, num_tags: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Offsets and positions of per-tag posting lists, each in pack order."""
+    order = np.lexsort((rows, tag_ids))
+    counts = np.bincount(tag_ids, minlength=num_tags)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return offsets, rows[order].astype(np.uint32)
+
+
+def _tag_occurrences(
+    puzzles: Sequence, field: str
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """The tag vocabulary of a pack field and its (row, tag id) pairs."""
+    if isinstance(puzzles, PuzzleStore):
+        if field == "opening_tags":
+            rows = np.repeat(
+                np.arange(len(puzzles)),
+                np.diff(puzzles.opening_offsets.astype(np.int64)),
+            )
+            return (
+                list(puzzles.opening_tags),
+                rows,
+                puzzles.opening_ids.astype(np.int64),
+            )
+        row_parts, id_parts = [], []
+        for theme_id in range(len(puzzles.themes)):
+            theme_rows = np.flatnonzero(puzzles.theme_mask(puzzles.themes[theme_id]))
+            row_parts.append(theme_rows)
+            id_parts.append(np.full(len(theme_rows), theme_id, dtype=np.int64))
+        return (
+            list(puzzles.themes),
+            np.concatenate(row_parts or [np.zeros(0, dtype=np.int64)]),
+            np.concatenate(id_parts or [np.zeros(0, dtype=np.int64)]),
+        )
+
+    vocabulary: Dict[str, int] = {}
+    flat_rows, flat_ids = [], []
+    for row, puzzle in enumerate(puzzles):
+        for tag in getattr(puzzle, field).split():
+            flat_rows.append(row)
+            flat_ids.append(vocabulary.setdefault(tag, len(vocabulary)))
+    return (
+        list(vocabulary),
+        np.array(flat_rows, dtype=np.int64),
+        np.array(flat_ids, dtype=np.int64),
+    )
+
+
+QUERY_OPERATORS = {"and", "or", "not", "(", ")"}
+
+
+class TagIndex:
+    """Theme and opening tag -> sorted positions of the puzzles carrying it.
+
+    Answers boolean queries over a pack without another pass over its rows:
+
+        fork AND endgame AND NOT long
+        (pin OR skewer) sicilian_defense
+
+    Adjacent terms are ANDed, NOT binds tighter than AND, and AND tighter
+    than OR. A term is looked up as a theme first and then as an opening
+    tag; prefix it with `theme:` or `opening:` to pick one. Unknown terms
+    match no puzzles.
+    """
+
+    def __init__(
+        self,
+        puzzles: Sequence,
+        themes: List[str],
+        theme_offsets: np.ndarray,
+        theme_positions: np.ndarray,
+        opening_tags: List[str],
+        opening_offsets: np.ndarray,
+        opening_positions: np.ndarray,
+    ):
+        self.puzzles = puzzles
+        self.themes = themes
+        self.theme_offsets = theme_offsets
+        self.theme_positions = theme_positions
+        self.opening_tags = opening_tags
+        self.opening_offsets = opening_offsets
+        self.opening_positions = opening_positions
+        self.theme_ids = {tag: i for i, tag in enumerate(themes)}
+        self.opening_tag_ids = {tag: i for i, tag in enumerate(opening_tags)}
+
+    @classmethod
+    def load(cls, csv_file: str) -> "TagIndex":
+        """Load the index for a filtered CSV from its cache, or build it."""
+        fingerprint = source_fingerprint(csv_file)
+        cache_file = index_cache_file(csv_file, "tags")
+        puzzles = load_puzzles(csv_file)
+        cached = load_cached_index(cache_file, fingerprint)
+        if cached is not None:
+            return cls(
+                puzzles,
+                [str(tag) for tag in cached["themes"]],
+                cached["theme_offsets"],
+                cached["theme_positions"],
+                [str(tag) for tag in cached["opening_tags"]],
+                cached["opening_offsets"],
+                cached["opening_positions"],
+            )
+
+        with instrumentation.stage("build_tag_index"):
+            index = cls.build(puzzles)
+        save_cached_index(
+            cache_file,
+            fingerprint,
+            {
+                "themes": np.array(index.themes, dtype=str),
+                "theme_offsets": index.theme_offsets,
+                "theme_positions": index.theme_positions,
+                "opening_tags": np.array(index.opening_tags, dtype=str),
+                "opening_offsets": index.opening_offsets,
+                "opening_positions": index.opening_positions,
+            },
+        )
+        return index
+
+    @classmethod
+    def build(cls, puzzles: Sequence) -> "TagIndex":
+        themes, theme_rows, theme_ids = _tag_occurrences(puzzles, "themes")
+        opening_tags, opening_rows, opening_ids = _tag_occurrences(
+            puzzles, "opening_tags"
+        )
+        return cls(
+            puzzles,
+            themes,
+            *_group_postings(theme_rows, theme_ids, len(themes)),
+            opening_tags,
+            *_group_postings(opening_rows, opening_ids, len(opening_tags)),
+        )
+
+    def __len__(self) -> int:
+        return len(self.puzzles)
+
+    def positions_for(self, term: str) -> np.ndarray:
+        """Sorted positions of the puzzles carrying a theme or opening tag."""
+        kind, _, tag = term.lower().rpartition(":")
+        if kind not in ("", "theme", "opening"):
+            raise ValueError(f"Unknown tag kind in query term: {term}")
+        if kind != "opening" and tag in self.theme_ids:
+            tag_id = self.theme_ids[tag]
+            return self.theme_positions[
+                self.theme_offsets[tag_id] : self.theme_offsets[tag_id + 1]
+            ]
+        if kind != "theme" and tag in self.opening_tag_ids:
+            tag_id = self.opening_tag_ids[tag]
+            return self.opening_positions[
+                self.opening_offsets[tag_id] : self.opening_offsets[tag_id + 1]
+            ]
+        return self.theme_positions[:0]
+
+    def query(
+        self,
+        query: str,
+        min_rating: Optional[int] = None,
+        max_rating: Optional[int] = None,
+    ) -> np.ndarray:
+        """Sorted positions of the puzzles matching a boolean tag query."""
+        tokens = query.replace("(", " ( ").replace(")", " ) ").lower().split()
+        if not tokens:
+            raise ValueError("Empty puzzle query")
+        parser = _QueryParser(tokens)
+        tree = parser.parse()
+        positions = self._evaluate(tree)
+
+        if min_rating is not None or max_rating is not None:
+            ratings = puzzle_ratings(self.puzzles)[positions]
+            keep = np.ones(len(positions), dtype=bool)
+            if min_rating is not None:
+                keep &= ratings >= min_rating
+            if max_rating is not None:
+                keep &= ratings <= max_rating
+            positions = positions[keep]
+        return positions
+
+    def puzzles_matching(
+        self,
+        query: str,
+        min_rating: Optional[int] = None,
+        max_rating: Optional[int] = None,
+    ) -> PuzzleSubset:
+        return PuzzleSubset(self.puzzles, self.query(query, min_rating, max_rating))
+
+    def _evaluate(self, node) -> np.ndarray:
+        op = node[0]
+        if op == "term":
+            return self.positions_for(node[1])
+        if op == "not":
+            return self._complement(self._evaluate(node[1]))
+        if op == "or":
+            result = self._evaluate(node[1][0])
+            for child in node[1][1:]:
+                result = np.union1d(result, self._evaluate(child))
+            return result.astype(np.uint32)
+
+        # AND: intersect the positive operands smallest first, then remove
+        # the negated ones, so NOT only needs the full position range when
+        # every operand is negated.
+        positives = [self._evaluate(child) for child in node[1] if child[0] != "not"]
+        negatives = [self._evaluate(child[1]) for child in node[1] if child[0] == "not"]
+        if positives:
+            positives.sort(key=len)
+            result = positives[0]
+            for positions in positives[1:]:
+                result = np.intersect1d(result, positions, assume_unique=True)
+        else:
+            result = np.arange(len(self.puzzles), dtype=np.uint32)
+        for positions in negatives:
+            result = np.setdiff1d(result, positions, assume_unique=True)
+        return result.astype(np.uint32)
+
+    def _complement(self, positions: np.ndarray) -> np.ndarray:
+        mask = np.ones(len(self.puzzles), dtype=bool)
+        mask[positions] = False
+        return np.flatnonzero(mask).astype(np.uint32)
+
+
+class _QueryParser:
+    """Recursive descent parser turning query tokens into nested tuples."""
+
+    def __init__(self, tokens: List[str]):
+        self.tokens = tokens
+        self.position = 0
+
+    def parse(self):
+        node = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(
+                f"Unexpected '{self.tokens[self.position]}' in puzzle query"
+            )
+        return node
+
+    def _peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _or(self):
+        children = [self._and()]
+        while self._peek() == "or":
+            self.position += 1
+            children.append(self._and())
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def _and(self):
+        children = [self._not()]
+        while self._peek() is not None and self._peek() not in ("or", ")"):
+            if self._peek() == "and":
+                self.position += 1
+            children.append(self._not())
+        return children[0] if len(children) == 1 else ("and", children)
+
+    def _not(self):
+        if self._peek() == "not":
+            self.position += 1
+            return ("not", self._not())
+        return self._atom()
+
+    def _atom(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError("Puzzle query ends unexpectedly")
+        self.position += 1
+        if token == "(":
+            node = self._or()
+            if self._peek() != ")":
+                raise ValueError("Unbalanced parentheses in puzzle query")
+            self.position += 1
+            return node
+        if token in QUERY_OPERATORS:
+            raise ValueError(f"Unexpected '{token}' in puzzle query")
+        return ("term", token)
+
+
+def pawn_structure_key(fen: str) -> int:
+    """The pawn structure of a FEN as one int: white pawns << 64 | black pawns.
+
+    Each half is a bitboard with a1 as bit 0 and h8 as bit 63, the same
+    layout as python-chess, so keys from boards and from FENs agree.
+    """
+    white = black = 0
+    square = 56
+    for char in fen.split(" ", 1)[0]:
+        if char == "/":
+            square -= 16
+        elif char in "12345678":
+            square += ord(char) - 48
+        else:
+            if char == "P":
+                white |= 1 << square
+            elif char == "p":
+                black |= 1 << square
+            square += 1
+    return white << 64 | black
+
+
+def pawn_structure_key_from_bitboards(white_pawns: int, black_pawns: int) -> int:
+    return white_pawns << 64 | black_pawns
+
+
+class StructureIndex:
+    """Pawn structure key -> positions of the puzzles that reach it.
+
+    A puzzle is indexed under the structure of its starting position and,
+    if different, of the position after the first move. Only structures
+    with more than `min_puzzles` puzzles are kept.
+    """
+
+    def __init__(
+        self,
+        puzzles: Sequence,
+        white_pawns: np.ndarray,
+        black_pawns: np.ndarray,
+        offsets: np.ndarray,
+        positions: np.ndarray,
+    ):
+        self.puzzles = puzzles
+        self.white_pawns = white_pawns
+        self.black_pawns = black_pawns
+        self.offsets = offsets
+        self.positions = positions
+        self.structure_ids = {
+            pawn_structure_key_from_bitboards(int(white), int(black)): i
+            for i, (white, black) in enumerate(zip(white_pawns, black_pawns))
+        }
+
+    @classmethod
+    def load(cls, csv_file: str, min_puzzles: int) -> "StructureIndex":
+        """Load the index for a filtered CSV from its cache, or build it."""
+        fingerprint = f"{source_fingerprint(csv_file)}:min{min_puzzles}"
+        cache_file = index_cache_file(csv_file, "structures")
+        puzzles = load_puzzles(csv_file)
+        cached = load_cached_index(cache_file, fingerprint)
+        if cached is not None:
+            return cls(
+                puzzles,
+                cached["white_pawns"],
+                cached["black_pawns"],
+                cached["offsets"],
+                cached["positions"],
+            )
+
+        with instrumentation.stage("build_structure_index"):
+            index = cls.build(puzzles, min_puzzles)
+        save_cached_index(
+            cache_file,
+            fingerprint,
+            {
+                "white_pawns": index.white_pawns,
+                "black_pawns": index.black_pawns,
+                "offsets": index.offsets,
+                "positions": index.positions,
+            },
+        )
+        return index
+
+    @classmethod
+    def build(cls, puzzles: Sequence, min_puzzles: int) -> "StructureIndex":
+        if isinstance(puzzles, PuzzleStore):
+            fens = (
+                (puzzles.string(i, "fen"), puzzles.string(i, "offensive_fen"))
+                for i in range(len(puzzles))
+            )
+        else:
+            fens = (
+                (puzzle.fen, puzzle.generate_puzzle_position(defensive=False))
+                for puzzle in puzzles
+            )
+
+        mask = (1 << 64) - 1
+        rows, keys = [], []
+        for row, (fen, offensive_fen) in enumerate(fens):
+            structure1 = pawn_structure_key(fen)
+            rows.append(row)
+            keys.append(structure1)
+            structure2 = pawn_structure_key(offensive_fen)
+            if structure2 != structure1:
+                rows.append(row)
+                keys.append(structure2)
+
+        rows = np.array(rows, dtype=np.uint32)
+        white = np.array([key >> 64 for key in keys], dtype=np.uint64)
+        black = np.array([key & mask for key in keys], dtype=np.uint64)
+
+        # Group entries by structure, keeping pack order within each group.
+        order = np.lexsort((rows, black, white))
+        rows, white, black = rows[order], white[order], black[order]
+        starts = np.flatnonzero(
+            np.concatenate(
+                [[True], (white[1:] != white[:-1]) | (black[1:] != black[:-1])]
+            )
+        )
+        counts = np.diff(np.append(starts, len(rows)))
+        kept = counts > min_puzzles
+
+        kept_starts, kept_counts = starts[kept], counts[kept]
+        offsets = np.concatenate([[0], np.cumsum(kept_counts)]).astype(np.int64)
+        positions = (
+            np.concatenate(
+                [rows[start : start + n] for start, n in zip(kept_starts, kept_counts)]
+            )
+            if len(kept_starts)
+            else rows[:0]
+        )
+        return cls(puzzles, white[kept_starts], black[kept_starts], offsets, positions)
+
+    def __len__(self) -> int:
+        return len(self.white_pawns)
+
+    def positions_for(self, structure: int) -> np.ndarray:
+        structure_id = self.structure_ids.get(structure)
+        if structure_id is None:
+            return self.positions[:0]
+        start, end = self.offsets[structure_id], self.offsets[structure_id + 1]
+        return self.positions[start:end]
+
+    def puzzles_matching(self, structures) -> PuzzleSubset:
+        """Puzzles reaching any of the given structure keys, in pack order."""
+        matches = [self.positions_for(structure) for structure in structures]
+        positions = (
+            np.unique(np.concatenate(matches)) if matches else self.positions[:0]
+        )
+        return PuzzleSubset(self.puzzles, positions)
+
+
+_opening_indexes: Dict[str, OpeningIndex] = {}
+_opening_fingerprints: Dict[str, str] = {}
+_opening_lock = threading.Lock()
+
+
+def get_opening_index(csv_file: str) -> OpeningIndex:
+    """The process-wide opening index for csv_file, rebuilt if the file changed."""
+    fingerprint = source_fingerprint(csv_file)
+    with _opening_lock:
+        if _opening_fingerprints.get(csv_file) != fingerprint:
+            instrumentation.cache_miss("opening_index")
+            _opening_indexes[csv_file] = OpeningIndex.load(csv_file)
+            _opening_fingerprints[csv_file] = fingerprint
+        else:
+            instrumentation.cache_hit("opening_index")
+        return _opening_indexes[csv_file]
+
+
+_structure_indexes: Dict[str, StructureIndex] = {}
+_structure_fingerprints: Dict[str, str] = {}
+_structure_lock = threading.Lock()
+
+
+def get_structure_index(csv_file: str, min_puzzles: int) -> StructureIndex:
+    """The process-wide structure index for csv_file, rebuilt if it changed."""
+    fingerprint = f"{source_fingerprint(csv_file)}:min{min_puzzles}"
+    with _structure_lock:
+        if _structure_fingerprints.get(csv_file) != fingerprint:
+            instrumentation.cache_miss("structure_index")
+            _structure_indexes[csv_file] = StructureIndex.load(csv_file, min_puzzles)
+            _structure_fingerprints[csv_file] = fingerprint
+        else:
+            instrumentation.cache_hit("structure_index")
+        return _structure_indexes[csv_file]
+
+
+_tag_indexes: Dict[str, TagIndex] = {}
+_tag_fingerprints: Dict[str, str] = {}
+_tag_lock = threading.Lock()
+
+
+def get_tag_index(csv_file: str) -> TagIndex:
+    """The process-wide tag index for csv_file, rebuilt if the file changed."""
+    fingerprint = source_fingerprint(csv_file)
+    with _tag_lock:
+        if _tag_fingerprints.get(csv_file) != fingerprint:
+            instrumentation.cache_miss("tag_index")
+            _tag_indexes[csv_file] = TagIndex.load(csv_file)
+            _tag_fingerprints[csv_file] = fingerprint
+        else:
+            instrumentation.cache_hit("tag_index")
+        return _tag_indexes[csv_file]
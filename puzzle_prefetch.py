@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, NamedTuple, Optional, Tuple
+
+from generate_puzzles import PuzzleGenerator
+
+# Puzzles kept ready per session.
+PREFETCH_DEPTH = 5
+# Sessions with a filled queue; older ones are emptied, bounding the total
+# held across sessions at PREFETCH_DEPTH * PREFETCH_MAX_SESSIONS puzzles.
+PREFETCH_MAX_SESSIONS = 256
+PREFETCH_WORKERS = 4
+
+
+class PuzzleRequest(NamedTuple):
+    """The app inputs that decide which puzzles a session is shown."""
+
+    puzzle_pack_name: str
+    target_rating: int
+    opening_name: str = ""
+    username: str = ""
+
+
+class PrefetchQueue:
+    """Upcoming puzzles for one session, refilled in the background.
+
+    The queued puzzles are for one request; asking for a different one
+    drops them, and a puzzle generated for the old request while it changed
+    is discarded.
+    """
+
+    def __init__(self, prefetcher: "PuzzlePrefetcher"):
+        self.prefetcher = prefetcher
+        self.request: Optional[PuzzleRequest] = None
+        self.puzzles: Deque[Tuple[str, str]] = deque()
+        self.generation = 0
+        self.filling = False
+        self.active = False
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.puzzles)
+
+    def next(self, request: PuzzleRequest) -> Tuple[str, str]:
+        """The next (fen, analysis url) for request, from the queue if ready."""
+        with self.lock:
+            if request != self.request:
+                self._reset(request)
+            puzzle = self.puzzles.popleft() if self.puzzles else None
+            self.active = True
+        self.prefetcher.touch(self)
+        if puzzle is None:
+            puzzle = self.prefetcher.generate(request)
+        self.prefetcher.schedule(self)
+        return puzzle
+
+    def deactivate(self):
+        """Drop the queued puzzles and stop filling until the next request."""
+        with self.lock:
+            self.active = False
+            self._reset(self.request)
+
+    def _reset(self, request: Optional[PuzzleRequest]):
+        self.request = request
+        self.puzzles.clear()
+        self.generation += 1
+
+    def fill(self):
+        """Top the queue up for the current request; runs on a worker."""
+        while True:
+            with self.lock:
+                # Clearing the flag under the same lock as the check means a
+                # puzzle popped right after is always followed by a refill.
+                if not self.active or len(self.puzzles) >= self.prefetcher.depth:
+                    self.filling = False
+                    return
+                request = self.request
+                generation = self.generation
+            try:
+                puzzle = self.prefetcher.generate(request)
+            except Exception:
+                # Leave the error to the next synchronous generate, where the
+                # app can show it.
+                with self.lock:
+                    self.filling = False
+                return
+            with self.lock:
+                if generation == self.generation:
+                    self.puzzles.append(puzzle)
+
+
+class PuzzlePrefetcher:
+    """Shared worker pool keeping each session's PrefetchQueue topped up.
+
+    Holds at most `max_sessions` filled queues, least recently used first
+    out; an evicted queue is emptied and refills on its next use.
+    """
+
+    def __init__(
+        self,
+        puzzle_generator: Optional[PuzzleGenerator] = None,
+        depth: int = PREFETCH_DEPTH,
+        max_sessions: int = PREFETCH_MAX_SESSIONS,
+        num_workers: int = PREFETCH_WORKERS,
+    ):
+        self.puzzle_generator = puzzle_generator or PuzzleGenerator()
+        self.depth = depth
+        self.max_sessions = max_sessions
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="puzzle-prefetch"
+        )
+        self.queues: "OrderedDict[int, PrefetchQueue]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def session_queue(self) -> PrefetchQueue:
+        return PrefetchQueue(self)
+
+    def generate(self, request: PuzzleRequest) -> Tuple[str, str]:
+        return self.puzzle_generator.generate_puzzle_fen_string(
+            puzzle_pack_name=request.puzzle_pack_name,
+            target_rating=request.target_rating,
+            opening_name=request.opening_name,
+            username=request.username,
+        )
+
+    def touch(self, queue: PrefetchQueue):
+        evicted = []
+        with self.lock:
+            self.queues[id(queue)] = queue
+            self.queues.move_to_end(id(queue))
+            while len(self.queues) > self.max_sessions:
+                evicted.append(self.queues.popitem(last=False)[1])
+        for old_queue in evicted:
+            old_queue.deactivate()
+
+    def schedule(self, queue: PrefetchQueue):
+        with queue.lock:
+            if queue.filling or len(queue.puzzles) >= self.depth:
+                return
+            queue.filling = True
+        self.executor.submit(queue.fill)
@@ -0,0 +1,470 @@
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from generate_puzzles import (
+    PUZZLES_OPENINGS_BY_NAME,
+    RATING_SAMPLE_SIZE,
+    RATING_WINDOW,
+    PuzzleGenerator,
+    RatingIndex,
+    convert_to_analysis_url,
+)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_RATING = 1400
+MIN_SESSION_RATING = 400
+MAX_SESSION_RATING = 3200
+# Elo K-factor for session rating updates after each result.
+RATING_K_FACTOR = 32
+# Puzzles a session will not be served again; also bounds per-session memory.
+RECENT_PUZZLES_LIMIT = 200
+MAX_SESSIONS = 10000
+SESSION_TTL_SECONDS = 3600
+# Random draws from the rating window before falling back to a scan.
+SAMPLE_ATTEMPTS = 16
+
+
+@dataclass
+class PuzzleSession:
+    """A solver working through one pack, rated by their results so far.
+
+    Puzzles are tracked by position in the session's rating index, so the
+    recently seen set holds ints rather than puzzle ids.
+    """
+
+    session_id: str
+    index: RatingIndex
+    rating: float
+    recent_limit: int = RECENT_PUZZLES_LIMIT
+    recent: Deque[int] = field(default_factory=deque)
+    recent_positions: Set[int] = field(default_factory=set)
+    current: Optional[int] = None
+    last_used: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def mark_seen(self, position: int):
+        self.recent.append(position)
+        self.recent_positions.add(position)
+        if len(self.recent) > self.recent_limit:
+            self.recent_positions.discard(self.recent.popleft())
+
+
+def updated_rating(rating: float, puzzle_rating: int, solved: bool) -> float:
+    """Elo update of a solver's rating after solving or failing a puzzle."""
+    expected = 1 / (1 + 10 ** ((puzzle_rating - rating) / 400))
+    rating += RATING_K_FACTOR * ((1 if solved else 0) - expected)
+    return min(MAX_SESSION_RATING, max(MIN_SESSION_RATING, rating))
+
+
+class PuzzleService:
+    """Rating-adaptive puzzle sessions over a PuzzleGenerator's rating indexes.
+
+    Sessions live in memory, least recently used first out once there are
+    more than `max_sessions`, and expire after `ttl` idle seconds.
+    """
+
+    def __init__(
+        self,
+        puzzle_generator: Optional[PuzzleGenerator] = None,
+        max_sessions: int = MAX_SESSIONS,
+        ttl: float = SESSION_TTL_SECONDS,
+        recent_limit: int = RECENT_PUZZLES_LIMIT,
+    ):
+        self.puzzle_generator = puzzle_generator or PuzzleGenerator()
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.recent_limit = recent_limit
+        self.sessions: "OrderedDict[str, PuzzleSession]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def preload(self, puzzle_pack_names: Optional[List[str]] = None):
+        """Build rating indexes up front so the first sessions are not slow."""
+        for puzzle_pack_name in puzzle_pack_names or list(
+            self.puzzle_generator.puzzle_mapping
+        ):
+            self.puzzle_generator.get_rating_index(puzzle_pack_name)
+
+    def rating_index(
+        self, puzzle_pack_name: str, opening_name: str = ""
+    ) -> RatingIndex:
+        if puzzle_pack_name == PUZZLES_OPENINGS_BY_NAME:
+            if opening_name not in self.puzzle_generator.get_opening_names():
+                raise ValueError("Invalid opening name")
+            return self.puzzle_generator.get_opening_rating_index(opening_name)
+        if puzzle_pack_name not in self.puzzle_generator.puzzle_mapping:
+            raise ValueError("Invalid puzzle pack name")
+        return self.puzzle_generator.get_rating_index(puzzle_pack_name)
+
+    def create_session(
+        self,
+        puzzle_pack_name: str,
+        rating: float = DEFAULT_RATING,
+        opening_name: str = "",
+    ) -> PuzzleSession:
+        session = PuzzleSession(
+            uuid.uuid4().hex,
+            self.rating_index(puzzle_pack_name, opening_name),
+            min(MAX_SESSION_RATING, max(MIN_SESSION_RATING, float(rating))),
+            self.recent_limit,
+        )
+        with self.lock:
+            self.sessions[session.session_id] = session
+            self._evict(session.last_used)
+        return session
+
+    def get_session(self, session_id: str) -> PuzzleSession:
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None or now - session.last_used > self.ttl:
+                self.sessions.pop(session_id, None)
+                raise KeyError(session_id)
+            session.last_used = now
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def _evict(self, now: float):
+        while self.sessions:
+            session_id, oldest = next(iter(self.sessions.items()))
+            if (
+                len(self.sessions) <= self.max_sessions
+                and now - oldest.last_used <= self.ttl
+            ):
+                break
+            del self.sessions[session_id]
+
+    def next_puzzle(self, session_id: str) -> Dict:
+        """Serve a puzzle near the session's rating that it has not seen recently."""
+        session = self.get_session(session_id)
+        with session.lock:
+            position = _select_unseen(session)
+            session.mark_seen(position)
+            session.current = position
+            puzzle = session.index.puzzles[position]
+            rating = int(session.index.ratings[position])
+            session_rating = session.rating
+
+        defensive = random.random() > 0.5
+        fen = puzzle.generate_puzzle_position(defensive)
+        return {
+            "puzzle_id": puzzle.puzzle_id,
+            "fen": fen,
+            "analysis_url": convert_to_analysis_url(fen),
+            "rating": rating,
+            "defensive": defensive,
+            "session_rating": round(session_rating),
+        }
+
+    def record_result(self, session_id: str, solved: bool) -> float:
+        """Update the session rating from the result of its current puzzle."""
+        session = self.get_session(session_id)
+        with session.lock:
+            if session.current is None:
+                raise ValueError("No puzzle has been served to this session")
+            puzzle_rating = int(session.index.ratings[session.current])
+            session.rating = updated_rating(session.rating, puzzle_rating, solved)
+            session.current = None
+            return session.rating
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {"sessions": len(self.sessions)}
+
+
+def _select_unseen(session: PuzzleSession) -> int:
+    index = session.index
+    if len(index) == 0:
+        raise ValueError("Puzzle pack is empty")
+    target_rating = int(round(session.rating))
+    positions = index.window(
+        target_rating - RATING_WINDOW, target_rating + RATING_WINDOW
+    )
+    if len(positions) < RATING_SAMPLE_SIZE:
+        positions = index.around(target_rating, RATING_SAMPLE_SIZE)
+
+    # The rating window is normally far larger than the recently seen set,
+    # so a few random draws almost always find an unseen puzzle.
+    for _ in range(SAMPLE_ATTEMPTS):
+        position = int(positions[random.randrange(len(positions))])
+        if position not in session.recent_positions:
+            return position
+
+    if len(session.recent_positions) >= len(index):
+        # Every puzzle in the pack was seen recently; start over.
+        session.recent.clear()
+        session.recent_positions.clear()
+        return int(positions[random.randrange(len(positions))])
+
+    # A slice of len(seen) + RATING_SAMPLE_SIZE puzzles holds unseen ones.
+    seen = np.fromiter(session.recent_positions, dtype=np.int64)
+    while True:
+        unseen = positions[~np.isin(positions, seen)]
+        if len(unseen):
+            return int(unseen[random.randrange(len(unseen))])
+        positions = index.around(target_rating, len(seen) + RATING_SAMPLE_SIZE)
+
+
+class PuzzleRequestHandler(BaseHTTPRequestHandler):
+    """JSON API over a PuzzleService.
+
+    POST /sessions                 {"pack", "rating", "opening"} -> session
+    GET  /sessions/<id>/next       -> puzzle
+    POST /sessions/<id>/result     {"solved"} -> updated rating
+    GET  /stats                    -> server counters
+    """
+
+    # Keep connections alive between requests, and send small responses
+    # right away rather than waiting on the client's delayed ACK.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    service: PuzzleService
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["stats"]:
+            self._handle(self.service.stats)
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "next":
+            self._handle(lambda: self.service.next_puzzle(parts[1]))
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        try:
+            body = self._read_json()
+        except ValueError:
+            self._send(400, {"error": "Invalid JSON body"})
+            return
+        if parts == ["sessions"]:
+            self._handle(lambda: self._create_session(body))
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "result":
+            self._handle(lambda: self._record_result(parts[1], body))
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def _create_session(self, body: Dict) -> Dict:
+        session = self.service.create_session(
+            body.get("pack", ""),
+            body.get("rating", DEFAULT_RATING),
+            body.get("opening", ""),
+        )
+        return {
+            "session_id": session.session_id,
+            "session_rating": round(session.rating),
+        }
+
+    def _record_result(self, session_id: str, body: Dict) -> Dict:
+        solved = body.get("solved")
+        if not isinstance(solved, bool):
+            raise ValueError('"solved" must be true or false')
+        return {"session_rating": round(self.service.record_result(session_id, solved))}
+
+    def _handle(self, action):
+        try:
+            self._send(200, action())
+        except KeyError:
+            self._send(404, {"error": "Unknown or expired session"})
+        except (TypeError, ValueError) as e:
+            self._send(400, {"error": str(e)})
+        except Exception:
+            # Reply rather than leave a keep-alive client waiting for a
+            # response that never comes.
+            traceback.print_exc()
+            self._send(500, {"error": "Internal server error"})
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        body = json.loads(self.rfile.read(length))
+        if not isinstance(body, dict):
+            raise ValueError("Expected a JSON object")
+        return body
+
+    def _send(self, status: int, payload: Dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Per-request logging would dominate the cost of serving a puzzle.
+        pass
+
+
+def make_server(
+    service: PuzzleService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT
+) -> ThreadingHTTPServer:
+    handler = type(
+        "BoundPuzzleRequestHandler", (PuzzleRequestHandler,), {"service": service}
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def _request(
+    connection: http.client.HTTPConnection,
+    method: str,
+    path: str,
+    payload: Optional[Dict] = None,
+) -> Tuple[int, Dict]:
+    body = json.dumps(payload).encode() if payload is not None else None
+    headers = {"Content-Type": "application/json"} if body else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def _run_load_session(
+    host: str, port: int, puzzle_pack_name: str, num_puzzles: int, seed: int
+) -> Tuple[List[float], Counter]:
+    """Latencies of one solver's requests, and the status of every reply
+    that was not 2xx. A solver stops at its first error."""
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    errors: Counter = Counter()
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    try:
+        status, session = _request(
+            connection,
+            "POST",
+            "/sessions",
+            {"pack": puzzle_pack_name, "rating": rng.randint(800, 2200)},
+        )
+        if not 200 <= status < 300:
+            errors[status] += 1
+            return latencies, errors
+        session_path = f"/sessions/{session['session_id']}"
+        for _ in range(num_puzzles):
+            for method, path, payload in (
+                ("GET", f"{session_path}/next", None),
+                ("POST", f"{session_path}/result", {"solved": rng.random() < 0.6}),
+            ):
+                start = time.perf_counter()
+                status, _ = _request(connection, method, path, payload)
+                latencies.append(time.perf_counter() - start)
+                if not 200 <= status < 300:
+                    errors[status] += 1
+                    return latencies, errors
+    finally:
+        connection.close()
+    return latencies, errors
+
+
+def run_load_test(
+    host: str,
+    port: int,
+    puzzle_pack_name: str,
+    num_sessions: int,
+    num_puzzles: int,
+    concurrency: int,
+) -> Dict:
+    """Drive `num_sessions` simulated solvers against a running server.
+
+    Each solver creates a session, then fetches `num_puzzles` puzzles and
+    reports a random result for each over one keep-alive connection. Replies
+    that are not 2xx are counted by status under "errors".
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda seed: _run_load_session(
+                    host, port, puzzle_pack_name, num_puzzles, seed
+                ),
+                range(num_sessions),
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    latencies = np.sort(np.concatenate([np.array(r) for r, _ in results]))
+    errors: Counter = Counter()
+    for _, session_errors in results:
+        errors.update(session_errors)
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            f"p{p}": round(float(np.percentile(latencies, p)) * 1000, 3)
+            if len(latencies)
+            else None
+            for p in (50, 95, 99)
+        },
+        "errors": {str(status): count for status, count in sorted(errors.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rating-adaptive puzzle server.")
+    parser.add_argument(
+        "command", type=str, help="Command to run. Options: serve, loadtest"
+    )
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--max-sessions",
+        type=int,
+        default=MAX_SESSIONS,
+        help="Sessions kept in memory before the least recently used is dropped",
+    )
+    parser.add_argument(
+        "--pack", type=str, default="Random", help="Puzzle pack for loadtest"
+    )
+    parser.add_argument(
+        "--sessions", type=int, default=200, help="Simulated solvers for loadtest"
+    )
+    parser.add_argument(
+        "--puzzles", type=int, default=20, help="Puzzles per solver for loadtest"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Concurrent solvers for loadtest"
+    )
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        service = PuzzleService(max_sessions=args.max_sessions)
+        service.preload()
+        server = make_server(service, args.host, args.port)
+        print(f"Serving puzzles on http://{args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    elif args.command == "loadtest":
+        report = run_load_test(
+            args.host,
+            args.port,
+            args.pack,
+            args.sessions,
+            args.puzzles,
+            args.concurrency,
+        )
+        print(json.dumps(report, indent=2))
+
+    else:
+        parser.error(f"Unknown command {args.command}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,547 @@
+import argparse
 import csv
-from collections import defaultdict
-from process_puzzles import Puzzle
+import itertools
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
 
-puzzles = []
-with open("puzzles/opening_tag.csv", "r") as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        puzzle = Puzzle.from_dict(row)
-        puzzles.append(puzzle)
+import numpy as np
 
+import instrumentation
+from generate_puzzles import RATING_SAMPLE_SIZE, RATING_WINDOW
+from process_puzzles import (
+    OPTIONAL_FILTER_MAPPING,
+    PUZZLE_FILTER_MAPPING,
+    PUZZLE_INPUT_FILE,
+    find_puzzle_input,
+    open_puzzle_input,
+)
+from puzzle_index import (
+    index_cache_file,
+    load_cached_index,
+    save_cached_index,
+    source_digest,
+)
 
-opening_counts = defaultdict(int)
+# Bump when the cached statistics change meaning so stale caches are rebuilt.
+STATS_VERSION = 1
+# Ratings are histogrammed in bins of this many points; higher ratings land
+# in the last bin.
+RATING_BIN_WIDTH = 10
+MAX_RATING = 4000
+NUM_RATING_BINS = MAX_RATING // RATING_BIN_WIDTH
+STATS_BATCH_ROWS = 65536
+DEFAULT_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+DEFAULT_BAND_WIDTH = 100
+# Capacities are reported for the optional filters too, to show what they
+# would add.
+STATS_FILTERS = {**PUZZLE_FILTER_MAPPING, **OPTIONAL_FILTER_MAPPING}
 
-for puzzle in puzzles:
-    opening_tags = puzzle.opening_tags.split(" ")
-    for tag in opening_tags:
-        opening_counts[tag] += 1
 
-# print the counts in sorted order
-for opening, count in sorted(opening_counts.items(), key=lambda x: x[1], reverse=False):
-    print(f"{opening}: {count}")
+def weighted_quantiles(
+    values: np.ndarray, counts: np.ndarray, quantiles: Sequence[float]
+) -> np.ndarray:
+    """Quantiles of a distribution given as distinct values and their counts.
 
-print(len(opening_counts))
+    Returns the smallest value whose cumulative share reaches each quantile,
+    like np.quantile(..., method="inverted_cdf") on the expanded values.
+    """
+    if len(values) == 0:
+        return np.zeros(len(quantiles), dtype=np.int64)
+    cumulative = np.cumsum(counts)
+    positions = np.searchsorted(
+        cumulative, np.asarray(quantiles) * cumulative[-1], side="left"
+    )
+    return values[np.minimum(positions, len(values) - 1)]
+
+
+def rating_quantiles(
+    rating_counts: np.ndarray, quantiles: Sequence[float]
+) -> np.ndarray:
+    """Quantiles of a rating histogram, to the start of their bin."""
+    bin_starts = np.arange(len(rating_counts)) * RATING_BIN_WIDTH
+    return weighted_quantiles(bin_starts, rating_counts, quantiles)
+
+
+@dataclass
+class PuzzleStats:
+    """Aggregates over every puzzle of one input file.
+
+    Rating histograms have NUM_RATING_BINS bins of RATING_BIN_WIDTH points.
+    theme_pairs[i, j] counts the puzzles with both themes i and j, so its
+    diagonal is each theme's puzzle count. filter_ratings holds, for each
+    STATS_FILTERS entry, the histogram of the puzzles it keeps.
+    """
+
+    rating_counts: np.ndarray
+    themes: List[str]
+    theme_ratings: np.ndarray
+    theme_pairs: np.ndarray
+    opening_tags: List[str]
+    opening_ratings: np.ndarray
+    num_without_opening: int
+    popularity_values: np.ndarray
+    popularity_counts: np.ndarray
+    plays_values: np.ndarray
+    plays_counts: np.ndarray
+    filter_names: List[str]
+    filter_ratings: np.ndarray
+
+    @property
+    def num_puzzles(self) -> int:
+        return int(self.rating_counts.sum())
+
+    def popularity_quantiles(self, quantiles: Sequence[float]) -> np.ndarray:
+        return weighted_quantiles(
+            self.popularity_values, self.popularity_counts, quantiles
+        )
+
+    def plays_quantiles(self, quantiles: Sequence[float]) -> np.ndarray:
+        return weighted_quantiles(self.plays_values, self.plays_counts, quantiles)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "rating_counts": self.rating_counts,
+            "themes": np.array(self.themes, dtype=str),
+            "theme_ratings": self.theme_ratings,
+            "theme_pairs": self.theme_pairs,
+            "opening_tags": np.array(self.opening_tags, dtype=str),
+            "opening_ratings": self.opening_ratings,
+            "num_without_opening": np.array(self.num_without_opening),
+            "popularity_values": self.popularity_values,
+            "popularity_counts": self.popularity_counts,
+            "plays_values": self.plays_values,
+            "plays_counts": self.plays_counts,
+            "filter_names": np.array(self.filter_names, dtype=str),
+            "filter_ratings": self.filter_ratings,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "PuzzleStats":
+        return cls(
+            rating_counts=arrays["rating_counts"],
+            themes=arrays["themes"].tolist(),
+            theme_ratings=arrays["theme_ratings"],
+            theme_pairs=arrays["theme_pairs"],
+            opening_tags=arrays["opening_tags"].tolist(),
+            opening_ratings=arrays["opening_ratings"],
+            num_without_opening=int(arrays["num_without_opening"]),
+            popularity_values=arrays["popularity_values"],
+            popularity_counts=arrays["popularity_counts"],
+            plays_values=arrays["plays_values"],
+            plays_counts=arrays["plays_counts"],
+            filter_names=arrays["filter_names"].tolist(),
+            filter_ratings=arrays["filter_ratings"],
+        )
+
+
+def _grow(counts: np.ndarray, size: int, axes: Tuple[int, ...] = (0,)) -> np.ndarray:
+    """Pad the given axes of counts with zeros up to size."""
+    padding = [(0, 0)] * counts.ndim
+    for axis in axes:
+        padding[axis] = (0, size - counts.shape[axis])
+    return np.pad(counts, padding)
+
+
+def _merge_value_counts(
+    values: np.ndarray, counts: np.ndarray, new_values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Add new_values to a distribution kept as sorted distinct values and
+    their counts."""
+    batch_values, batch_counts = np.unique(new_values, return_counts=True)
+    merged, inverse = np.unique(
+        np.concatenate([values, batch_values]), return_inverse=True
+    )
+    merged_counts = np.bincount(
+        inverse, weights=np.concatenate([counts, batch_counts]), minlength=len(merged)
+    )
+    return merged, merged_counts.astype(np.int64)
+
+
+def _split_quoted(line: bytes) -> List[bytes]:
+    return [
+        value.encode("utf-8") for value in next(csv.reader([line.decode("utf-8")]), [])
+    ]
+
+
+class _Vocabulary(dict):
+    """Tag -> id, giving each new tag the next id on first lookup."""
+
+    def __missing__(self, tag: bytes) -> int:
+        tag_id = self[tag] = len(self)
+        return tag_id
+
+
+class _StatsBuilder:
+    """Accumulates PuzzleStats one batch of CSV rows at a time.
+
+    Only splitting rows and parsing numbers happen per row in Python; the
+    histograms, tag counts and filter matches are computed with NumPy over
+    the whole batch. Tag vocabularies grow as new tags turn up, and the
+    per-tag arrays grow with them.
+    """
+
+    def __init__(self, fieldnames: List[str]):
+        self.rating_index = fieldnames.index("Rating")
+        self.popularity_index = fieldnames.index("Popularity")
+        self.plays_index = fieldnames.index("NbPlays")
+        self.themes_index = fieldnames.index("Themes")
+        self.opening_tags_index = fieldnames.index("OpeningTags")
+        self.num_fields = len(fieldnames)
+
+        self.themes = _Vocabulary()
+        self.opening_tags = _Vocabulary()
+        self.rating_counts = np.zeros(NUM_RATING_BINS, dtype=np.int64)
+        self.theme_ratings = np.zeros((0, NUM_RATING_BINS), dtype=np.int64)
+        self.theme_pairs = np.zeros((0, 0), dtype=np.int64)
+        self.opening_ratings = np.zeros((0, NUM_RATING_BINS), dtype=np.int64)
+        self.num_without_opening = 0
+        self.popularity = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.plays = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.filter_ratings = np.zeros(
+            (len(STATS_FILTERS), NUM_RATING_BINS), dtype=np.int64
+        )
+
+    def parse_lines(self, lines: List[bytes]) -> List[List[bytes]]:
+        """Split raw CSV data lines into fields, dropping lines that are not
+        rows. Line endings are left on the last field; int() and the tag
+        split both ignore them."""
+        rows = [
+            line.split(b",") if b'"' not in line else _split_quoted(line)
+            for line in lines
+        ]
+        return [row for row in rows if len(row) >= self.num_fields]
+
+    def _column(self, rows: List[List[bytes]], index: int) -> np.ndarray:
+        return np.fromiter(
+            (int(row[index]) for row in rows), dtype=np.int64, count=len(rows)
+        )
+
+    def _tags(
+        self, rows: List[List[bytes]], index: int, vocabulary: Dict[bytes, int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """(row, tag id) pairs of a space-separated tag field.
+
+        Empty fields contribute no tags, rather than an empty-string tag.
+        """
+        split = [row[index].split() for row in rows]
+        lengths = np.fromiter(map(len, split), dtype=np.int64, count=len(split))
+        tag_rows = np.repeat(np.arange(len(rows)), lengths)
+        tags = list(itertools.chain.from_iterable(split))
+        if not tags:
+            return tag_rows, np.zeros(0, dtype=np.int64)
+        tag_ids = np.fromiter(
+            map(vocabulary.__getitem__, tags), dtype=np.int64, count=len(tags)
+        )
+        return tag_rows, tag_ids
+
+    def _tag_ratings(
+        self,
+        tag_ratings: np.ndarray,
+        num_tags: int,
+        tag_ids: np.ndarray,
+        bins: np.ndarray,
+    ) -> np.ndarray:
+        tag_ratings = _grow(tag_ratings, num_tags)
+        tag_ratings += np.bincount(
+            tag_ids * NUM_RATING_BINS + bins, minlength=num_tags * NUM_RATING_BINS
+        ).reshape(num_tags, NUM_RATING_BINS)
+        return tag_ratings
+
+    def _has_tag(
+        self,
+        num_rows: int,
+        tag_rows: np.ndarray,
+        tag_ids: np.ndarray,
+        vocabulary: Dict[bytes, int],
+        tag: str,
+    ) -> np.ndarray:
+        """Rows carrying tag, matched case-insensitively like FilterPlan."""
+        tag = tag.lower().encode("utf-8")
+        ids = [i for name, i in vocabulary.items() if name.lower() == tag]
+        has_tag = np.zeros(num_rows, dtype=bool)
+        has_tag[tag_rows[np.isin(tag_ids, ids)]] = True
+        return has_tag
+
+    def add_batch(self, lines: List[bytes]) -> int:
+        """Add a batch of raw CSV data lines; returns the number of rows."""
+        rows = self.parse_lines(lines)
+        num_rows = len(rows)
+        if not num_rows:
+            return 0
+        ratings = self._column(rows, self.rating_index)
+        popularity = self._column(rows, self.popularity_index)
+        plays = self._column(rows, self.plays_index)
+        bins = np.clip(ratings // RATING_BIN_WIDTH, 0, NUM_RATING_BINS - 1)
+
+        self.rating_counts += np.bincount(bins, minlength=NUM_RATING_BINS)
+        self.popularity = _merge_value_counts(*self.popularity, popularity)
+        self.plays = _merge_value_counts(*self.plays, plays)
+
+        theme_rows, theme_ids = self._tags(rows, self.themes_index, self.themes)
+        num_themes = len(self.themes)
+        self.theme_ratings = self._tag_ratings(
+            self.theme_ratings, num_themes, theme_ids, bins[theme_rows]
+        )
+        # One row per puzzle and column per theme; its Gram matrix counts the
+        # puzzles sharing each pair of themes. float32 is exact up to 2**24,
+        # well above STATS_BATCH_ROWS.
+        has_theme = np.zeros((num_rows, num_themes), dtype=np.float32)
+        has_theme[theme_rows, theme_ids] = 1
+        self.theme_pairs = _grow(self.theme_pairs, num_themes, axes=(0, 1))
+        self.theme_pairs += (has_theme.T @ has_theme).astype(np.int64)
+
+        opening_rows, opening_ids = self._tags(
+            rows, self.opening_tags_index, self.opening_tags
+        )
+        self.opening_ratings = self._tag_ratings(
+            self.opening_ratings,
+            len(self.opening_tags),
+            opening_ids,
+            bins[opening_rows],
+        )
+        self.num_without_opening += num_rows - len(np.unique(opening_rows))
+
+        for i, puzzle_filter in enumerate(STATS_FILTERS.values()):
+            keep = (
+                (ratings >= puzzle_filter.min_rating)
+                & (ratings <= puzzle_filter.max_rating)
+                & (popularity >= puzzle_filter.min_popularity)
+                & (plays >= puzzle_filter.min_plays)
+            )
+            if puzzle_filter.puzzle_theme_tag:
+                keep &= self._has_tag(
+                    num_rows,
+                    theme_rows,
+                    theme_ids,
+                    self.themes,
+                    puzzle_filter.puzzle_theme_tag,
+                )
+            if puzzle_filter.puzzle_opening_tag:
+                keep &= self._has_tag(
+                    num_rows,
+                    opening_rows,
+                    opening_ids,
+                    self.opening_tags,
+                    puzzle_filter.puzzle_opening_tag,
+                )
+            self.filter_ratings[i] += np.bincount(bins[keep], minlength=NUM_RATING_BINS)
+        return num_rows
+
+    def finish(self) -> PuzzleStats:
+        return PuzzleStats(
+            rating_counts=self.rating_counts,
+            themes=[tag.decode("utf-8") for tag in self.themes],
+            theme_ratings=self.theme_ratings,
+            theme_pairs=self.theme_pairs,
+            opening_tags=[tag.decode("utf-8") for tag in self.opening_tags],
+            opening_ratings=self.opening_ratings,
+            num_without_opening=self.num_without_opening,
+            popularity_values=self.popularity[0],
+            popularity_counts=self.popularity[1],
+            plays_values=self.plays[0],
+            plays_counts=self.plays[1],
+            filter_names=list(STATS_FILTERS),
+            filter_ratings=self.filter_ratings,
+        )
+
+
+def compute_stats(input_file: str) -> PuzzleStats:
+    """PuzzleStats of a puzzle CSV or dump (optionally .zst, .gz or .bz2),
+    in one streaming pass."""
+    with instrumentation.stage("puzzle_stats") as recorder:
+        with open_puzzle_input(input_file) as puzzle_input:
+            header = puzzle_input.stream.readline().decode("utf-8")
+            builder = _StatsBuilder(next(csv.reader([header])))
+            num_rows = 0
+            while True:
+                lines = list(itertools.islice(puzzle_input.stream, STATS_BATCH_ROWS))
+                if not lines:
+                    break
+                num_rows += builder.add_batch(lines)
+            recorder.add(rows=num_rows, bytes_read=puzzle_input.size)
+    return builder.finish()
+
+
+def _stats_fingerprint(input_file: str) -> str:
+    # Filter capacities depend on the filters as well as the input.
+    return ":".join(
+        [
+            str(STATS_VERSION),
+            str(RATING_BIN_WIDTH),
+            source_digest(input_file),
+            repr(list(STATS_FILTERS.items())),
+        ]
+    )
+
+
+def load_stats(input_file: str, use_cache: bool = True) -> PuzzleStats:
+    """PuzzleStats of input_file, cached next to it keyed by its content hash."""
+    cache_file = index_cache_file(input_file, "stats")
+    fingerprint = _stats_fingerprint(input_file)
+    if use_cache:
+        arrays = load_cached_index(cache_file, fingerprint)
+        if arrays is not None:
+            return PuzzleStats.from_arrays(arrays)
+    stats = compute_stats(input_file)
+    save_cached_index(cache_file, fingerprint, stats.to_arrays())
+    return stats
+
+
+def window_counts(rating_counts: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Puzzles within RATING_WINDOW of each target rating, to bin resolution:
+    the candidates RatingIndex draws from before falling back to the nearest
+    RATING_SAMPLE_SIZE."""
+    cumulative = np.concatenate([[0], np.cumsum(rating_counts)])
+    lo = np.clip((targets - RATING_WINDOW) // RATING_BIN_WIDTH, 0, len(rating_counts))
+    hi = np.clip((targets + RATING_WINDOW) // RATING_BIN_WIDTH, 0, len(rating_counts))
+    return cumulative[hi] - cumulative[lo]
+
+
+def _format_quantiles(values: np.ndarray) -> str:
+    return "  ".join(f"{value:>8}" for value in values)
+
+
+def print_report(
+    input_file: str,
+    stats: PuzzleStats,
+    quantiles: Sequence[float] = DEFAULT_QUANTILES,
+    top: int = 25,
+    band_width: int = DEFAULT_BAND_WIDTH,
+):
+    median = rating_quantiles(stats.rating_counts, [0.5])[0]
+    print(f"{input_file}: {stats.num_puzzles} puzzles, median rating {median}")
+
+    print()
+    print(f"{'quantile':<12}" + _format_quantiles([f"q{q:g}" for q in quantiles]))
+    print(
+        f"{'rating':<12}"
+        + _format_quantiles(rating_quantiles(stats.rating_counts, quantiles))
+    )
+    print(
+        f"{'popularity':<12}" + _format_quantiles(stats.popularity_quantiles(quantiles))
+    )
+    print(f"{'plays':<12}" + _format_quantiles(stats.plays_quantiles(quantiles)))
+
+    # Pack capacity: puzzles each filter keeps per rating band. A * marks
+    # bands whose centre has fewer than RATING_SAMPLE_SIZE candidates within
+    # RATING_WINDOW, where puzzle selection widens to the nearest ones.
+    bins_per_band = band_width // RATING_BIN_WIDTH
+    band_counts = stats.filter_ratings.reshape(
+        len(stats.filter_names), -1, bins_per_band
+    ).sum(axis=2)
+    band_starts = np.arange(band_counts.shape[1]) * band_width
+    windows = np.stack(
+        [
+            window_counts(counts, band_starts + band_width // 2)
+            for counts in stats.filter_ratings
+        ]
+    )
+    nonempty = np.flatnonzero(band_counts.sum(axis=0))
+    print()
+    print(f"{'band':<12}" + "".join(f"{name:>14}" for name in stats.filter_names))
+    if len(nonempty):
+        for band in range(nonempty[0], nonempty[-1] + 1):
+            cells = [
+                f"{count}{'*' if window < RATING_SAMPLE_SIZE else ' '}"
+                for count, window in zip(band_counts[:, band], windows[:, band])
+            ]
+            label = f"{band_starts[band]}-{band_starts[band] + band_width - 1}"
+            print(f"{label:<12}" + "".join(f"{cell:>14}" for cell in cells))
+    print(
+        f"{'total':<12}" + "".join(f"{count:>13} " for count in band_counts.sum(axis=1))
+    )
+
+    theme_counts = np.diag(stats.theme_pairs)
+    print()
+    print(f"{len(stats.themes)} themes")
+    for theme_id in np.argsort(-theme_counts, kind="stable")[: top or None]:
+        count = theme_counts[theme_id]
+        low, mid, high = rating_quantiles(
+            stats.theme_ratings[theme_id], [0.1, 0.5, 0.9]
+        )
+        pairs = stats.theme_pairs[theme_id].copy()
+        pairs[theme_id] = 0
+        partners = ", ".join(
+            f"{stats.themes[other]} {pairs[other] / count:.0%}"
+            for other in np.argsort(-pairs, kind="stable")[:3]
+            if pairs[other]
+        )
+        print(
+            f"  {stats.themes[theme_id]:<24}{count:>9}  "
+            f"rating {mid} ({low}-{high})  with {partners}"
+        )
+
+    opening_counts = stats.opening_ratings.sum(axis=1)
+    print()
+    print(
+        f"{len(stats.opening_tags)} opening tags, "
+        f"{stats.num_without_opening} puzzles without one"
+    )
+    for opening_id in np.argsort(-opening_counts, kind="stable")[: top or None]:
+        mid = rating_quantiles(stats.opening_ratings[opening_id], [0.5])[0]
+        print(
+            f"  {stats.opening_tags[opening_id]:<48}"
+            f"{opening_counts[opening_id]:>9}  rating {mid}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rating, popularity, tag and pack capacity statistics of a "
+        "puzzle set or the full dump."
+    )
+    parser.add_argument(
+        "input",
+        nargs="?",
+        default=PUZZLE_INPUT_FILE,
+        help="Puzzle CSV, e.g. puzzles/opening_tag.csv, or the Lichess dump "
+        "(optionally .zst, .gz or .bz2)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=25,
+        help="Number of themes and opening tags to list (0 = all)",
+    )
+    parser.add_argument(
+        "--band-width",
+        type=int,
+        default=DEFAULT_BAND_WIDTH,
+        help=f"Width of the rating bands, a multiple of {RATING_BIN_WIDTH}",
+    )
+    parser.add_argument(
+        "--quantiles",
+        type=float,
+        nargs="+",
+        default=DEFAULT_QUANTILES,
+        help="Quantiles of rating, popularity and plays to report",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Recompute the statistics even if the cached ones match the input",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="profiles",
+        default=None,
+        help="Write a cProfile pstats file per stage to this directory",
+    )
+    args = parser.parse_args()
+    if (
+        args.band_width <= 0
+        or MAX_RATING % args.band_width
+        or (args.band_width % RATING_BIN_WIDTH)
+    ):
+        parser.error(
+            f"--band-width must be a multiple of {RATING_BIN_WIDTH} "
+            f"dividing {MAX_RATING}"
+        )
+    instrumentation.configure(profile_dir=args.profile)
+
+    input_file = find_puzzle_input(args.input)
+    stats = load_stats(input_file, use_cache=not args.no_cache)
+    print_report(input_file, stats, args.quantiles, args.top, args.band_width)
+    instrumentation.get_instrumentation().finish()
@@ -0,0 +1,509 @@
+import bisect
+import csv
+import io
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import Sequence
+from typing import BinaryIO, Dict, Iterator, List, Optional
+
+import numpy as np
+
+import instrumentation
+from process_puzzles import OFFENSIVE_FEN_FIELD, Puzzle, compute_offensive_fen
+
+# On-disk layout of a puzzle store:
+#
+#   MAGIC | header length (u32) | JSON header | padding | column sections
+#
+# The header lists the interned theme and opening tag vocabularies and, for
+# every column, its dtype, byte offset and element count. Columns are
+# 8-byte aligned so each one can be viewed straight out of the memory map:
+#
+#   rating, rating_deviation, popularity, plays   fixed-width per puzzle
+#   theme_bits                                    one bitset row per puzzle
+#   opening_offsets, opening_ids                  interned tag ids per puzzle
+#   move_offsets, move_codes                      UCI moves packed as u16
+#   *_offsets, *_blob                             puzzle id, FEN and the
+#                                                 offensive (post-move) FEN
+#
+# Version 1 stores kept the moves as a string column instead of move codes;
+# they are still readable.
+STORE_MAGIC = b"LPSTORE1"
+STORE_SUFFIX = ".store"
+STORE_VERSION = 2
+READABLE_STORE_VERSIONS = (1, STORE_VERSION)
+
+NUMERIC_COLUMNS = {
+    "rating": "<i2",
+    "rating_deviation": "<i2",
+    "popularity": "<i1",
+    "plays": "<u4",
+}
+STRING_COLUMNS = ["puzzle_id", "fen", "offensive_fen"]
+
+# A move code is from-square | to-square << 6 | promotion << 12, with squares
+# numbered a1=0 .. h8=63 as in python-chess.
+PROMOTION_PIECES = "nbrq"
+FILES = "abcdefgh"
+
+
+def encode_uci_move(move: str) -> int:
+    code = (
+        FILES.index(move[0])
+        + (int(move[1]) - 1) * 8
+        + ((FILES.index(move[2]) + (int(move[3]) - 1) * 8) << 6)
+    )
+    if len(move) == 5:
+        code |= (PROMOTION_PIECES.index(move[4]) + 1) << 12
+    return code
+
+
+def decode_uci_move(code: int) -> str:
+    from_square = code & 63
+    to_square = (code >> 6) & 63
+    promotion = code >> 12
+    move = (
+        f"{FILES[from_square & 7]}{(from_square >> 3) + 1}"
+        f"{FILES[to_square & 7]}{(to_square >> 3) + 1}"
+    )
+    if promotion:
+        move += PROMOTION_PIECES[promotion - 1]
+    return move
+
+
+class StoreVersionError(ValueError):
+    """A store was written in a layout this version cannot read."""
+
+
+def store_file_for(csv_file: str) -> str:
+    return os.path.splitext(csv_file)[0] + STORE_SUFFIX
+
+
+class PuzzleStoreWriter:
+    """Accumulates puzzles column by column and writes them as one store."""
+
+    def __init__(self):
+        self.numeric: Dict[str, array] = {
+            "rating": array("h"),
+            "rating_deviation": array("h"),
+            "popularity": array("b"),
+            "plays": array("I"),
+        }
+        self.blobs: Dict[str, bytearray] = {
+            name: bytearray() for name in STRING_COLUMNS
+        }
+        self.offsets: Dict[str, array] = {
+            name: array("q", [0]) for name in STRING_COLUMNS
+        }
+        self.themes: Dict[str, int] = {}
+        self.theme_offsets = array("q", [0])
+        self.theme_ids = array("I")
+        self.opening_tags: Dict[str, int] = {}
+        self.opening_offsets = array("q", [0])
+        self.opening_ids = array("I")
+        self.move_offsets = array("q", [0])
+        self.move_codes = array("H")
+
+    def __len__(self) -> int:
+        return len(self.numeric["rating"])
+
+    def add_row(self, row: Dict[str, str]):
+        self.numeric["rating"].append(int(row["Rating"]))
+        self.numeric["rating_deviation"].append(int(row["RatingDeviation"]))
+        self.numeric["popularity"].append(int(row["Popularity"]))
+        self.numeric["plays"].append(int(row["NbPlays"]))
+        offensive_fen = row.get(OFFENSIVE_FEN_FIELD) or compute_offensive_fen(
+            row["FEN"], row["Moves"].split()[0]
+        )
+        for name, value in (
+            ("puzzle_id", row["PuzzleId"]),
+            ("fen", row["FEN"]),
+            ("offensive_fen", offensive_fen),
+        ):
+            blob = self.blobs[name]
+            blob += value.encode("utf-8")
+            self.offsets[name].append(len(blob))
+        self.move_codes.extend(encode_uci_move(move) for move in row["Moves"].split())
+        self.move_offsets.append(len(self.move_codes))
+
+        for tag in (row["Themes"] or "").lower().split():
+            self.theme_ids.append(self.themes.setdefault(tag, len(self.themes)))
+        self.theme_offsets.append(len(self.theme_ids))
+        for tag in (row["OpeningTags"] or "").lower().split():
+            self.opening_ids.append(
+                self.opening_tags.setdefault(tag, len(self.opening_tags))
+            )
+        self.opening_offsets.append(len(self.opening_ids))
+
+    def _columns(self):
+        count = len(self)
+        themes = sorted(self.themes)
+        opening_tags = sorted(self.opening_tags)
+        theme_words = max(1, (len(themes) + 63) // 64)
+
+        # Re-number the interned tags so ids follow the sorted vocabulary.
+        theme_remap = np.zeros(len(self.themes), dtype=np.int64)
+        for new_id, tag in enumerate(themes):
+            theme_remap[self.themes[tag]] = new_id
+        opening_remap = np.zeros(len(self.opening_tags), dtype=np.uint32)
+        for new_id, tag in enumerate(opening_tags):
+            opening_remap[self.opening_tags[tag]] = new_id
+
+        theme_bits = np.zeros((count, theme_words), dtype="<u8")
+        theme_ids = theme_remap[np.frombuffer(self.theme_ids, dtype=np.uint32)]
+        theme_rows = np.repeat(
+            np.arange(count),
+            np.diff(np.frombuffer(self.theme_offsets, dtype=np.int64)),
+        )
+        np.bitwise_or.at(
+            theme_bits,
+            (theme_rows, theme_ids // 64),
+            np.left_shift(np.uint64(1), (theme_ids % 64).astype(np.uint64)),
+        )
+
+        columns: Dict[str, np.ndarray] = {
+            name: np.frombuffer(values, dtype=values.typecode).astype(
+                NUMERIC_COLUMNS[name]
+            )
+            for name, values in self.numeric.items()
+        }
+        columns["theme_bits"] = theme_bits.reshape(-1)
+        columns["opening_offsets"] = np.frombuffer(
+            self.opening_offsets, dtype=np.int64
+        ).astype("<u4")
+        columns["opening_ids"] = opening_remap[
+            np.frombuffer(self.opening_ids, dtype=np.uint32)
+        ].astype("<u2" if len(opening_tags) <= 1 << 16 else "<u4")
+        columns["move_offsets"] = np.frombuffer(
+            self.move_offsets, dtype=np.int64
+        ).astype("<u4")
+        columns["move_codes"] = np.frombuffer(self.move_codes, dtype=np.uint16).astype(
+            "<u2"
+        )
+        for name in STRING_COLUMNS:
+            offsets = np.frombuffer(self.offsets[name], dtype=np.int64)
+            if offsets[-1] > np.iinfo(np.uint32).max:
+                raise ValueError(f"Column {name} is too large for a puzzle store")
+            columns[f"{name}_offsets"] = offsets.astype("<u4")
+            columns[f"{name}_blob"] = np.frombuffer(bytes(self.blobs[name]), dtype="u1")
+
+        return count, themes, opening_tags, theme_words, columns
+
+    def write(self, store_file: str):
+        # Write to a temporary file and rename so readers that have the old
+        # store memory-mapped never observe a partially written file.
+        tmp_file = f"{store_file}.tmp{os.getpid()}"
+        with open(tmp_file, "wb") as f:
+            _write_store(f, *self._columns())
+        os.replace(tmp_file, store_file)
+
+    def to_bytes(self) -> bytes:
+        """The store as it would be written to disk, kept in memory."""
+        buffer = io.BytesIO()
+        _write_store(buffer, *self._columns())
+        return buffer.getvalue()
+
+
+def _write_store(
+    f: BinaryIO,
+    count: int,
+    themes: List[str],
+    opening_tags: List[str],
+    theme_words: int,
+    columns: Dict[str, np.ndarray],
+):
+    layout = {}
+    offset = 0
+    for name, values in columns.items():
+        layout[name] = {
+            "dtype": values.dtype.str,
+            "offset": offset,
+            "count": len(values),
+        }
+        offset = _align(offset + values.nbytes)
+    header = json.dumps(
+        {
+            "version": STORE_VERSION,
+            "count": count,
+            "themes": themes,
+            "opening_tags": opening_tags,
+            "theme_words": theme_words,
+            "columns": layout,
+        }
+    ).encode("utf-8")
+    data_start = _align(len(STORE_MAGIC) + 4 + len(header))
+
+    f.write(STORE_MAGIC)
+    f.write(struct.pack("<I", len(header)))
+    f.write(header)
+    for name, values in columns.items():
+        f.seek(data_start + layout[name]["offset"])
+        f.write(values.tobytes())
+    f.truncate(data_start + offset)
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class PuzzleStore(Sequence):
+    """A memory-mapped, read-only columnar puzzle collection.
+
+    Numeric columns are exposed as NumPy views over the mapping, so opening a
+    store costs a header parse regardless of its size, and processes that map
+    the same file share one page-cached copy. Indexing returns a `Puzzle`
+    built on demand from the columns.
+
+    A store can also be opened over an in-memory buffer (see `from_buffer`),
+    which keeps the same compact layout for puzzles that were never written
+    to disk.
+    """
+
+    def __init__(self, store_file: str, buffer: Optional[bytes] = None):
+        self.store_file = store_file
+        if buffer is None:
+            with open(store_file, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmap = buffer
+        if self._mmap[: len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError(f"{store_file} is not a puzzle store")
+        (header_length,) = struct.unpack_from("<I", self._mmap, len(STORE_MAGIC))
+        header_start = len(STORE_MAGIC) + 4
+        header = json.loads(self._mmap[header_start : header_start + header_length])
+        version = header.get("version")
+        if version not in READABLE_STORE_VERSIONS:
+            raise StoreVersionError(
+                f"{store_file} is a version {version} puzzle store, expected "
+                f"version {STORE_VERSION}"
+            )
+        data_start = _align(header_start + header_length)
+
+        self.count: int = header["count"]
+        self.themes: List[str] = header["themes"]
+        self.opening_tags: List[str] = header["opening_tags"]
+        self.theme_words: int = header["theme_words"]
+        self.theme_ids = {tag: i for i, tag in enumerate(self.themes)}
+        self.opening_tag_ids = {tag: i for i, tag in enumerate(self.opening_tags)}
+
+        columns = {
+            name: np.frombuffer(
+                self._mmap,
+                dtype=spec["dtype"],
+                count=spec["count"],
+                offset=data_start + spec["offset"],
+            )
+            for name, spec in header["columns"].items()
+        }
+        self.ratings = columns["rating"]
+        self.rating_deviations = columns["rating_deviation"]
+        self.popularities = columns["popularity"]
+        self.plays = columns["plays"]
+        self.theme_bits = columns["theme_bits"].reshape(self.count, self.theme_words)
+        self.opening_offsets = columns["opening_offsets"]
+        self.opening_ids = columns["opening_ids"]
+        self.move_offsets = columns.get("move_offsets")
+        self.move_codes = columns.get("move_codes")
+        self._strings = {
+            name: (
+                columns[f"{name}_offsets"],
+                data_start + header["columns"][f"{name}_blob"]["offset"],
+            )
+            for name in STRING_COLUMNS + ["moves"]
+            if f"{name}_offsets" in columns
+        }
+
+    @classmethod
+    def from_buffer(cls, buffer: bytes, name: str = "<memory>") -> "PuzzleStore":
+        return cls(name, buffer)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("puzzle store index out of range")
+        return Puzzle(
+            self.string(index, "puzzle_id"),
+            self.string(index, "fen"),
+            self.move_string(index),
+            self.ratings[index],
+            self.rating_deviations[index],
+            self.popularities[index],
+            self.plays[index],
+            self.theme_string(index),
+            self.opening_tag_string(index),
+            self.string(index, "offensive_fen"),
+        )
+
+    def __iter__(self) -> Iterator[Puzzle]:
+        for i in range(self.count):
+            yield self[i]
+
+    def string(self, index: int, column: str) -> Optional[str]:
+        if column not in self._strings:
+            return None
+        offsets, blob_start = self._strings[column]
+        start = blob_start + int(offsets[index])
+        end = blob_start + int(offsets[index + 1])
+        return self._mmap[start:end].decode("utf-8")
+
+    def move_string(self, index: int) -> str:
+        if self.move_codes is None:
+            return self.string(index, "moves")
+        start = self.move_offsets[index]
+        end = self.move_offsets[index + 1]
+        return " ".join(
+            decode_uci_move(int(code)) for code in self.move_codes[start:end]
+        )
+
+    def theme_string(self, index: int) -> str:
+        tags = []
+        for word_index, word in enumerate(self.theme_bits[index]):
+            word = int(word)
+            while word:
+                bit = word & -word
+                tags.append(self.themes[word_index * 64 + bit.bit_length() - 1])
+                word ^= bit
+        return " ".join(tags)
+
+    def opening_tag_string(self, index: int) -> str:
+        start = self.opening_offsets[index]
+        end = self.opening_offsets[index + 1]
+        return " ".join(self.opening_tags[i] for i in self.opening_ids[start:end])
+
+    def theme_mask(self, theme: str) -> np.ndarray:
+        """Boolean mask of the puzzles tagged with `theme`."""
+        theme_id = self.theme_ids.get(theme.lower())
+        if theme_id is None:
+            return np.zeros(self.count, dtype=bool)
+        word = self.theme_bits[:, theme_id // 64]
+        return (word & np.uint64(1 << (theme_id % 64))) != 0
+
+
+class PuzzleSubset(Sequence):
+    """A view over selected positions of another puzzle sequence."""
+
+    def __init__(self, puzzles: Sequence, indices: np.ndarray):
+        self.puzzles = puzzles
+        self.indices = indices
+
+    @property
+    def ratings(self) -> np.ndarray:
+        return puzzle_ratings(self.puzzles)[self.indices]
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PuzzleSubset(self.puzzles, self.indices[index])
+        return self.puzzles[int(self.indices[index])]
+
+
+class PuzzleChain(Sequence):
+    """A read-only concatenation of puzzle sequences that copies no puzzles."""
+
+    def __init__(self, parts: List[Sequence]):
+        self.parts = parts
+        self.starts = []
+        total = 0
+        for part in parts:
+            self.starts.append(total)
+            total += len(part)
+        self.count = total
+        self._ratings: Optional[np.ndarray] = None
+
+    @property
+    def ratings(self) -> np.ndarray:
+        if self._ratings is None:
+            self._ratings = np.concatenate(
+                [puzzle_ratings(part) for part in self.parts]
+                or [np.zeros(0, dtype="<i2")]
+            )
+        return self._ratings
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("puzzle chain index out of range")
+        part_index = bisect.bisect_right(self.starts, index) - 1
+        return self.parts[part_index][index - self.starts[part_index]]
+
+    def __iter__(self) -> Iterator[Puzzle]:
+        for part in self.parts:
+            yield from part
+
+
+def puzzle_ratings(puzzles: Sequence) -> np.ndarray:
+    """The ratings of a puzzle sequence as an array, without copying columns."""
+    ratings = getattr(puzzles, "ratings", None)
+    if ratings is None:
+        ratings = np.fromiter(
+            (puzzle.rating for puzzle in puzzles), dtype=np.int32, count=len(puzzles)
+        )
+    return ratings
+
+
+def _read_puzzle_csv(csv_file: str) -> PuzzleStoreWriter:
+    writer = PuzzleStoreWriter()
+    with open(csv_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            writer.add_row(row)
+    return writer
+
+
+def build_puzzle_store(csv_file: str, store_file: Optional[str] = None) -> str:
+    store_file = store_file or store_file_for(csv_file)
+    _read_puzzle_csv(csv_file).write(store_file)
+    return store_file
+
+
+def load_puzzles(csv_file: str) -> Sequence:
+    """Load a filtered puzzle CSV, preferring its store when it is up to date."""
+    store_file = store_file_for(csv_file)
+    if os.path.exists(store_file) and (
+        not os.path.exists(csv_file)
+        or os.path.getmtime(store_file) >= os.path.getmtime(csv_file)
+    ):
+        try:
+            store = PuzzleStore(store_file)
+        except StoreVersionError:
+            if not os.path.exists(csv_file):
+                raise
+        else:
+            instrumentation.cache_hit("puzzle_store")
+            return store
+        # The store predates this layout; rebuild it from the CSV.
+        instrumentation.cache_miss("puzzle_store")
+        return PuzzleStore(build_puzzle_store(csv_file, store_file))
+
+    # Without a store on disk, build the same columnar layout in memory rather
+    # than holding one Puzzle object per row. Rows without an offensive FEN
+    # would replay every puzzle through python-chess on each load, so that is
+    # left to the store command, which pays for it once.
+    with open(csv_file, "r", newline="") as f:
+        fieldnames = next(csv.reader(f), [])
+    if OFFENSIVE_FEN_FIELD not in fieldnames:
+        raise ValueError(
+            f"{csv_file} has no {OFFENSIVE_FEN_FIELD} column; run "
+            "`python process_puzzles.py store` to build its puzzle store"
+        )
+    instrumentation.cache_miss("puzzle_store")
+    with instrumentation.stage(f"load_csv:{os.path.basename(csv_file)}") as recorder:
+        writer = _read_puzzle_csv(csv_file)
+        puzzles = PuzzleStore.from_buffer(writer.to_bytes(), csv_file)
+        recorder.add(rows=len(puzzles), bytes_read=os.path.getsize(csv_file))
+    return puzzles
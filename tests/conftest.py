@@ -0,0 +1,91 @@
+import csv
+from typing import Dict, List
+
+import pytest
+
+PUZZLE_FIELDS = [
+    "PuzzleId",
+    "FEN",
+    "Moves",
+    "Rating",
+    "RatingDeviation",
+    "Popularity",
+    "NbPlays",
+    "Themes",
+    "GameUrl",
+    "OpeningTags",
+]
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+
+def puzzle_row(puzzle_id: str, **fields) -> Dict[str, str]:
+    """A dump row that passes every default filter threshold."""
+    row = {
+        "PuzzleId": puzzle_id,
+        "FEN": START_FEN,
+        "Moves": "e2e4 e7e5 g1f3 b8c6",
+        "Rating": "1500",
+        "RatingDeviation": "75",
+        "Popularity": "90",
+        "NbPlays": "20000",
+        "Themes": "opening short",
+        "GameUrl": f"https://lichess.org/{puzzle_id}",
+        "OpeningTags": "Kings_Pawn_Game",
+    }
+    row.update({name: str(value) for name, value in fields.items()})
+    return row
+
+
+@pytest.fixture
+def make_row():
+    return puzzle_row
+
+
+@pytest.fixture
+def write_dump(tmp_path):
+    """Write rows as a puzzle CSV under tmp_path and return its path."""
+
+    def write(name: str, rows: List[Dict[str, str]]) -> str:
+        path = tmp_path / name
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=list(rows[0]) if rows else PUZZLE_FIELDS
+            )
+            writer.writeheader()
+            writer.writerows(rows)
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def puzzle_generator(write_dump):
+    """A PuzzleGenerator over "Pack", 400 puzzles rated 1000-1399 that each
+    have their own position, and "Repeated", which lists one puzzle twice."""
+    from generate_puzzles import PuzzleGenerator, PuzzlePacks
+    from process_puzzles import compute_offensive_fen
+
+    pack = []
+    for i in range(400):
+        # The move number tells the positions apart.
+        fen = START_FEN.replace(" 0 1", f" 0 {i + 1}")
+        pack.append(
+            puzzle_row(
+                f"p{i}",
+                FEN=fen,
+                Rating=1000 + i,
+                OffensiveFEN=compute_offensive_fen(fen, "e2e4"),
+            )
+        )
+    offensive_fen = compute_offensive_fen(START_FEN, "e2e4")
+    repeated = [
+        puzzle_row(puzzle_id, OffensiveFEN=offensive_fen) for puzzle_id in "aabc"
+    ]
+    generator = PuzzleGenerator()
+    generator.puzzle_mapping = PuzzlePacks(
+        {
+            "Pack": write_dump("pack.csv", pack),
+            "Repeated": write_dump("repeated.csv", repeated),
+        }
+    )
+    return generator
@@ -0,0 +1,151 @@
+import json
+import os
+
+import chess
+import pytest
+
+import board_images
+from board_images import (
+    RenderSettings,
+    board_key,
+    image_path,
+    read_pack_fens,
+    render_fens,
+    render_packs,
+)
+
+START = chess.STARTING_FEN
+# The same placement with black to move and no castling rights.
+START_BLACK = START.replace(" w KQkq - 0 1", " b - - 3 9")
+AFTER_E4 = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+
+
+@pytest.fixture
+def rendered(monkeypatch):
+    """Replace the renderer with one that writes the FEN to the image path,
+    recording every board it renders."""
+    renders = []
+
+    def render(task):
+        fen, settings, path = task
+        renders.append(fen)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(fen)
+        return path
+
+    monkeypatch.setattr(board_images, "_render_board", render)
+    return renders
+
+
+def test_key_ignores_everything_but_the_placement():
+    assert board_key(START) == board_key(START_BLACK)
+    assert board_key(START) != board_key(AFTER_E4)
+
+
+def test_settings_name_the_cache_directory(tmp_path):
+    default = image_path(str(tmp_path), RenderSettings(), START)
+    assert default.endswith(".png")
+    assert os.path.basename(os.path.dirname(default)) == board_key(START)[:2]
+    for settings in [
+        RenderSettings(square_size=16),
+        RenderSettings(coordinates=False),
+        RenderSettings(image_format="webp"),
+    ]:
+        path = image_path(str(tmp_path), settings, START)
+        assert os.path.dirname(os.path.dirname(path)) != os.path.dirname(
+            os.path.dirname(default)
+        )
+
+
+def test_read_pack_fens(tmp_path):
+    pgn = tmp_path / "pack.pgn"
+    pgn.write_text(
+        f'[FEN "{START}"]\n[SITE "https://lichess.org/training/a"]\n\n*\n\n'
+        f'[FEN "{AFTER_E4}"]\n[SITE "https://lichess.org/training/b"]\n\n*\n\n'
+    )
+    json_pack = tmp_path / "pack.json"
+    json_pack.write_text(
+        json.dumps(
+            {
+                "version": 1,
+                "fields": ["fen", "elo", "defensive"],
+                "puzzles": [[START, 1000, 0], [AFTER_E4, 1100, 1]],
+            }
+        )
+    )
+    static_csv = tmp_path / "static.csv"
+    static_csv.write_text(f"fen,elo\n{START},1000\n{AFTER_E4},1100\n")
+    for pack_file in (pgn, json_pack, static_csv):
+        assert read_pack_fens(str(pack_file)) == [START, AFTER_E4]
+
+    not_a_pack = tmp_path / "index.json"
+    not_a_pack.write_text('{"shards": []}')
+    with pytest.raises(ValueError):
+        read_pack_fens(str(not_a_pack))
+
+
+def test_puzzle_set_csv_uses_the_fen_column(make_row, write_dump):
+    dump = write_dump("opening.csv", [make_row("p1"), make_row("p2", FEN=AFTER_E4)])
+    assert read_pack_fens(dump) == [make_row("p1")["FEN"], AFTER_E4]
+
+
+def test_identical_positions_render_once(tmp_path, rendered):
+    cache_dir = str(tmp_path / "cache")
+    paths = render_fens([START, START_BLACK, AFTER_E4], cache_dir)
+    assert len(rendered) == 2
+    assert paths[START] == paths[START_BLACK] != paths[AFTER_E4]
+
+    # Cached boards are not rendered again; other settings are another cache.
+    render_fens([START, AFTER_E4], cache_dir)
+    assert len(rendered) == 2
+    render_fens([START], cache_dir, RenderSettings(square_size=16))
+    assert len(rendered) == 3
+
+
+def test_packs_share_renders(tmp_path, rendered):
+    first = tmp_path / "first.csv"
+    first.write_text(f"fen,elo\n{START},1000\n{AFTER_E4},1100\n")
+    second = tmp_path / "second.csv"
+    second.write_text(f"fen,elo\n{AFTER_E4},1100\n{START_BLACK},1200\n")
+    paths = render_packs([str(first), str(second)], str(tmp_path / "cache"))
+    assert sorted(rendered) == sorted([START, AFTER_E4])
+    assert paths[str(second)] == [paths[str(first)][1], paths[str(first)][0]]
+
+
+def test_sprite_sheet(tmp_path, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    settings = RenderSettings(square_size=4)
+
+    def render(task):
+        fen, settings, path = task
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        color = (255, 0, 0) if fen == START else (0, 0, 255)
+        Image.new("RGB", (32, 32), color).save(path, format="PNG")
+        return path
+
+    monkeypatch.setattr(board_images, "_render_board", render)
+    pack = tmp_path / "pack.csv"
+    pack.write_text(f"fen,elo\n{START},1\n{AFTER_E4},2\n{START_BLACK},3\n")
+    sprite_dir = tmp_path / "sprites"
+    render_packs(
+        [str(pack)], str(tmp_path / "cache"), settings, sprite_dir=str(sprite_dir)
+    )
+
+    with open(sprite_dir / "pack.sprite.json") as f:
+        index = json.load(f)
+    assert index["fens"] == [0, 1, 0]
+    with Image.open(sprite_dir / "pack.sprite.png") as sheet:
+        assert sheet.size == (64, 32)
+        assert sheet.getpixel((0, 0)) == (255, 0, 0)
+        assert sheet.getpixel((32, 0)) == (0, 0, 255)
+
+
+def test_render_with_fentoimage(tmp_path):
+    pytest.importorskip("fentoimage")
+    Image = pytest.importorskip("PIL.Image")
+    settings = RenderSettings(square_size=16)
+    paths = render_fens([START, AFTER_E4], str(tmp_path), settings, num_workers=2)
+    for path in paths.values():
+        with Image.open(path) as image:
+            assert image.size[0] >= 16 * 8
@@ -0,0 +1,182 @@
+import csv
+import os
+
+import pytest
+
+from process_puzzles import (
+    OPTIONAL_FILTER_MAPPING,
+    PUZZLE_FILTER_MAPPING,
+    MAX_FILTERS,
+    FilterPlan,
+    PuzzleUpdate,
+    _content_hash,
+    _patch_output,
+    filter_puzzles,
+    load_fingerprints,
+)
+
+FILTERS = {**PUZZLE_FILTER_MAPPING, **OPTIONAL_FILTER_MAPPING}
+
+
+def read_output(output_dir, filter_name):
+    with open(os.path.join(output_dir, f"{filter_name}.csv"), newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def output_rows(output_dir, filters=FILTERS):
+    """Each output's rows by puzzle id, checking no id appears twice."""
+    outputs = {}
+    for filter_name in filters:
+        rows = read_output(output_dir, filter_name)
+        ids = [row["PuzzleId"] for row in rows]
+        assert len(ids) == len(set(ids)), f"duplicate rows in {filter_name}"
+        outputs[filter_name] = {row["PuzzleId"]: row for row in rows}
+    return outputs
+
+
+def output_bytes(output_dir, filters=FILTERS):
+    outputs = {}
+    for filter_name in filters:
+        with open(os.path.join(output_dir, f"{filter_name}.csv"), "rb") as f:
+            outputs[filter_name] = f.read()
+    return outputs
+
+
+@pytest.fixture
+def dumps(make_row, write_dump):
+    before = [
+        make_row("p1"),
+        make_row("p2", Themes="middlegame fork"),
+        make_row("p3", Themes="endgame mate"),
+        make_row("p4", NbPlays=500),
+        make_row("p5", Rating=3000, Themes="middlegame"),
+    ]
+    after = [
+        # p2 removed; p1 leaves opening but stays in opening_tag.
+        make_row("p1", Rating=2200),
+        # The position is unchanged, so its offensive FEN is kept.
+        make_row("p3", Themes="endgame mate", Rating=1600),
+        # Only a counter drifts.
+        make_row("p4", NbPlays=600),
+        # A new position enters middlegame.
+        make_row("p5", Themes="middlegame", Moves="d2d4 d7d5 c2c4"),
+        make_row("p6", Themes="endgame"),
+    ]
+    return write_dump("before.csv", before), write_dump("after.csv", after)
+
+
+def test_delta_matches_full_run(tmp_path, dumps):
+    before, after = dumps
+    delta_dir = str(tmp_path / "delta")
+    full_dir = str(tmp_path / "full")
+    filter_puzzles(before, delta_dir, filters=FILTERS)
+    filter_puzzles(after, delta_dir, delta=True, filters=FILTERS)
+    filter_puzzles(after, full_dir, filters=FILTERS)
+
+    assert output_bytes(delta_dir) == output_bytes(full_dir)
+    assert set(output_rows(delta_dir)["middlegame"]) == {"p5"}
+
+
+def test_delta_keeps_offensive_fen_of_unchanged_positions(tmp_path, dumps):
+    before, after = dumps
+    output_dir = str(tmp_path / "puzzles")
+    filter_puzzles(before, output_dir, filters=FILTERS)
+    # Mark the stored FEN so a replay would be noticed.
+    endgame_file = os.path.join(output_dir, "endgame.csv")
+    with open(endgame_file) as f:
+        text = f.read()
+    with open(endgame_file, "w") as f:
+        f.write(text.replace(" 0 1\n", " 0 99\n"))
+
+    filter_puzzles(after, output_dir, delta=True, filters=FILTERS)
+
+    endgame = output_rows(output_dir)["endgame"]
+    assert endgame["p3"]["Rating"] == "1600"
+    assert endgame["p3"]["OffensiveFEN"].endswith(" 0 99")
+    assert endgame["p6"]["OffensiveFEN"].endswith(" 0 1")
+
+
+def test_delta_refreshes_counters_without_replay(tmp_path, dumps):
+    before, after = dumps
+    output_dir = str(tmp_path / "puzzles")
+    filter_puzzles(before, output_dir, filters=FILTERS)
+    all_file = os.path.join(output_dir, "all.csv")
+    with open(all_file) as f:
+        text = f.read()
+    with open(all_file, "w") as f:
+        f.write(text.replace(" 0 1\n", " 0 99\n"))
+
+    filter_puzzles(after, output_dir, delta=True, filters=FILTERS)
+
+    p4 = output_rows(output_dir)["all"]["p4"]
+    assert p4["NbPlays"] == "600"
+    assert p4["OffensiveFEN"].endswith(" 0 99")
+
+
+def test_full_run_replaces_fingerprints(tmp_path, dumps):
+    before, after = dumps
+    output_dir = str(tmp_path / "puzzles")
+    filter_puzzles(before, output_dir, filters=FILTERS)
+    filter_puzzles(after, output_dir, filters=FILTERS)
+    expected = output_rows(output_dir)
+
+    # The fingerprints describe the second dump, so there is nothing to patch.
+    filter_puzzles(after, output_dir, delta=True, filters=FILTERS)
+    assert output_rows(output_dir) == expected
+
+
+def test_delta_with_other_filters_runs_in_full(tmp_path, dumps):
+    before, after = dumps
+    output_dir = str(tmp_path / "puzzles")
+    filter_puzzles(before, output_dir, filters=FILTERS)
+    assert load_fingerprints(output_dir, PUZZLE_FILTER_MAPPING) is None
+
+    filter_puzzles(after, output_dir, delta=True)
+    assert load_fingerprints(output_dir, PUZZLE_FILTER_MAPPING) is not None
+
+
+def test_filters_past_32_bits(tmp_path, make_row, write_dump):
+    # Bits 32 and up must survive the fingerprints and the delta run.
+    filters = {f"f{i}": FILTERS["all"] for i in range(40)}
+    filters["endgame"] = FILTERS["endgame"]
+    output_dir = str(tmp_path / "puzzles")
+    before = write_dump("before.csv", [make_row("p1")])
+    after = write_dump("after.csv", [make_row("p1"), make_row("p2", Themes="endgame")])
+    filter_puzzles(before, output_dir, filters=filters)
+    filter_puzzles(after, output_dir, delta=True, filters=filters)
+
+    assert set(output_rows(output_dir, ["f39", "endgame"])["endgame"]) == {"p2"}
+    assert set(output_rows(output_dir, ["f39"])["f39"]) == {"p1", "p2"}
+    masks = load_fingerprints(output_dir, filters).masks
+    assert masks.tolist() == [(1 << 40) - 1, (1 << 41) - 1]
+
+
+def test_too_many_filters(make_row):
+    filters = {f"f{i}": FILTERS["all"] for i in range(MAX_FILTERS + 1)}
+    with pytest.raises(ValueError, match="At most 64 filters"):
+        FilterPlan(filters, list(make_row("p1")))
+
+
+def test_patch_output_skips_ids_already_present(tmp_path, make_row, write_dump):
+    plan = FilterPlan(PUZZLE_FILTER_MAPPING, list(make_row("p1")))
+    flag = 1 << plan.filter_bits["opening"]
+    output_file = write_dump(
+        "opening.csv",
+        [dict(make_row(puzzle_id), OffensiveFEN="kept") for puzzle_id in ("p1", "p2")],
+    )
+
+    def update(puzzle_id):
+        values = list(make_row(puzzle_id).values())
+        line = (",".join(values) + "\n").encode()
+        return PuzzleUpdate(flag, 0, _content_hash(values), line, values)
+
+    # The fingerprints claim p2 is new, yet the file already holds it.
+    updates = {b"p2": update("p2"), b"p3": update("p3")}
+    count = _patch_output(plan, output_file, flag, {b"p1": 0}, updates)
+
+    with open(output_file, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["PuzzleId"] for row in rows] == ["p2", "p3"]
+    assert rows[0]["OffensiveFEN"] == "kept"
+    assert rows[1]["OffensiveFEN"].startswith("rnbqkbnr/pppppppp/8/8/4P3/")
+    assert count == 2
@@ -0,0 +1,41 @@
+import os
+
+import process_puzzles
+from process_puzzles import (
+    FINGERPRINT_FILE,
+    OPTIONAL_FILTER_MAPPING,
+    PUZZLE_FILTER_MAPPING,
+    filter_puzzles,
+)
+
+FILTERS = {**PUZZLE_FILTER_MAPPING, **OPTIONAL_FILTER_MAPPING}
+THEMES = ["opening fork", "middlegame pin", "endgame mate", "opening", "short"]
+
+
+def test_parallel_filter_matches_serial(tmp_path, monkeypatch, make_row, write_dump):
+    rows = [
+        make_row(
+            f"p{i:03d}",
+            Rating=700 + i * 7,
+            NbPlays=50 + i * 137,
+            Themes=THEMES[i % len(THEMES)],
+        )
+        for i in range(300)
+    ]
+    dump = write_dump("dump.csv", rows)
+    # Many small chunks, with fewer in flight than there are chunks.
+    monkeypatch.setattr(process_puzzles, "FILTER_CHUNK_SIZE", 2048)
+    monkeypatch.setattr(process_puzzles, "FILTER_CHUNKS_PER_WORKER", 1)
+
+    serial_dir = str(tmp_path / "serial")
+    parallel_dir = str(tmp_path / "parallel")
+    filter_puzzles(dump, serial_dir, num_workers=1, filters=FILTERS)
+    filter_puzzles(dump, parallel_dir, num_workers=3, filters=FILTERS)
+
+    for name in [f"{filter_name}.csv" for filter_name in FILTERS] + [FINGERPRINT_FILE]:
+        with open(os.path.join(serial_dir, name), "rb") as f:
+            expected = f.read()
+        with open(os.path.join(parallel_dir, name), "rb") as f:
+            assert f.read() == expected, name
+    # No part files are left behind.
+    assert not [name for name in os.listdir(parallel_dir) if name.startswith(".")]
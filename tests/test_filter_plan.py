@@ -0,0 +1,58 @@
+import csv
+import os
+
+import pytest
+
+from process_puzzles import (
+    OPTIONAL_FILTER_MAPPING,
+    PUZZLE_FILTER_MAPPING,
+    FilterPlan,
+    Puzzle,
+    filter_puzzles,
+)
+
+FILTERS = {**PUZZLE_FILTER_MAPPING, **OPTIONAL_FILTER_MAPPING}
+
+
+@pytest.fixture
+def rows(make_row):
+    return [
+        make_row("p1"),
+        make_row("p2", Themes="Opening opening fork"),
+        make_row("p3", Themes="endgame ENDGAME endgame", NbPlays=50000),
+        make_row("p4", Rating=600, Themes="opening"),
+        make_row("p5", Popularity=30, NbPlays=50),
+        make_row("p6", Rating=2600, Themes="middlegame"),
+        make_row("p7", Themes="", OpeningTags=""),
+    ]
+
+
+def test_match_agrees_with_apply_filter(rows):
+    plan = FilterPlan(FILTERS, list(rows[0]))
+    for row in rows:
+        puzzle = Puzzle.from_dict(row)
+        expected = [
+            name
+            for name, puzzle_filter in FILTERS.items()
+            if puzzle.apply_filter(puzzle_filter)
+        ]
+        assert sorted(plan.match(list(row.values()))) == sorted(expected)
+
+
+def test_repeated_theme_matches_once(rows):
+    plan = FilterPlan(FILTERS, list(rows[0]))
+    assert sorted(plan.match(list(rows[1].values()))) == [
+        "all",
+        "opening",
+        "opening_tag",
+    ]
+    assert sorted(plan.match(list(rows[2].values()))) == ["all", "endgame"]
+
+
+def test_repeated_theme_is_written_once(tmp_path, rows, write_dump):
+    output_dir = str(tmp_path / "puzzles")
+    filter_puzzles(write_dump("dump.csv", rows), output_dir, filters=FILTERS)
+    for filter_name in FILTERS:
+        with open(os.path.join(output_dir, f"{filter_name}.csv"), newline="") as f:
+            ids = [row["PuzzleId"] for row in csv.DictReader(f)]
+        assert len(ids) == len(set(ids))
@@ -0,0 +1,116 @@
+import asyncio
+import json
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import lichess_games
+from lichess_games import LichessGamesFetcher, game_structures
+
+OPENINGS = ["e4", "d4", "c4", "e4 e5", "d4 d5", "e4 c5", "d4 Nf6 c4", "g3"]
+
+
+class StubBackend:
+    """Serves a user's games from memory the way the games API does: newest
+    first, honouring max, since and until."""
+
+    def __init__(self, games):
+        self.games = games
+        self.requests = []
+
+    async def get(self, url, headers):
+        params = {
+            k: int(v[0])
+            for k, v in parse_qs(urlsplit(url).query).items()
+            if k in ("max", "since", "until")
+        }
+        self.requests.append(params)
+        games = [
+            game
+            for game in sorted(self.games, key=lambda g: -g["createdAt"])
+            if game["createdAt"] >= params.get("since", 0)
+            and game["createdAt"] <= params.get("until", float("inf"))
+        ][: params["max"]]
+        return 200, "".join(json.dumps(game) + "\n" for game in games).encode()
+
+
+def make_game(i):
+    return {"id": f"g{i}", "createdAt": 1000 + i, "moves": OPENINGS[i % len(OPENINGS)]}
+
+
+def expected_structures(games):
+    structures = set()
+    for game in games:
+        structures |= game_structures(game["moves"])
+    return structures
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(lichess_games.time, "monotonic", lambda: now[0])
+    return now
+
+
+def get(fetcher, username, num_games):
+    return asyncio.run(fetcher.get_structures(username, num_games))
+
+
+def test_ttl_hit_makes_no_request(clock):
+    backend = StubBackend([make_game(i) for i in range(5)])
+    fetcher = LichessGamesFetcher(backend, ttl=60)
+    structures = get(fetcher, "Alice", 3)
+    assert structures == expected_structures(backend.games[2:])
+    clock[0] = 59
+    assert get(fetcher, "alice", 3) == structures
+    # Fewer games are served from the same entry.
+    assert get(fetcher, "ALICE", 1) == expected_structures(backend.games[4:])
+    assert len(backend.requests) == 1
+
+
+def test_more_games_only_fetches_older_ones(clock):
+    backend = StubBackend([make_game(i) for i in range(60)])
+    fetcher = LichessGamesFetcher(backend, ttl=60)
+    get(fetcher, "alice", 20)
+    assert get(fetcher, "alice", 50) == expected_structures(backend.games[10:])
+    assert backend.requests[1] == {"max": 30, "until": 1000 + 40 - 1}
+    # A user with fewer games than asked for has nothing older to fetch.
+    assert get(fetcher, "alice", 100) == expected_structures(backend.games)
+    assert get(fetcher, "alice", 200) == expected_structures(backend.games)
+    assert len(backend.requests) == 3
+
+
+def test_lru_eviction(clock):
+    backend = StubBackend([make_game(i) for i in range(3)])
+    fetcher = LichessGamesFetcher(backend, ttl=60, max_users=2)
+    get(fetcher, "a", 3)
+    get(fetcher, "b", 3)
+    get(fetcher, "a", 3)
+    get(fetcher, "c", 3)
+    assert list(fetcher.cache) == ["a", "c"]
+    get(fetcher, "a", 3)
+    assert len(backend.requests) == 3
+    get(fetcher, "b", 3)
+    assert len(backend.requests) == 4
+
+
+def test_incremental_refresh(clock):
+    backend = StubBackend([make_game(i) for i in range(5)])
+    fetcher = LichessGamesFetcher(backend, ttl=60)
+    get(fetcher, "alice", 4)
+
+    clock[0] = 60
+    # A game already cached comes back alongside the new ones.
+    backend.games += [make_game(5), make_game(6)]
+    original = backend.get
+
+    async def get_with_repeat(url, headers):
+        status, body = await original(url, headers)
+        return status, body + (json.dumps(make_game(4)) + "\n").encode()
+
+    backend.get = get_with_repeat
+    structures = get(fetcher, "alice", 4)
+    assert backend.requests[-1] == {"max": 4, "since": 1000 + 4 + 1}
+    games = fetcher.cache["alice"].games
+    assert [game.game_id for game in games] == ["g6", "g5", "g4", "g3"]
+    assert structures == expected_structures(backend.games[3:])
@@ -0,0 +1,87 @@
+import csv
+import os
+
+import chess
+import pytest
+
+import process_puzzles
+from process_puzzles import (
+    OFFENSIVE_FEN_FIELD,
+    PUZZLE_FILTER_MAPPING,
+    Puzzle,
+    compute_offensive_fen,
+    filter_puzzles,
+)
+
+SICILIAN_FEN = "rnbqkbnr/pp1ppppp/8/2p5/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2"
+# White to move after ...d7d5, so the first move can take en passant.
+EN_PASSANT_FEN = "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3"
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.mark.parametrize(
+    "fen, first_move",
+    [(SICILIAN_FEN, "g1f3"), (EN_PASSANT_FEN, "e5f6"), (SICILIAN_FEN, "e1e2")],
+)
+def test_offensive_fen_plays_the_first_move(fen, first_move):
+    board = chess.Board(fen)
+    board.push_uci(first_move)
+    assert compute_offensive_fen(fen, first_move) == board.fen()
+
+
+def test_filtered_rows_carry_the_offensive_fen(tmp_path, make_row, write_dump):
+    rows = [
+        make_row("p1"),
+        make_row("p2", FEN=SICILIAN_FEN, Moves="g1f3 d7d6"),
+        make_row("p3", FEN=EN_PASSANT_FEN, Moves="e5f6 g8f6"),
+    ]
+    output_dir = str(tmp_path / "puzzles")
+    filter_puzzles(write_dump("dump.csv", rows), output_dir)
+
+    filtered = read_rows(os.path.join(output_dir, "opening.csv"))
+    assert [row["PuzzleId"] for row in filtered] == ["p1", "p2", "p3"]
+    for row in filtered:
+        assert row[OFFENSIVE_FEN_FIELD] == compute_offensive_fen(
+            row["FEN"], row["Moves"].split()[0]
+        )
+
+
+def test_filtering_filtered_output_keeps_its_column(
+    tmp_path, monkeypatch, make_row, write_dump
+):
+    dump = write_dump("dump.csv", [make_row("p1", OffensiveFEN="stored")])
+
+    def fail(fen, first_move):
+        raise AssertionError("replayed a stored offensive FEN")
+
+    monkeypatch.setattr(process_puzzles, "compute_offensive_fen", fail)
+    output_dir = str(tmp_path / "puzzles")
+    filter_puzzles(dump, output_dir, filters=PUZZLE_FILTER_MAPPING)
+    (row,) = read_rows(os.path.join(output_dir, "opening.csv"))
+    assert list(row).count(OFFENSIVE_FEN_FIELD) == 1
+    assert row[OFFENSIVE_FEN_FIELD] == "stored"
+
+
+def test_puzzle_position_uses_the_stored_fen(monkeypatch, make_row):
+    calls = []
+    real = compute_offensive_fen
+
+    def counting(fen, first_move):
+        calls.append(fen)
+        return real(fen, first_move)
+
+    monkeypatch.setattr(process_puzzles, "compute_offensive_fen", counting)
+    stored = Puzzle.from_dict(make_row("p1", OffensiveFEN="stored"))
+    assert stored.generate_puzzle_position(False) == "stored"
+    assert stored.generate_puzzle_position(True) == stored.fen
+
+    # Rows written before the column existed replay the move once.
+    legacy = Puzzle.from_dict(make_row("p2"))
+    expected = real(legacy.fen, "e2e4")
+    assert legacy.generate_puzzle_position(False) == expected
+    assert legacy.generate_puzzle_position(False) == expected
+    assert len(calls) == 1
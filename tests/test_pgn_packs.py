@@ -0,0 +1,110 @@
+import gzip
+import os
+import random
+import re
+
+import pytest
+
+from process_puzzles import (
+    PUZZLE_FILTER_MAPPING,
+    PgnPackSpec,
+    Reservoir,
+    compute_offensive_fen,
+    generate_pgn_packs,
+    write_pgn_packs,
+)
+
+ENDGAME = PUZZLE_FILTER_MAPPING["endgame"]
+
+
+def sample(size, num_items, seed):
+    reservoir = Reservoir(size, random.Random(seed))
+    for i in range(num_items):
+        reservoir.offer(i)
+        assert len(reservoir.items) == min(size, i + 1)
+    return reservoir.items
+
+
+def test_reservoir_keeps_at_most_its_size():
+    assert sorted(sample(5, 3, 0)) == [0, 1, 2]
+    assert sample(0, 10, 0) == []
+    items = sample(50, 10000, 1)
+    assert len(items) == len(set(items)) == 50
+
+
+def test_reservoir_sample_is_uniform():
+    size, num_items, trials = 5, 20, 4000
+    counts = [0] * num_items
+    for seed in range(trials):
+        for item in sample(size, num_items, seed):
+            counts[item] += 1
+    # Each item is kept with probability size / num_items; 0.03 is over four
+    # standard deviations of the observed rate.
+    for count in counts:
+        assert abs(count / trials - size / num_items) < 0.03
+
+
+@pytest.fixture
+def dump(make_row, write_dump):
+    rows = [
+        make_row(
+            f"p{i:03d}",
+            Themes="endgame mate" if i % 4 == 0 else "opening short",
+            Rating=1000 + i,
+        )
+        for i in range(400)
+    ]
+    return write_dump("dump.csv", rows)
+
+
+def entry_ids(entries):
+    return [re.search(r"training/(\w+)", entry).group(1) for entry in entries]
+
+
+def test_packs_sharing_a_filter_do_not_repeat(dump):
+    specs = [
+        PgnPackSpec("endgame_1.pgn", 10, ENDGAME),
+        PgnPackSpec("endgame_2.pgn", 15, ENDGAME),
+        PgnPackSpec("any.pgn", 30),
+    ]
+    pgns = generate_pgn_packs(dump, specs, seed=3)
+    endgame = entry_ids(pgns["endgame_1.pgn"]) + entry_ids(pgns["endgame_2.pgn"])
+    assert len(endgame) == len(set(endgame)) == 25
+    assert all(int(puzzle_id[1:]) % 4 == 0 for puzzle_id in endgame)
+    assert len(set(entry_ids(pgns["any.pgn"]))) == 30
+
+    assert generate_pgn_packs(dump, specs, seed=3) == pgns
+
+
+def test_entries_start_from_either_side(dump, make_row):
+    (entries,) = generate_pgn_packs(dump, [PgnPackSpec("all", 40)], seed=4).values()
+    fen = make_row("p")["FEN"]
+    positions = {re.search(r'\[FEN "(.*)"\]', entry).group(1) for entry in entries}
+    assert positions == {fen, compute_offensive_fen(fen, "e2e4")}
+
+
+def test_too_few_matching_puzzles(dump):
+    with pytest.raises(ValueError, match="100 matching puzzles, 101 requested"):
+        generate_pgn_packs(dump, [PgnPackSpec("endgame", 101, ENDGAME)])
+
+
+def test_compressed_dump_samples_like_the_plain_one(dump):
+    with open(dump, "rb") as f, open(f"{dump}.gz", "wb") as out:
+        out.write(gzip.compress(f.read()))
+    specs = [PgnPackSpec("endgame", 20, ENDGAME)]
+    assert generate_pgn_packs(f"{dump}.gz", specs, 5) == generate_pgn_packs(
+        dump, specs, 5
+    )
+
+
+def test_write_leaves_unchanged_packs(tmp_path, dump, capsys):
+    output_file = str(tmp_path / "packs" / "endgame.pgn")
+    specs = [PgnPackSpec(output_file, 8, ENDGAME)]
+    write_pgn_packs(dump, specs, seed=6)
+    with open(output_file) as f:
+        assert f.read().count("[FEN ") == 8
+    os.utime(output_file, ns=(0, 0))
+
+    write_pgn_packs(dump, specs, seed=6)
+    assert os.stat(output_file).st_mtime_ns == 0
+    assert f"Unchanged {output_file}" in capsys.readouterr().out
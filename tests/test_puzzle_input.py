@@ -0,0 +1,189 @@
+import bz2
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import sys
+import zlib
+
+import pytest
+
+import process_puzzles
+from process_puzzles import (
+    PUZZLE_FILTER_MAPPING,
+    ThreadedDecompressor,
+    ZstdFrameReader,
+    filter_puzzles,
+    open_puzzle_input,
+)
+
+needs_zstd = pytest.mark.skipif(
+    shutil.which("zstd") is None, reason="needs the zstd command"
+)
+
+
+@pytest.fixture
+def dump(make_row, write_dump):
+    themes = ["opening fork", "middlegame pin", "endgame mate"]
+    rows = [
+        make_row(f"p{i:04d}", Rating=700 + i, Themes=themes[i % 3]) for i in range(2000)
+    ]
+    return write_dump("dump.csv", rows)
+
+
+def compress(path, suffix):
+    with open(path, "rb") as f:
+        content = f.read()
+    compressed = f"{path}.{suffix}"
+    if suffix == "gz":
+        data = gzip.compress(content)
+    elif suffix == "bz2":
+        data = bz2.compress(content)
+    else:
+        data = subprocess.run(
+            ["zstd", "-c", "--long=27"], input=content, capture_output=True, check=True
+        ).stdout
+    with open(compressed, "wb") as f:
+        f.write(data)
+    return compressed
+
+
+def truncate(path):
+    stem, suffix = os.path.splitext(path)
+    truncated = f"{stem}.truncated{suffix}"
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(truncated, "wb") as f:
+        f.write(data[: len(data) * 2 // 3])
+    return truncated
+
+
+def read_outputs(output_dir):
+    outputs = {}
+    for filter_name in PUZZLE_FILTER_MAPPING:
+        with open(os.path.join(output_dir, f"{filter_name}.csv"), "rb") as f:
+            outputs[filter_name] = f.read()
+    return outputs
+
+
+@pytest.fixture
+def zstd_cli(monkeypatch):
+    """Make .zst input go through the zstd command even if zstandard is
+    installed."""
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+
+
+@pytest.mark.parametrize("suffix", ["gz", "bz2", pytest.param("zst", marks=needs_zstd)])
+def test_compressed_dump_filters_like_the_plain_one(
+    tmp_path, monkeypatch, zstd_cli, dump, suffix
+):
+    # Small blocks so the reader waits on the decompressing thread.
+    monkeypatch.setattr(process_puzzles, "DECOMPRESS_BLOCK_SIZE", 4096)
+    filter_puzzles(dump, str(tmp_path / "plain"))
+    filter_puzzles(compress(dump, suffix), str(tmp_path / suffix))
+    assert read_outputs(tmp_path / suffix) == read_outputs(tmp_path / "plain")
+
+
+@pytest.mark.parametrize(
+    "suffix, error",
+    [
+        ("gz", EOFError),
+        ("bz2", EOFError),
+        pytest.param("zst", OSError, marks=needs_zstd),
+    ],
+)
+def test_truncated_dump_fails(tmp_path, zstd_cli, dump, suffix, error):
+    with pytest.raises(error):
+        filter_puzzles(truncate(compress(dump, suffix)), str(tmp_path / "puzzles"))
+
+
+@pytest.mark.parametrize("suffix", ["gz", pytest.param("zst", marks=needs_zstd)])
+def test_position_reaches_the_compressed_size(zstd_cli, dump, suffix):
+    compressed = compress(dump, suffix)
+    with open_puzzle_input(compressed) as puzzle_input:
+        with open(dump, "rb") as f:
+            assert puzzle_input.stream.read() == f.read()
+        assert puzzle_input.position() == os.path.getsize(compressed)
+
+
+class ZlibFrames:
+    """Stands in for zstandard.ZstdDecompressor: zlib streams have the same
+    decompressobj interface (eof, unused_data), so concatenated zlib streams
+    behave like concatenated zstd frames."""
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+
+def frames(*parts):
+    return b"".join(zlib.compress(part) for part in parts)
+
+
+def read_all(reader):
+    blocks = []
+    while True:
+        block = reader.read()
+        if not block:
+            return b"".join(blocks)
+        blocks.append(block)
+
+
+def test_frame_reader_reads_concatenated_frames(monkeypatch):
+    monkeypatch.setattr(process_puzzles, "READ_BUFFER_SIZE", 7)
+    parts = [b"PuzzleId,FEN\n", b"a" * 1000, b"", b"tail\n"]
+    reader = ZstdFrameReader(ZlibFrames(), io.BytesIO(frames(*parts)))
+    assert read_all(reader) == b"".join(parts)
+
+
+@pytest.mark.parametrize("cut", [1, 10, 30])
+def test_frame_reader_rejects_a_truncated_frame(monkeypatch, cut):
+    monkeypatch.setattr(process_puzzles, "READ_BUFFER_SIZE", 7)
+    data = frames(b"first frame " * 20, b"second frame " * 20)
+    reader = ZstdFrameReader(ZlibFrames(), io.BytesIO(data[:-cut]))
+    with pytest.raises(EOFError):
+        read_all(reader)
+
+
+def test_frame_reader_with_zstandard(tmp_path, dump):
+    zstandard = pytest.importorskip("zstandard")
+    with open(dump, "rb") as f:
+        content = f.read()
+    data = zstandard.ZstdCompressor().compress(content) * 2
+    reader = ZstdFrameReader(zstandard.ZstdDecompressor(), io.BytesIO(data))
+    assert read_all(reader) == content * 2
+    reader = ZstdFrameReader(zstandard.ZstdDecompressor(), io.BytesIO(data[:-5]))
+    with pytest.raises(EOFError):
+        read_all(reader)
+
+
+class Failing(io.RawIOBase):
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if not self.blocks:
+            raise ValueError("corrupt input")
+        return self.blocks.pop(0)
+
+
+def test_threaded_decompressor_raises_stream_errors_in_order():
+    source = io.BytesIO()
+    reader = ThreadedDecompressor(Failing([b"abc", b"def"]), source, max_blocks=1)
+    assert reader.read(3) == b"abc"
+    assert reader.read(3) == b"def"
+    with pytest.raises(ValueError, match="corrupt input"):
+        reader.read(3)
+    reader.close()
+
+
+def test_threaded_decompressor_closes_with_a_full_queue():
+    source = io.BytesIO()
+    stream = Failing([b"x"] * 100)
+    reader = ThreadedDecompressor(stream, source, max_blocks=1)
+    assert reader.read(1) == b"x"
+    reader.close()
+    assert not reader.thread.is_alive()
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+from puzzle_prefetch import PuzzlePrefetcher, PuzzleRequest
+
+ENDGAME = PuzzleRequest("Endgame", 1500)
+OPENING = PuzzleRequest("Opening", 1200)
+
+
+class StubGenerator:
+    """Numbers each puzzle it generates per pack; a pack can be held until
+    released, and can be made to fail from its nth puzzle on."""
+
+    def __init__(self):
+        self.counts = {}
+        self.threads = []
+        self.held = {}
+        self.fail_from = {}
+        self.lock = threading.Lock()
+
+    def generate_puzzle_fen_string(
+        self, puzzle_pack_name, target_rating, opening_name, username
+    ):
+        gate = self.held.get(puzzle_pack_name)
+        if gate is not None:
+            gate.wait(5)
+        with self.lock:
+            n = self.counts.get(puzzle_pack_name, 0)
+            if n >= self.fail_from.get(puzzle_pack_name, n + 1):
+                raise ValueError("no puzzles")
+            self.counts[puzzle_pack_name] = n + 1
+            self.threads.append(threading.current_thread().name)
+        return f"{puzzle_pack_name}-{n}", f"url-{n}"
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def generator():
+    return StubGenerator()
+
+
+@pytest.fixture
+def prefetcher(generator):
+    prefetcher = PuzzlePrefetcher(generator, depth=3, max_sessions=2, num_workers=2)
+    yield prefetcher
+    for gate in generator.held.values():
+        gate.set()
+    prefetcher.executor.shutdown(wait=True)
+
+
+def test_queue_fills_in_the_background(generator, prefetcher):
+    queue = prefetcher.session_queue()
+    # Nothing is queued yet, so the first puzzle is generated right away.
+    assert queue.next(ENDGAME) == ("Endgame-0", "url-0")
+    assert generator.threads[0] == "MainThread"
+    wait_for(lambda: len(queue) == 3 and not queue.filling)
+
+    assert [queue.next(ENDGAME)[0] for _ in range(3)] == [
+        "Endgame-1",
+        "Endgame-2",
+        "Endgame-3",
+    ]
+    assert generator.threads.count("MainThread") == 1
+    wait_for(lambda: len(queue) == 3 and not queue.filling)
+    assert generator.counts["Endgame"] <= 1 + 3 + 3
+
+
+def test_new_request_drops_queued_and_in_flight_puzzles(generator, prefetcher):
+    queue = prefetcher.session_queue()
+    queue.next(ENDGAME)
+    wait_for(lambda: len(queue) == 3 and not queue.filling)
+    generator.held["Endgame"] = threading.Event()
+    queue.next(ENDGAME)
+    # A refill for the old request is now waiting on the gate.
+    wait_for(lambda: queue.filling)
+
+    assert queue.next(OPENING)[0] == "Opening-0"
+    generator.held["Endgame"].set()
+    wait_for(lambda: len(queue) == 3 and not queue.filling)
+    assert all(fen.startswith("Opening") for fen, _ in queue.puzzles)
+
+
+def test_least_recently_used_queues_are_emptied(prefetcher):
+    queues = [prefetcher.session_queue() for _ in range(3)]
+    for queue in queues[:2]:
+        queue.next(ENDGAME)
+        wait_for(lambda: len(queue) == 3 and not queue.filling)
+    queues[2].next(OPENING)
+    assert len(queues[0]) == 0 and not queues[0].active
+    assert len(queues[1]) == 3
+    wait_for(lambda: len(queues[2]) == 3 and not queues[2].filling)
+    # An emptied queue refills once it is used again.
+    queues[0].next(ENDGAME)
+    wait_for(lambda: len(queues[0]) == 3 and not queues[0].filling)
+
+
+def test_errors_surface_on_the_next_synchronous_request(generator, prefetcher):
+    queue = prefetcher.session_queue()
+    generator.fail_from["Endgame"] = 1
+    assert queue.next(ENDGAME)[0] == "Endgame-0"
+    # The background fill fails and stops rather than retrying.
+    wait_for(lambda: not queue.filling)
+    assert len(queue) == 0
+    with pytest.raises(ValueError, match="no puzzles"):
+        queue.next(ENDGAME)
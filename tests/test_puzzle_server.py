@@ -0,0 +1,99 @@
+import http.client
+import threading
+
+import pytest
+
+import puzzle_server
+from generate_puzzles import PuzzleGenerator, PuzzlePacks
+from puzzle_server import PuzzleService, _request, make_server, run_load_test
+from puzzle_store import build_puzzle_store
+
+
+@pytest.fixture
+def service(make_row, write_dump):
+    csv_file = write_dump(
+        "pack.csv", [make_row(f"p{i}", Rating=800 + i) for i in range(1000)]
+    )
+    build_puzzle_store(csv_file)
+    generator = PuzzleGenerator()
+    generator.puzzle_mapping = PuzzlePacks({"Pack": csv_file})
+    return PuzzleService(generator)
+
+
+@pytest.fixture
+def connection(service):
+    server = make_server(service, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+    yield connection
+    connection.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_puzzles_come_from_the_generator_rating_window(monkeypatch, service):
+    monkeypatch.setattr(puzzle_server, "RATING_WINDOW", 20)
+    monkeypatch.setattr(puzzle_server, "RATING_SAMPLE_SIZE", 10)
+    session = service.create_session("Pack", 1300)
+    for _ in range(30):
+        puzzle = service.next_puzzle(session.session_id)
+        assert abs(puzzle["rating"] - 1300) <= 20
+
+
+def test_session_round_trip(connection):
+    status, body = _request(connection, "POST", "/sessions", {"pack": "Pack"})
+    assert status == 200
+    session_id = body["session_id"]
+    status, puzzle = _request(connection, "GET", f"/sessions/{session_id}/next")
+    assert status == 200 and puzzle["fen"]
+    status, body = _request(
+        connection, "POST", f"/sessions/{session_id}/result", {"solved": True}
+    )
+    assert status == 200 and body["session_rating"] > 1400
+    assert _request(connection, "GET", "/stats") == (200, {"sessions": 1})
+
+
+def test_client_errors(connection):
+    assert _request(connection, "GET", "/sessions/missing/next")[0] == 404
+    assert _request(connection, "POST", "/sessions", {"pack": "Missing"})[0] == 400
+    assert _request(connection, "GET", "/nowhere")[0] == 404
+
+
+def test_unexpected_errors_reply_500(monkeypatch, service, connection):
+    def fail(session_id):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(service, "next_puzzle", fail)
+    status, body = _request(connection, "GET", "/sessions/any/next")
+    assert status == 500 and "error" in body
+    # The connection stays usable after the error.
+    assert _request(connection, "GET", "/stats")[0] == 200
+
+
+@pytest.mark.parametrize("solved", [1, "yes", None, [], {}])
+def test_result_must_be_a_json_bool(connection, solved):
+    _, body = _request(connection, "POST", "/sessions", {"pack": "Pack"})
+    path = f"/sessions/{body['session_id']}/result"
+    _request(connection, "GET", f"/sessions/{body['session_id']}/next")
+    status, body = _request(connection, "POST", path, {"solved": solved})
+    assert status == 400 and "solved" in body["error"]
+    assert _request(connection, "POST", path, {})[0] == 400
+    assert _request(connection, "POST", path, {"solved": False})[0] == 200
+
+
+def test_load_test_counts_error_replies(monkeypatch, service, connection):
+    port = connection.port
+    report = run_load_test("127.0.0.1", port, "Pack", 4, 3, 2)
+    assert report["requests"] == 4 * 3 * 2 and report["errors"] == {}
+
+    def fail(session_id):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(service, "next_puzzle", fail)
+    report = run_load_test("127.0.0.1", port, "Missing", 2, 3, 1)
+    assert report["errors"] == {"400": 2}
+    report = run_load_test("127.0.0.1", port, "Pack", 4, 3, 1)
+    # Each solver stops at its first error.
+    assert report["errors"] == {"500": 4}
+    assert report["requests"] == 4
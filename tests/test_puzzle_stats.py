@@ -0,0 +1,161 @@
+import csv
+import gzip
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import puzzle_stats
+from process_puzzles import Puzzle
+from puzzle_stats import (
+    NUM_RATING_BINS,
+    RATING_BIN_WIDTH,
+    STATS_FILTERS,
+    compute_stats,
+    load_stats,
+    print_report,
+    weighted_quantiles,
+)
+
+THEMES = ["opening", "middlegame", "endgame", "fork", "pin", "mate", "short"]
+OPENINGS = ["Sicilian_Defense", "Italian_Game", "French_Defense_Winawer"]
+
+
+@pytest.fixture
+def dump(make_row, write_dump):
+    rng = random.Random(0)
+    rows = []
+    for i in range(300):
+        rows.append(
+            make_row(
+                f"p{i}",
+                Rating=rng.randint(400, 4200),
+                Popularity=rng.randint(-100, 100),
+                NbPlays=rng.randint(0, 50000),
+                Themes=" ".join(rng.sample(THEMES, rng.randint(0, 3))),
+                OpeningTags=" ".join(rng.sample(OPENINGS, rng.randint(0, 2))),
+                # A comma makes the writer quote the field.
+                GameUrl=f"https://lichess.org/{i},x" if i % 10 == 0 else "",
+            )
+        )
+    # Tags are matched case-insensitively, as the filters do.
+    rows.append(make_row("upper", Themes="ENDGAME Mate", OpeningTags=""))
+    return write_dump("dump.csv", rows)
+
+
+def read_puzzles(path):
+    with open(path, newline="") as f:
+        return [Puzzle.from_dict(row) for row in csv.DictReader(f)]
+
+
+def rating_bin(rating):
+    return min(rating // RATING_BIN_WIDTH, NUM_RATING_BINS - 1)
+
+
+@pytest.fixture
+def stats(monkeypatch, dump):
+    # Small batches, so tags keep turning up after the arrays were sized.
+    monkeypatch.setattr(puzzle_stats, "STATS_BATCH_ROWS", 7)
+    return compute_stats(dump)
+
+
+def test_histograms_match_the_rows(dump, stats):
+    puzzles = read_puzzles(dump)
+    assert stats.num_puzzles == len(puzzles)
+    expected = np.zeros(NUM_RATING_BINS, dtype=np.int64)
+    for puzzle in puzzles:
+        expected[rating_bin(puzzle.rating)] += 1
+    assert stats.rating_counts.tolist() == expected.tolist()
+
+    plays = Counter(puzzle.plays for puzzle in puzzles)
+    assert dict(zip(stats.plays_values.tolist(), stats.plays_counts.tolist())) == plays
+
+
+def test_tag_counts_match_the_rows(dump, stats):
+    puzzles = read_puzzles(dump)
+    theme_counts = Counter(t for p in puzzles for t in set(p.themes.split()))
+    stats_themes = Counter()
+    for theme, count in zip(stats.themes, np.diag(stats.theme_pairs).tolist()):
+        stats_themes[theme.lower()] += count
+    assert stats_themes == theme_counts
+    assert "" not in stats.themes
+
+    i, j = stats.themes.index("fork"), stats.themes.index("pin")
+    both = sum({"fork", "pin"} <= set(p.themes.split()) for p in puzzles)
+    assert stats.theme_pairs[i, j] == stats.theme_pairs[j, i] == both
+
+    opening_counts = Counter(t for p in puzzles for t in p.opening_tags.split())
+    assert {
+        tag.lower(): int(count)
+        for tag, count in zip(stats.opening_tags, stats.opening_ratings.sum(axis=1))
+    } == opening_counts
+    assert stats.num_without_opening == sum(not p.opening_tags for p in puzzles)
+
+
+def test_filter_capacities_match_apply_filter(dump, stats):
+    puzzles = read_puzzles(dump)
+    for name, filter_ratings in zip(stats.filter_names, stats.filter_ratings):
+        kept = [p for p in puzzles if p.apply_filter(STATS_FILTERS[name])]
+        expected = np.zeros(NUM_RATING_BINS, dtype=np.int64)
+        for puzzle in kept:
+            expected[rating_bin(puzzle.rating)] += 1
+        assert filter_ratings.tolist() == expected.tolist(), name
+
+
+def test_weighted_quantiles_match_numpy():
+    rng = np.random.default_rng(1)
+    values = np.unique(rng.integers(-100, 100, 40))
+    counts = rng.integers(1, 20, len(values))
+    quantiles = [0, 0.1, 0.25, 0.5, 0.75, 0.9, 1]
+    expected = np.quantile(np.repeat(values, counts), quantiles, method="inverted_cdf")
+    assert weighted_quantiles(values, counts, quantiles).tolist() == expected.tolist()
+    assert weighted_quantiles(values[:0], counts[:0], [0.5]).tolist() == [0]
+
+
+def test_compressed_input_gives_the_same_stats(dump, stats):
+    with open(dump, "rb") as f, open(f"{dump}.gz", "wb") as out:
+        out.write(gzip.compress(f.read()))
+    compressed = compute_stats(f"{dump}.gz").to_arrays()
+    for name, array in stats.to_arrays().items():
+        assert np.array_equal(compressed[name], array), name
+
+
+def test_stats_are_cached_by_content(monkeypatch, dump, make_row, write_dump):
+    first = load_stats(dump)
+
+    def fail(input_file):
+        raise AssertionError("recomputed cached stats")
+
+    monkeypatch.setattr(puzzle_stats, "compute_stats", fail)
+    cached = load_stats(dump)
+    for name, array in first.to_arrays().items():
+        assert np.array_equal(cached.to_arrays()[name], array), name
+
+    monkeypatch.undo()
+    write_dump("dump.csv", [make_row("p1")])
+    assert load_stats(dump).num_puzzles == 1
+
+
+def test_report(dump, stats, capsys):
+    print_report(dump, stats, top=3)
+    out = capsys.readouterr().out
+    assert f"{stats.num_puzzles} puzzles" in out
+    assert "opening tags" in out
+    # Every filter's total capacity is listed.
+    totals = next(line for line in out.splitlines() if line.startswith("total"))
+    assert [int(n) for n in totals.split()[1:]] == stats.filter_ratings.sum(
+        axis=1
+    ).tolist()
+
+
+def test_tag_split_ignores_line_endings():
+    builder = puzzle_stats._StatsBuilder(
+        ["PuzzleId", "Rating", "Popularity", "NbPlays", "Themes", "OpeningTags"]
+    )
+    lines = [b"a,1500,90,100,fork,Sicilian_Defense\r\n", b"b,1500,90,100,fork,\n"]
+    assert builder.add_batch(lines) == 2
+    stats = builder.finish()
+    assert stats.opening_tags == ["Sicilian_Defense"]
+    assert stats.num_without_opening == 1
+    assert stats.themes == ["fork"]
@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+from puzzle_store import (
+    STORE_VERSION,
+    PuzzleStore,
+    StoreVersionError,
+    build_puzzle_store,
+    decode_uci_move,
+    encode_uci_move,
+    load_puzzles,
+)
+
+
+@pytest.fixture
+def rows(make_row):
+    return [
+        make_row("p1", OffensiveFEN="fen after e2e4"),
+        make_row(
+            "p2",
+            Moves="e7e8q d1d2 a2a1n h7h8r b2b1b",
+            Rating=2999,
+            RatingDeviation=-5,
+            Popularity=-100,
+            NbPlays=4000000000,
+            Themes="Fork Endgame fork",
+            OpeningTags="",
+            OffensiveFEN="another fen",
+        ),
+        # Unicode survives the string blobs.
+        make_row("p3", Themes="", OpeningTags="Caro-Kann_Défense", OffensiveFEN="ü"),
+    ]
+
+
+def assert_round_trip(store, rows):
+    assert len(store) == len(rows)
+    for puzzle, row in zip(store, rows):
+        assert puzzle.puzzle_id == row["PuzzleId"]
+        assert puzzle.fen == row["FEN"]
+        assert puzzle.moves == row["Moves"].split()
+        assert puzzle.rating == int(row["Rating"])
+        assert puzzle.rating_deviation == int(row["RatingDeviation"])
+        assert puzzle.popularity == int(row["Popularity"])
+        assert puzzle.plays == int(row["NbPlays"])
+        assert set(puzzle.themes.split()) == set(row["Themes"].lower().split())
+        assert puzzle.opening_tags == row["OpeningTags"].lower()
+        assert puzzle.offensive_fen == row["OffensiveFEN"]
+
+
+def test_store_round_trip(rows, write_dump):
+    csv_file = write_dump("pack.csv", rows)
+    store = PuzzleStore(build_puzzle_store(csv_file))
+    assert_round_trip(store, rows)
+    assert store.ratings.tolist() == [1500, 2999, 1500]
+    assert store[-1].puzzle_id == "p3"
+    assert [puzzle.puzzle_id for puzzle in store[1:]] == ["p2", "p3"]
+    with pytest.raises(IndexError):
+        store[3]
+
+
+def test_theme_mask(rows, write_dump):
+    store = PuzzleStore(build_puzzle_store(write_dump("pack.csv", rows)))
+    assert store.theme_mask("FORK").tolist() == [False, True, False]
+    assert store.theme_mask("opening").tolist() == [True, False, False]
+    assert not store.theme_mask("missing").any()
+
+
+def test_load_puzzles_without_store_matches_store(rows, write_dump):
+    csv_file = write_dump("pack.csv", rows)
+    assert_round_trip(load_puzzles(csv_file), rows)
+    build_puzzle_store(csv_file)
+    loaded = load_puzzles(csv_file)
+    assert isinstance(loaded, PuzzleStore)
+    assert_round_trip(loaded, rows)
+
+
+def test_store_computes_missing_offensive_fen(make_row, write_dump):
+    csv_file = write_dump("pack.csv", [make_row("p1")])
+    store = PuzzleStore(build_puzzle_store(csv_file))
+    assert store[0].offensive_fen.startswith("rnbqkbnr/pppppppp/8/8/4P3/8/")
+
+
+def test_uci_move_codes_round_trip():
+    files, ranks = "abcdefgh", "12345678"
+    squares = [f + r for f in files for r in ranks]
+    moves = [a + b for a in squares for b in squares if a != b]
+    moves += ["e7e8q", "a2a1n", "h7h8r", "b2b1b", "g7h8q"]
+    codes = [encode_uci_move(move) for move in moves]
+    assert len(set(codes)) == len(codes)
+    assert max(codes) < 1 << 16
+    assert [decode_uci_move(code) for code in codes] == moves
+
+
+def set_store_version(store_file, version):
+    with open(store_file, "rb") as f:
+        data = f.read()
+    old = f'"version": {STORE_VERSION}'.encode()
+    new = f'"version": {version}'.encode()
+    assert len(old) == len(new)
+    with open(store_file, "wb") as f:
+        f.write(data.replace(old, new, 1))
+
+
+def test_store_rejects_unknown_version(rows, write_dump):
+    store_file = build_puzzle_store(write_dump("pack.csv", rows))
+    set_store_version(store_file, 9)
+    with pytest.raises(StoreVersionError, match="version 9"):
+        PuzzleStore(store_file)
+
+
+def test_load_puzzles_rebuilds_store_of_unknown_version(rows, write_dump):
+    csv_file = write_dump("pack.csv", rows)
+    store_file = build_puzzle_store(csv_file)
+    set_store_version(store_file, 9)
+    assert_round_trip(load_puzzles(csv_file), rows)
+    assert_round_trip(PuzzleStore(store_file), rows)
+
+    set_store_version(store_file, 9)
+    os.remove(csv_file)
+    with pytest.raises(StoreVersionError):
+        load_puzzles(csv_file)
+
+
+def test_load_puzzles_refuses_csv_without_offensive_fen(make_row, write_dump):
+    csv_file = write_dump("pack.csv", [make_row("p1")])
+    with pytest.raises(ValueError, match="process_puzzles.py store"):
+        load_puzzles(csv_file)
+    build_puzzle_store(csv_file)
+    assert load_puzzles(csv_file)[0].offensive_fen
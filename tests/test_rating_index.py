@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+import pytest
+
+from generate_puzzles import RATING_SAMPLE_SIZE, RatingIndex
+from process_puzzles import Puzzle
+
+
+def make_puzzles(ratings):
+    return [
+        Puzzle(f"p{i}", "", "e2e4", rating, 80, 90, 1000, "", "")
+        for i, rating in enumerate(ratings)
+    ]
+
+
+def nearest_by_scan(ratings, target_rating, k):
+    """The k puzzles closest in rating, ties broken by pack position."""
+    distances = np.abs(np.asarray(ratings) - target_rating)
+    return np.lexsort((np.arange(len(ratings)), distances))[:k].tolist()
+
+
+@pytest.fixture
+def ratings():
+    rng = random.Random(4)
+    # Coarse ratings so many puzzles tie on distance.
+    return [rng.randrange(600, 2400, 25) for _ in range(500)]
+
+
+@pytest.mark.parametrize("target_rating", [0, 599, 1000, 1337, 1500, 2399, 5000])
+@pytest.mark.parametrize("k", [1, 2, 7, 50, 499, 500, 600])
+def test_nearest_matches_scan(ratings, target_rating, k):
+    index = RatingIndex(make_puzzles(ratings))
+    assert index.nearest(target_rating, k).tolist() == nearest_by_scan(
+        ratings, target_rating, k
+    )
+
+
+def test_nearest_breaks_ties_by_pack_position():
+    index = RatingIndex(make_puzzles([1500, 1400, 1600, 1400, 1600, 1500]))
+    assert index.nearest(1500, 1).tolist() == [0]
+    assert index.nearest(1500, 3).tolist() == [0, 5, 1]
+    assert index.nearest(1550, 2).tolist() == [0, 2]
+
+
+def test_window_is_inclusive_and_in_rating_order(ratings):
+    index = RatingIndex(make_puzzles(ratings))
+    positions = index.window(1000, 1200)
+    window_ratings = np.asarray(ratings)[positions]
+    assert sorted(positions.tolist()) == [
+        i for i, rating in enumerate(ratings) if 1000 <= rating <= 1200
+    ]
+    assert np.all(np.diff(window_ratings) >= 0)
+
+
+def test_candidate_positions_fall_back_to_nearest(ratings):
+    index = RatingIndex(make_puzzles(ratings))
+    # The pack holds fewer than RATING_SAMPLE_SIZE puzzles in any window.
+    assert len(ratings) < RATING_SAMPLE_SIZE
+    assert sorted(index.candidate_positions(1500).tolist()) == list(range(len(ratings)))
+
+
+def test_empty_index():
+    index = RatingIndex(make_puzzles([]))
+    assert len(index) == 0
+    assert index.window(0, 3000).tolist() == []
+    assert index.nearest(1500, 5).tolist() == []
@@ -0,0 +1,99 @@
+import random
+
+import numpy as np
+import pytest
+
+import generate_puzzles
+from generate_puzzles import RATING_WINDOW, RatingIndex
+from process_puzzles import Puzzle, compute_offensive_fen
+
+
+@pytest.fixture
+def generator(monkeypatch, puzzle_generator):
+    monkeypatch.setattr(generate_puzzles, "RATING_SAMPLE_SIZE", 10)
+    return puzzle_generator
+
+
+def test_selections_are_distinct_and_within_the_window(generator):
+    requests = [("Pack", 1200)] * 50 + [
+        ("Pack", rating) for rating in range(1000, 1400, 8)
+    ]
+    puzzles = generator.select_puzzles(requests, random.Random(1))
+    assert len({puzzle.puzzle_id for puzzle in puzzles}) == len(requests)
+    for puzzle, (_, target_rating) in zip(puzzles, requests):
+        assert abs(puzzle.rating - target_rating) <= RATING_WINDOW
+
+
+def test_selections_widen_once_the_window_is_taken(generator):
+    # 201 puzzles are rated within 100 of 1200, so the last request widens.
+    puzzles = generator.select_puzzles([("Pack", 1200)] * 202, random.Random(2))
+    outside = [p.rating for p in puzzles if abs(p.rating - 1200) > RATING_WINDOW]
+    assert len({puzzle.puzzle_id for puzzle in puzzles}) == 202
+    # The widened search keeps to the nearest puzzles by rating.
+    assert len(outside) == 1
+    assert abs(outside[0] - 1200) <= RATING_WINDOW + 10
+
+
+def test_selections_are_reproducible(generator):
+    requests = [("Pack", 1100), ("Pack", 1300)] * 10
+    first = generator.select_puzzles(requests, random.Random(3))
+    second = generator.select_puzzles(requests, random.Random(3))
+    assert [p.puzzle_id for p in first] == [p.puzzle_id for p in second]
+
+
+def test_repeated_ids_are_returned_once(generator):
+    puzzles = generator.select_puzzles([("Repeated", 1500)] * 3, random.Random(4))
+    assert sorted(puzzle.puzzle_id for puzzle in puzzles) == ["a", "b", "c"]
+    with pytest.raises(ValueError):
+        generator.select_puzzles([("Repeated", 1500)] * 4, random.Random(4))
+
+
+def test_unknown_pack_is_rejected(generator):
+    with pytest.raises(ValueError):
+        generator.select_puzzles([("Missing", 1500)])
+
+
+def test_small_windows_fall_back_to_each_targets_nearest(
+    monkeypatch, generator, make_row, write_dump
+):
+    monkeypatch.setattr(generate_puzzles, "RATING_SAMPLE_SIZE", 2)
+    offensive_fen = compute_offensive_fen(make_row("s")["FEN"], "e2e4")
+    rows = [
+        make_row(f"s{rating}", Rating=rating, OffensiveFEN=offensive_fen)
+        for rating in range(0, 3000, 200)
+    ]
+    generator.puzzle_mapping.puzzle_files["Sparse"] = write_dump("sparse.csv", rows)
+    # Both windows hold only the puzzle rated 1000, but the nearest two
+    # puzzles differ: 800 and 1000 for 910, 1000 and 1200 for 1090.
+    for seed in range(20):
+        low, high = generator.select_puzzles(
+            [("Sparse", 910), ("Sparse", 1090)], random.Random(seed)
+        )
+        assert low.rating in (800, 1000)
+        assert high.rating in (1000, 1200)
+
+
+def test_curve_selects_in_curve_order(generator):
+    curve = [1000 + 40 * i for i in range(10)]
+    puzzles = generator.select_puzzles_for_curve("Pack", curve, random.Random(5))
+    assert puzzles == generator.select_puzzles(
+        [("Pack", elo) for elo in curve], random.Random(5)
+    )
+    for puzzle, elo in zip(puzzles, curve):
+        assert abs(puzzle.rating - elo) <= RATING_WINDOW
+
+
+def test_window_bounds_take_arrays():
+    index = RatingIndex(
+        [
+            Puzzle(f"p{i}", "", "e2e4", r, 80, 90, 1000, "", "")
+            for i, r in enumerate([1500, 900, 1210, 1200, 1700, 1300])
+        ]
+    )
+    targets = np.array([700, 1250, 2300])
+    los, his = index.window_bounds(targets - RATING_WINDOW, targets + RATING_WINDOW)
+    for target_rating, lo, hi in zip(targets, los, his):
+        window = index.window(
+            target_rating - RATING_WINDOW, target_rating + RATING_WINDOW
+        )
+        assert index.order[lo:hi].tolist() == window.tolist()
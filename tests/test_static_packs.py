@@ -0,0 +1,254 @@
+import gzip
+import hashlib
+import json
+import os
+import random
+
+import pytest
+
+import generate_static_puzzles as static_puzzles
+from generate_puzzles import PuzzlePacks
+from generate_static_puzzles import (
+    CONTENT_HASH_LENGTH,
+    PACK_INDEX_FILE,
+    SHARD_INDEX_FILE,
+    ShardedPack,
+    compress_pack,
+    decode_json_pack,
+    export_puzzle_packs,
+    export_puzzles_to_csv,
+    export_sharded_pack,
+    generate_static_puzzles,
+)
+
+
+def test_json_pack_drops_the_analysis_url(tmp_path, puzzle_generator):
+    filepath = export_puzzles_to_csv(
+        str(tmp_path), 40, "Pack", 1000, 1300, puzzle_generator, 3, "json"
+    )
+    assert os.path.basename(filepath) == "puzzles_Pack_n40_elo1000-1300.json"
+    with open(filepath, "rb") as f:
+        content = f.read()
+    assert b"analysis" not in content
+
+    expected = generate_static_puzzles(
+        40, "Pack", 1000, 1300, puzzle_generator, random.Random(3)
+    )
+    assert decode_json_pack(content) == [
+        {key: puzzle[key] for key in ("fen", "elo", "type")} for puzzle in expected
+    ]
+
+
+def test_content_hashed_packs_and_index(tmp_path, puzzle_generator):
+    output_dir = tmp_path / "packs"
+
+    def export(seed):
+        return export_puzzles_to_csv(
+            str(output_dir),
+            40,
+            "Pack",
+            1000,
+            1300,
+            puzzle_generator,
+            seed,
+            "json",
+            compress=["gz"],
+            content_hash=True,
+        )
+
+    def pack_index():
+        with open(output_dir / PACK_INDEX_FILE) as f:
+            return json.load(f)
+
+    filepath = export(3)
+    with open(filepath, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()[:CONTENT_HASH_LENGTH]
+    hashed_name = f"puzzles_Pack_n40_elo1000-1300.{digest}.json"
+    assert os.path.basename(filepath) == hashed_name
+    with open(f"{filepath}.gz", "rb") as f:
+        assert gzip.decompress(f.read()) == content
+    assert pack_index() == {"puzzles_Pack_n40_elo1000-1300.json": hashed_name}
+
+    # The same seed gives the same name; a new one replaces the old files.
+    assert export(3) == filepath
+    new_filepath = export(4)
+    assert new_filepath != filepath
+    assert sorted(os.listdir(output_dir)) == sorted(
+        [
+            PACK_INDEX_FILE,
+            os.path.basename(new_filepath),
+            os.path.basename(new_filepath) + ".gz",
+        ]
+    )
+    assert pack_index() == {
+        "puzzles_Pack_n40_elo1000-1300.json": os.path.basename(new_filepath)
+    }
+
+
+def test_gzip_copies_are_reproducible():
+    content = b'{"puzzles": []}' * 100
+    assert compress_pack(content, "gz") == compress_pack(content, "gz")
+    with pytest.raises(ValueError):
+        compress_pack(content, "xz")
+
+
+@pytest.fixture
+def sharded_pack(tmp_path, puzzle_generator):
+    """A 120-puzzle pack from 1000 to 1399 in shards of 25."""
+    index_file = export_sharded_pack(
+        str(tmp_path / "static"),
+        120,
+        "Pack",
+        1000,
+        1399,
+        shard_size=25,
+        puzzle_generator=puzzle_generator,
+        seed=7,
+    )
+    return index_file
+
+
+def test_sharded_pack_round_trip(sharded_pack, puzzle_generator):
+    expected = generate_static_puzzles(
+        120, "Pack", 1000, 1399, puzzle_generator, random.Random(7)
+    )
+    expected.sort(key=lambda puzzle: puzzle["elo"])
+
+    with open(sharded_pack) as f:
+        index = json.load(f)
+    assert index["count"] == 120
+    assert [shard["count"] for shard in index["shards"]] == [25, 25, 25, 25, 20]
+    shards = []
+    for entry in index["shards"]:
+        with open(
+            os.path.join(os.path.dirname(sharded_pack), entry["file"]), "rb"
+        ) as f:
+            shard = decode_json_pack(f.read())
+        assert entry["min_elo"] == shard[0]["elo"]
+        assert entry["max_elo"] == shard[-1]["elo"]
+        shards.extend(shard)
+    assert shards == [
+        {key: puzzle[key] for key in ("fen", "elo", "type")} for puzzle in expected
+    ]
+
+
+def test_sharded_pack_lookup_by_ordinal(sharded_pack):
+    pack = ShardedPack(sharded_pack)
+    puzzles = [pack[ordinal] for ordinal in range(len(pack))]
+    assert [puzzle["elo"] for puzzle in puzzles] == sorted(
+        puzzle["elo"] for puzzle in puzzles
+    )
+    # Only the shard holding an ordinal is read.
+    pack = ShardedPack(sharded_pack)
+    assert pack[57] == puzzles[57]
+    assert list(pack.loaded) == [2]
+    with pytest.raises(IndexError):
+        pack[120]
+
+
+@pytest.mark.parametrize("elo", [0, 1000, 1150, 1201, 1398, 1399, 5000])
+def test_sharded_pack_lookup_by_rating(sharded_pack, elo):
+    pack = ShardedPack(sharded_pack)
+    elos = [pack[ordinal]["elo"] for ordinal in range(len(pack))]
+    expected = next((i for i, puzzle_elo in enumerate(elos) if puzzle_elo >= elo), 119)
+    pack = ShardedPack(sharded_pack)
+    assert pack.index_for_elo(elo) == expected
+    # Only the shard whose rating band reaches elo is read.
+    assert len(pack.loaded) <= 1
+
+
+def test_sharded_pack_rerun_keeps_files(sharded_pack, puzzle_generator, tmp_path):
+    pack_dir = os.path.dirname(sharded_pack)
+    before = sorted(os.listdir(pack_dir))
+    (
+        tmp_path / "static" / os.path.basename(pack_dir) / "shard-00099.0.json"
+    ).write_text("{}")
+    index_file = export_sharded_pack(
+        str(tmp_path / "static"),
+        120,
+        "Pack",
+        1000,
+        1399,
+        shard_size=25,
+        puzzle_generator=puzzle_generator,
+        seed=7,
+    )
+    assert index_file == sharded_pack
+    assert os.path.basename(index_file) == SHARD_INDEX_FILE
+    # Same seed, same shards; shards no longer listed are removed.
+    assert sorted(os.listdir(pack_dir)) == before
+
+
+@pytest.fixture
+def export_packs(tmp_path, monkeypatch, puzzle_generator):
+    """export_puzzle_packs over the puzzle_generator fixture's packs, taking
+    the manifest as a list of specs."""
+    puzzle_files = puzzle_generator.puzzle_mapping.puzzle_files
+    monkeypatch.setattr(
+        static_puzzles, "PuzzlePacks", lambda: PuzzlePacks(puzzle_files)
+    )
+    monkeypatch.setattr(static_puzzles, "PuzzleGenerator", lambda: puzzle_generator)
+
+    def export(specs, output_dir, **kwargs):
+        manifest_file = tmp_path / "manifest.json"
+        manifest_file.write_text(json.dumps(specs))
+        return export_puzzle_packs(str(manifest_file), str(output_dir), **kwargs)
+
+    return export
+
+
+SPECS = [
+    {"puzzle_pack": "Pack", "num_puzzles": 20, "start_elo": 1000, "end_elo": 1200},
+    {
+        "puzzle_pack": "Pack",
+        "num_puzzles": 10,
+        "start_elo": 1100,
+        "end_elo": 1300,
+        "format": "json",
+        "seed": 5,
+    },
+]
+
+
+def read_dir(path):
+    return {name: (path / name).read_bytes() for name in sorted(os.listdir(path))}
+
+
+def test_same_seed_exports_identical_bytes(tmp_path, export_packs):
+    export_packs(SPECS, tmp_path / "a")
+    export_packs(SPECS, tmp_path / "b")
+    first = read_dir(tmp_path / "a")
+    assert first == read_dir(tmp_path / "b")
+    assert len(first) == 3
+
+    export_packs(SPECS, tmp_path / "a")
+    assert read_dir(tmp_path / "a") == first
+
+
+def test_incremental_export_skips_up_to_date_packs(tmp_path, monkeypatch, export_packs):
+    output_dir = tmp_path / "packs"
+    filepaths = export_packs(SPECS, output_dir)
+
+    exported = []
+    export_pack_spec = static_puzzles._export_pack_spec
+
+    def record(task):
+        exported.append(task[1]["num_puzzles"])
+        return export_pack_spec(task)
+
+    monkeypatch.setattr(static_puzzles, "_export_pack_spec", record)
+    assert export_packs(SPECS, output_dir, incremental=True) == filepaths
+    assert exported == []
+
+    # A new seed regenerates only its own pack.
+    specs = [SPECS[0], {**SPECS[1], "seed": 6}]
+    assert export_packs(specs, output_dir, incremental=True) == filepaths
+    assert exported == [10]
+
+
+def test_specs_writing_the_same_file_are_rejected(tmp_path, export_packs):
+    specs = [{**SPECS[0], "seed": 1}, SPECS[1], {**SPECS[0], "seed": 2}]
+    with pytest.raises(ValueError, match="entries 0 and 2"):
+        export_packs(specs, tmp_path / "packs")
+    assert not (tmp_path / "packs").exists()
@@ -0,0 +1,110 @@
+import chess
+import pytest
+
+from generate_puzzles import pawns_only_fen
+from process_puzzles import compute_offensive_fen
+from puzzle_index import (
+    StructureIndex,
+    pawn_structure_key,
+    pawn_structure_key_from_bitboards,
+)
+from puzzle_store import PuzzleStore, build_puzzle_store, load_puzzles
+
+START_FEN = chess.STARTING_FEN
+OPENINGS = [
+    [],
+    ["e2e4"],
+    ["e2e4", "e7e5"],
+    ["d2d4", "d7d5", "c2c4", "d5c4"],
+    ["e2e4", "d7d5", "e4d5", "g8f6"],
+    ["g1f3", "g8f6"],
+    ["a2a4", "h7h5", "a4a5", "b7b5", "a5b6"],
+]
+
+
+def board_after(moves):
+    board = chess.Board()
+    for move in moves:
+        board.push_uci(move)
+    return board
+
+
+@pytest.mark.parametrize("moves", OPENINGS)
+def test_key_matches_the_board_bitboards(moves):
+    board = board_after(moves)
+    assert pawn_structure_key(board.fen()) == pawn_structure_key_from_bitboards(
+        board.pawns & board.occupied_co[chess.WHITE],
+        board.pawns & board.occupied_co[chess.BLACK],
+    )
+
+
+def test_keys_agree_with_pawns_only_fen():
+    fens = [board_after(moves).fen() for moves in OPENINGS]
+    for a in fens:
+        for b in fens:
+            same_pawns = pawns_only_fen(a) == pawns_only_fen(b)
+            assert (pawn_structure_key(a) == pawn_structure_key(b)) == same_pawns
+
+
+@pytest.fixture
+def pack(make_row, write_dump):
+    """Puzzles from the start position whose first move is either a knight
+    move (structure unchanged) or e2e4 or d2d4."""
+    first_moves = ["g1f3", "e2e4", "e2e4", "d2d4", "g1f3", "e2e4", "b1c3"]
+    rows = [
+        make_row(
+            f"p{i}",
+            Moves=f"{move} e7e5",
+            OffensiveFEN=compute_offensive_fen(START_FEN, move),
+        )
+        for i, move in enumerate(first_moves)
+    ]
+    return write_dump("pack.csv", rows)
+
+
+def structure_after(move):
+    return pawn_structure_key(compute_offensive_fen(START_FEN, move))
+
+
+@pytest.mark.parametrize("source", ["puzzles", "store"])
+def test_index_groups_puzzles_by_structure(pack, source):
+    build_puzzle_store(pack)
+    puzzles = load_puzzles(pack)
+    if source == "puzzles":
+        puzzles = list(puzzles)
+    else:
+        assert isinstance(puzzles, PuzzleStore)
+    index = StructureIndex.build(puzzles, min_puzzles=1)
+
+    # Every puzzle starts from the same structure.
+    assert index.positions_for(pawn_structure_key(START_FEN)).tolist() == list(range(7))
+    assert index.positions_for(structure_after("e2e4")).tolist() == [1, 2, 5]
+    # d2d4 is reached by one puzzle only, which is not more than min_puzzles.
+    assert index.positions_for(structure_after("d2d4")).tolist() == []
+    assert len(index) == 2
+
+    matching = index.puzzles_matching(
+        [structure_after("e2e4"), structure_after("d2d4")]
+    )
+    assert [puzzle.puzzle_id for puzzle in matching] == ["p1", "p2", "p5"]
+
+
+def test_index_is_cached_until_the_pack_changes(
+    monkeypatch, pack, make_row, write_dump
+):
+    built = StructureIndex.load(pack, 1)
+    build = StructureIndex.build
+
+    def fail(puzzles, min_puzzles):
+        raise AssertionError("rebuilt a cached index")
+
+    monkeypatch.setattr(StructureIndex, "build", fail)
+    cached = StructureIndex.load(pack, 1)
+    assert cached.structure_ids == built.structure_ids
+    assert cached.positions.tolist() == built.positions.tolist()
+
+    monkeypatch.setattr(StructureIndex, "build", build)
+    # Another threshold, or other puzzles, are another index.
+    assert len(StructureIndex.load(pack, 0)) == 3
+    write_dump("pack.csv", [make_row("p0", OffensiveFEN="8/8/8/8/8/8/8/8 b - - 0 1")])
+    assert len(StructureIndex.load(pack, 0)) == 2
@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+
+from process_puzzles import Puzzle
+from puzzle_index import TagIndex
+from puzzle_store import PuzzleStore, PuzzleStoreWriter
+
+# (themes, opening tags, rating) per puzzle, in pack order.
+PACK = [
+    ("fork endgame short", "", 1200),
+    ("fork endgame long", "", 1300),
+    ("pin middlegame", "Sicilian_Defense Sicilian_Defense_Najdorf", 1400),
+    ("skewer opening", "Sicilian_Defense", 1500),
+    ("pin endgame short", "Italian_Game", 1600),
+    ("fork opening", "Italian_Game", 1700),
+    ("mate", "", 1800),
+]
+
+
+def make_puzzles():
+    return [
+        Puzzle(f"p{i}", "", "e2e4 e7e5", rating, 80, 90, 1000, themes, tags)
+        for i, (themes, tags, rating) in enumerate(PACK)
+    ]
+
+
+def make_store():
+    writer = PuzzleStoreWriter()
+    for puzzle in make_puzzles():
+        writer.add_row(
+            {
+                "PuzzleId": puzzle.puzzle_id,
+                "FEN": "",
+                "Moves": " ".join(puzzle.moves),
+                "Rating": puzzle.rating,
+                "RatingDeviation": puzzle.rating_deviation,
+                "Popularity": puzzle.popularity,
+                "NbPlays": puzzle.plays,
+                "Themes": puzzle.themes,
+                "OpeningTags": puzzle.opening_tags,
+                "OffensiveFEN": "unused",
+            }
+        )
+    return PuzzleStore.from_buffer(writer.to_bytes())
+
+
+@pytest.fixture(params=["puzzles", "store"])
+def index(request):
+    puzzles = make_puzzles() if request.param == "puzzles" else make_store()
+    return TagIndex.build(puzzles)
+
+
+def expected(predicate):
+    return [
+        i
+        for i, (themes, tags, _) in enumerate(PACK)
+        if predicate(set(themes.split()), set(tags.lower().split()))
+    ]
+
+
+@pytest.mark.parametrize(
+    "query, predicate",
+    [
+        ("fork", lambda t, o: "fork" in t),
+        ("FORK", lambda t, o: "fork" in t),
+        ("fork endgame", lambda t, o: {"fork", "endgame"} <= t),
+        (
+            "fork AND endgame AND NOT long",
+            lambda t, o: {"fork", "endgame"} <= t and "long" not in t,
+        ),
+        (
+            "(pin OR skewer) sicilian_defense",
+            lambda t, o: t & {"pin", "skewer"} and "sicilian_defense" in o,
+        ),
+        # AND binds tighter than OR, and NOT tighter than AND.
+        ("fork OR pin endgame", lambda t, o: "fork" in t or {"pin", "endgame"} <= t),
+        ("NOT fork endgame", lambda t, o: "fork" not in t and "endgame" in t),
+        ("NOT (fork OR pin)", lambda t, o: not t & {"fork", "pin"}),
+        ("NOT NOT mate", lambda t, o: "mate" in t),
+        ("NOT short AND NOT long", lambda t, o: not t & {"short", "long"}),
+        ("opening:italian_game", lambda t, o: "italian_game" in o),
+        ("theme:opening", lambda t, o: "opening" in t),
+        ("opening:opening", lambda t, o: False),
+        ("unknown_tag", lambda t, o: False),
+        ("NOT unknown_tag", lambda t, o: True),
+    ],
+)
+def test_query_matches_predicate(index, query, predicate):
+    positions = index.query(query)
+    assert positions.tolist() == expected(predicate)
+
+
+def test_query_filters_by_rating(index):
+    assert index.query("fork", min_rating=1250).tolist() == [1, 5]
+    assert index.query("fork", max_rating=1300).tolist() == [0, 1]
+    assert index.query("endgame", 1300, 1600).tolist() == [1, 4]
+
+
+def test_puzzles_matching_returns_puzzles(index):
+    puzzles = index.puzzles_matching("pin AND short")
+    assert [puzzle.puzzle_id for puzzle in puzzles] == ["p4"]
+
+
+def test_query_positions_are_sorted_and_unique(index):
+    positions = index.query("fork OR endgame OR fork")
+    assert np.array_equal(positions, np.unique(positions))
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "",
+        "   ",
+        "fork AND",
+        "(fork",
+        "fork )",
+        "AND fork",
+        "fork OR",
+        "NOT",
+        "bogus:fork",
+    ],
+)
+def test_invalid_queries_raise(index, query):
+    with pytest.raises(ValueError):
+        index.query(query)